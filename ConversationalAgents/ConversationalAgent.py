@@ -1,40 +1,327 @@
 from abc import ABC
+import asyncio
 import json
-import re
-from typing import Dict
+import queue
+import threading
+import weakref
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from ConversationalAgents.PrefixCache import PrefixCacheStats
+from ConversationalAgents.ResponseCache import ResponseCache
+from ConversationalAgents.StructuredOutput import JSONRepairError, StructuredOutputStats, json_instructions, parse_json
 
 class ConversationalAgent(ABC):
-    def __init__(self, model:str):
+    # Identificador del proveedor, forma parte de la clave de la caché de respuestas
+    provider: str = "generic"
+    default_temperature: float = 0.7
+    # Veces que clean_answer vuelve a pedir al modelo un JSON que no se ha podido reparar localmente
+    max_json_reprompts: int = 1
+
+    def __init__(self, model:str, max_concurrency: int = 4, cache: Optional[ResponseCache] = None):
+        """
+        Args:
+            model: Nombre del modelo a usar
+            max_concurrency: Número máximo de peticiones simultáneas al proveedor
+            cache: Caché de respuestas; por defecto se configura desde el entorno (LLM_CACHE_MODE)
+        """
         self.model = model
+        self.max_concurrency = max_concurrency
+        self.cache = cache if cache is not None else ResponseCache.from_env()
+        # Un semáforo por event loop: varios hilos (ej: los workers de StoryService) pueden usar el mismo agente
+        self._semaphores: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Semaphore]" = weakref.WeakKeyDictionary()
+        self._semaphores_lock = threading.Lock()
+        self.structured_output_stats = StructuredOutputStats()
+        self.prefix_cache_stats = PrefixCacheStats()
 
     def start(self):
         pass
 
-    def ask(self, prompt: str)-> str:
-        pass
+    def ask(self, prompt: str, temperature: Optional[float] = None, prefix: Optional[str] = None)-> str:
+        """
+        Envía un prompt al modelo pasando por la caché de respuestas (read-through/write-through).
+
+        Args:
+            prompt: Texto a enviar
+            temperature: Temperatura de muestreo (por defecto la del proveedor)
+            prefix: Parte estable del prompt, común a muchas peticiones (ej: la biblia del mundo
+                de la historia). Se envía delante de prompt y, si el proveedor lo admite, se sirve
+                desde su caché de prefijos (ver prefix_cache_stats)
+
+        Returns:
+            Respuesta del modelo
+        """
+        temperature = self.default_temperature if temperature is None else temperature
+        key = self._prefixed_cache_key(prompt, temperature, prefix)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            return cached
+        response = self._ask(prompt, temperature, prefix)
+        if self.cache is not None:
+            self.cache.put(key, response)
+        return response
+
+    async def ask_async(self, prompt: str, temperature: Optional[float] = None, prefix: Optional[str] = None) -> str:
+        """Versión asíncrona de ask, también pasa por la caché de respuestas"""
+        temperature = self.default_temperature if temperature is None else temperature
+        key = self._prefixed_cache_key(prompt, temperature, prefix)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            return cached
+        response = await self._ask_async(prompt, temperature, prefix)
+        if self.cache is not None:
+            self.cache.put(key, response)
+        return response
+
+    def ask_json(self, prompt: str, schema: Optional[Dict] = None, temperature: Optional[float] = None) -> Union[Dict, List]:
+        """
+        Pide una respuesta JSON con el modo de salida estructurada del proveedor (y el esquema,
+        si se indica y el proveedor lo admite) y la devuelve ya leída (ver clean_answer).
+
+        Args:
+            prompt: Texto a enviar
+            schema: Esquema JSON de la respuesta (opcional)
+            temperature: Temperatura de muestreo (por defecto la del proveedor)
+        """
+        temperature = self.default_temperature if temperature is None else temperature
+        return self.clean_answer(self._ask_json_cached(prompt, temperature, schema))
+
+    def _ask_json_cached(self, prompt: str, temperature: float, schema: Optional[Dict]) -> str:
+        """_ask_json pasando por la caché de respuestas (el esquema forma parte de la clave)"""
+        key = self._cache_key(prompt, temperature, "json", json.dumps(schema, sort_keys=True, ensure_ascii=False))
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            return cached
+        response = self._ask_json(prompt, temperature, schema)
+        if self.cache is not None:
+            self.cache.put(key, response)
+        return response
+
+    def ask_stream(self, prompt: str, temperature: Optional[float] = None, prefix: Optional[str] = None) -> Iterator[str]:
+        """
+        Envía un prompt y devuelve la respuesta por fragmentos a medida que el proveedor
+        la genera. Si la respuesta está en la caché se devuelve en un único fragmento.
+        """
+        temperature = self.default_temperature if temperature is None else temperature
+        key = self._prefixed_cache_key(prompt, temperature, prefix)
+        cached = self.cache.get(key) if self.cache is not None else None
+        if cached is not None:
+            yield cached
+            return
+        chunks = []
+        for chunk in self._ask_stream(prompt, temperature, prefix):
+            chunks.append(chunk)
+            yield chunk
+        if self.cache is not None:
+            self.cache.put(key, "".join(chunks))
+
+    def _ask(self, prompt: str, temperature: float, prefix: Optional[str] = None) -> str:
+        """
+        Llamada real al proveedor, la implementa cada agente. Los proveedores sin caché de
+        prefijos envían prefix + prompt (ver join_prefix).
+        """
+        raise NotImplementedError
+
+    async def _ask_async(self, prompt: str, temperature: float, prefix: Optional[str] = None) -> str:
+        """
+        Llamada asíncrona al proveedor. Por defecto ejecuta _ask en un hilo para no
+        bloquear el event loop; los proveedores con cliente asíncrono la sobrescriben.
+        """
+        return await asyncio.to_thread(self._ask, prompt, temperature, prefix)
+
+    def _ask_stream(self, prompt: str, temperature: float, prefix: Optional[str] = None) -> Iterator[str]:
+        """Llamada en streaming al proveedor. Por defecto devuelve la respuesta completa de una vez"""
+        yield self._ask(prompt, temperature, prefix)
+
+    def _ask_json(self, prompt: str, temperature: float, schema: Optional[Dict]) -> str:
+        """
+        Llamada al proveedor pidiendo una respuesta JSON. Por defecto se pide en el propio
+        prompt; los proveedores con modo JSON o esquema de respuesta la sobrescriben.
+        """
+        return self._ask(prompt + json_instructions(schema), temperature)
+
+    def _cache_key(self, prompt: str, temperature: float, *extra: str) -> str:
+        return ResponseCache.make_key(self.provider, self.model, temperature, prompt, *extra)
+
+    def caches_prefix(self, prefix: str) -> bool:
+        """
+        True si el proveedor puede servir este prefijo desde una caché explícita, de modo que
+        compensa que sea largo (ej: con todo el reparto de la historia). Si no, conviene dejar
+        en el prefijo solo lo común y enviar en cada prompt solo lo que necesita.
+        """
+        return False
+
+    def release_prefix(self, prefix: str) -> None:
+        """Libera la caché del proveedor asociada al prefijo cuando ya no se va a usar"""
+
+    def _prefixed_cache_key(self, prompt: str, temperature: float, prefix: Optional[str]) -> str:
+        """Clave de la caché de respuestas; sin prefijo es la misma que antes de existir el parámetro"""
+        if prefix is None:
+            return self._cache_key(prompt, temperature)
+        return self._cache_key(prompt, temperature, "prefix", prefix)
+
+    async def ask_many_async(self,
+                             prompts: Sequence[str],
+                             concurrency: Optional[int] = None,
+                             return_exceptions: bool = False,
+                             **kwargs) -> List[Union[str, BaseException]]:
+        """
+        Envía varios prompts independientes en paralelo.
+
+        Args:
+            prompts: Lista de prompts a enviar
+            concurrency: Límite adicional de peticiones simultáneas para esta llamada
+            return_exceptions: Si True, las excepciones se devuelven en la posición del prompt fallido
+            **kwargs: Parámetros que se pasan a ask_async (ej: temperature o prefix)
+
+        Returns:
+            Respuestas en el mismo orden que los prompts
+        """
+        local_semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+        return await asyncio.gather(*(self._bounded_ask(p, local_semaphore, **kwargs) for p in prompts),
+                                    return_exceptions=return_exceptions)
+
+    async def _bounded_ask(self,
+                           prompt: str,
+                           local_semaphore: Optional[asyncio.Semaphore],
+                           cancelled: Optional[threading.Event] = None,
+                           **kwargs) -> str:
+        """
+        ask_async limitado por el semáforo del agente y, si se indica, por uno propio de la
+        llamada. Si cancelled está activado al conseguir turno, la petición no se envía.
+        """
+        semaphore = self._get_semaphore()
+        if local_semaphore is None:
+            async with semaphore:
+                _check_cancelled(cancelled)
+                return await self.ask_async(prompt, **kwargs)
+        async with local_semaphore:
+            async with semaphore:
+                _check_cancelled(cancelled)
+                return await self.ask_async(prompt, **kwargs)
+
+    def ask_many(self,
+                 prompts: Sequence[str],
+                 concurrency: Optional[int] = None,
+                 return_exceptions: bool = False,
+                 **kwargs) -> List[Union[str, BaseException]]:
+        """
+        Versión síncrona de ask_many_async, para usar desde el pipeline de PlotMind.
+        """
+        return run_coroutine(self.ask_many_async(prompts, concurrency=concurrency,
+                                                 return_exceptions=return_exceptions, **kwargs))
+
+    def iter_many(self,
+                  prompts: Sequence[str],
+                  concurrency: Optional[int] = None,
+                  **kwargs) -> Iterator[Tuple[int, Union[str, BaseException]]]:
+        """
+        Igual que ask_many pero devuelve cada respuesta en cuanto está lista, como pares
+        (índice del prompt, respuesta). Las excepciones se devuelven en lugar de la respuesta.
+        Si se deja de consumir el iterador (se cierra o el bucle que lo recorre falla), las
+        peticiones que aún no se han enviado se descartan.
+        """
+        results: "queue.Queue[Tuple[int, Union[str, BaseException]]]" = queue.Queue()
+        cancelled = threading.Event()
+
+        async def produce():
+            local_semaphore = asyncio.Semaphore(concurrency) if concurrency else None
+
+            async def one(index: int, prompt: str):
+                try:
+                    response = await self._bounded_ask(prompt, local_semaphore, cancelled, **kwargs)
+                except IterationCancelled:
+                    return
+                except Exception as e:
+                    response = e
+                results.put((index, response))
+
+            await asyncio.gather(*(one(i, p) for i, p in enumerate(prompts)))
+
+        thread = threading.Thread(target=asyncio.run, args=(produce(),), daemon=True)
+        thread.start()
+        try:
+            for _ in range(len(prompts)):
+                yield results.get()
+        finally:
+            # Solo quedan por terminar las peticiones ya enviadas
+            cancelled.set()
+            thread.join()
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        """Devuelve el semáforo del event loop actual (asyncio.Semaphore no se puede compartir entre loops)"""
+        loop = asyncio.get_running_loop()
+        with self._semaphores_lock:
+            if loop not in self._semaphores:
+                self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+            return self._semaphores[loop]
 
     def clean_answer(self, answer: str) -> Dict:
         """
-        Limpia la respuesta del modelo para eliminar caracteres innecesarios.
+        Lee el JSON de la respuesta del modelo. Si no es válido se repara localmente (ver
+        StructuredOutput.repair_json) y solo si no se puede reparar se pide al modelo que lo
+        corrija, como mucho max_json_reprompts veces. Cada caso se cuenta en structured_output_stats.
         Args:
             answer: Respuesta cruda del modelo.
         Returns:
-            Respuesta limpia.
+            Respuesta limpia ({} si no se ha podido leer).
         """
-        try:
-            # Limpieza robusta (incluye casos con '```json' y '```' en líneas separadas)
-            clean_response = re.sub(r'^```json|```$', '', answer.strip(), flags=re.DOTALL).strip()
-            
-            # Parsear y validar
-            parsed = json.loads(clean_response)
-            return parsed
-        except json.JSONDecodeError as e:
-            print(f"Error de JSON (posible respuesta corrupta): {e}")
-            new_prompt = f"""El siguiente texto no es un JSON válido:
-            {clean_response}
-            Por favor, corrige el formato y devuelve solo un JSON válido, sin comentarios adicionales.
+        reprompts = 0
+        while True:
+            try:
+                parsed, repaired = parse_json(answer)
+                outcome = "reprompted" if reprompts else "repaired" if repaired else "parsed"
+                self.structured_output_stats.record(outcome, reprompts)
+                return parsed
+            except JSONRepairError as e:
+                if reprompts >= self.max_json_reprompts:
+                    print(f"Error de JSON, se descarta la respuesta: {e}")
+                    self.structured_output_stats.record("failed", reprompts)
+                    return {}
+                print(f"Error de JSON (posible respuesta corrupta): {e}")
+                new_prompt = f"""El siguiente texto no es un JSON válido:
+            {answer}
+            Por favor, corrige el formato y devuelve solo un JSON válido, sin comentarios adicionales, sabiendo que está dando el siguiente error:
+            {e}
             """
-            return self.clean_answer(self.ask(new_prompt))
-        except Exception as e:
-            print(f"Error inesperado: {e}")
-            return {}
\ No newline at end of file
+                reprompts += 1
+                answer = self._ask_json_cached(new_prompt, self.default_temperature, None)
+
+
+class IterationCancelled(Exception):
+    """Petición de iter_many descartada porque ya nadie consume sus resultados"""
+
+
+def _check_cancelled(cancelled: Optional[threading.Event]) -> None:
+    if cancelled is not None and cancelled.is_set():
+        raise IterationCancelled()
+
+
+def join_prefix(prefix: Optional[str], prompt: str) -> str:
+    """Prompt completo para los proveedores que reciben el prefijo como texto"""
+    return prompt if prefix is None else prefix + "\n" + prompt
+
+
+def run_coroutine(coroutine):
+    """
+    Ejecuta una corrutina desde código síncrono. Si ya hay un event loop corriendo
+    en este hilo (ej: dentro del bot de Telegram) se ejecuta en un hilo aparte.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+
+    result = {}
+
+    def runner():
+        try:
+            result["value"] = asyncio.run(coroutine)
+        except BaseException as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=runner)
+    thread.start()
+    thread.join()
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
@@ -1,8 +1,13 @@
-from openai import OpenAI
+import asyncio
+from typing import Dict, Iterator, Optional
+from openai import AsyncOpenAI, OpenAI
 from dotenv import load_dotenv
 import os
 
-from ConversationalAgents.ConversationalAgent import ConversationalAgent
+from ConversationalAgents.ConversationalAgent import ConversationalAgent, join_prefix
+from ConversationalAgents.ResponseCache import ResponseCache
+from ConversationalAgents.StructuredOutput import json_instructions
+from ConversationalAgents.RateLimiter import RateLimiter, call_with_retries, call_with_retries_async, estimate_tokens, get_rate_limiter
 
 load_dotenv()
 api_key = os.getenv("API_KEY_DEEPSEEK")
@@ -10,9 +15,13 @@ api_key = os.getenv("API_KEY_DEEPSEEK")
 from openai import OpenAI
 
 class DeepSeek(ConversationalAgent):
+    provider = "deepseek"
+    default_temperature = 0.7
+
     def __init__(self, system_prompt: str = "Eres un asistente útil", 
                  model: str = "deepseek/deepseek-r1:free", base_url: str = "https://api.deepseek.com",
-                 proxies: dict = None, api_key: str = api_key):
+                 proxies: dict = None, api_key: str = api_key, max_concurrency: int = 4,
+                 max_retries: int = 6, rate_limiter: RateLimiter = None, cache: ResponseCache = None):
         """
         Inicializa el cliente de DeepSeek.
         
@@ -21,35 +30,160 @@ class DeepSeek(ConversationalAgent):
         :param model: Nombre del modelo a usar
         :param base_url: URL base de la API
         :param proxies: Diccionario de proxies (opcional)
+        :param max_concurrency: Número máximo de peticiones simultáneas
+        :param max_retries: Reintentos (con backoff exponencial) ante errores del servidor
+        :param rate_limiter: Limitador a usar; por defecto el compartido para este modelo
+        :param cache: Caché de respuestas; por defecto se configura desde el entorno
         """
+        super().__init__(model, max_concurrency, cache)
         client_params = {
             'api_key': api_key,
             'base_url': base_url
         }
         
+        self.client_params = client_params
         self.client = OpenAI(**client_params)
+        self._async_client = (None, None)
         self.system_prompt = system_prompt
         self.model = model
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter or get_rate_limiter("deepseek", model)
 
-    def ask(self, user_prompt: str, temperature: float = 0.7) -> str:
+    def _ask(self, user_prompt: str, temperature: float, prefix: Optional[str] = None) -> str:
         """
         Envía un prompt al modelo y devuelve la respuesta.
         
         :param user_prompt: Texto de la pregunta/comando
         :param temperature: Creatividad (0.0 a 1.0)
+        :param prefix: Parte estable del prompt; va al principio del mensaje para que la
+            caché de prefijos de DeepSeek la reutilice entre peticiones
         :return: Respuesta del modelo como string
         """
+        user_prompt = join_prefix(prefix, user_prompt)
         messages = [
             {"role": "system", "content": self.system_prompt},
             {"role": "user", "content": user_prompt}
         ]
         
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            temperature=temperature,
-            stream=False
-        )
+        def generate():
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                stream=False
+            )
+            self._record_usage(response.usage, prefix)
+            return response.choices[0].message.content
+
+        return call_with_retries(generate, self.rate_limiter, estimate_tokens(self.system_prompt + user_prompt),
+                                 self.max_retries, description=f"DeepSeek {self.model}")
+
+    async def _ask_async(self, user_prompt: str, temperature: float, prefix: Optional[str] = None) -> str:
+        """
+        Versión asíncrona de _ask usando el cliente asíncrono de OpenAI.
+        
+        :param user_prompt: Texto de la pregunta/comando
+        :param temperature: Creatividad (0.0 a 1.0)
+        :param prefix: Parte estable del prompt (ver _ask)
+        :return: Respuesta del modelo como string
+        """
+        user_prompt = join_prefix(prefix, user_prompt)
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
         
-        return response.choices[0].message.content
+        async def generate():
+            response = await self._get_async_client().chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                stream=False
+            )
+            self._record_usage(response.usage, prefix)
+            return response.choices[0].message.content
+
+        return await call_with_retries_async(generate, self.rate_limiter, estimate_tokens(self.system_prompt + user_prompt),
+                                             self.max_retries, description=f"DeepSeek {self.model}")
+
+    def _ask_json(self, user_prompt: str, temperature: float, schema: Optional[Dict]) -> str:
+        """
+        Modo JSON de DeepSeek (response_format json_object). No admite esquema, así que el
+        esquema se describe en el prompt (que además tiene que mencionar JSON).
+        """
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": user_prompt + json_instructions(schema)}
+        ]
+
+        def generate():
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                response_format={"type": "json_object"},
+                stream=False
+            )
+            return response.choices[0].message.content
+
+        return call_with_retries(generate, self.rate_limiter, estimate_tokens(self.system_prompt + user_prompt),
+                                 self.max_retries, description=f"DeepSeek {self.model}")
+
+    def _ask_stream(self, user_prompt: str, temperature: float, prefix: Optional[str] = None) -> Iterator[str]:
+        """
+        Envía un prompt con stream=True y devuelve los fragmentos a medida que llegan.
+        Solo se reintenta la apertura del stream; un error a mitad de respuesta se propaga.
+        """
+        user_prompt = join_prefix(prefix, user_prompt)
+        messages = [
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+
+        stream = call_with_retries(
+            lambda: self.client.chat.completions.create(
+                model=self.model,
+                messages=messages,
+                temperature=temperature,
+                stream=True,
+                # El último fragmento trae el uso de tokens (sin choices)
+                stream_options={"include_usage": True}
+            ),
+            self.rate_limiter, estimate_tokens(self.system_prompt + user_prompt),
+            self.max_retries, description=f"DeepSeek {self.model}")
+
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if getattr(chunk, "usage", None) is not None:
+                self._record_usage(chunk.usage, prefix)
+
+    def _record_usage(self, usage, prefix: Optional[str]) -> None:
+        """
+        Registra los tokens servidos desde la caché de prefijos en las peticiones con prefijo.
+        DeepSeek los informa en prompt_cache_hit_tokens; las APIs compatibles con OpenAI, en
+        prompt_tokens_details.cached_tokens.
+        """
+        if prefix is None:
+            return
+        if usage is None:
+            self.prefix_cache_stats.record(None, None)
+            return
+        cached_tokens = getattr(usage, "prompt_cache_hit_tokens", None)
+        if cached_tokens is None and getattr(usage, "prompt_tokens_details", None) is not None:
+            cached_tokens = usage.prompt_tokens_details.cached_tokens
+        self.prefix_cache_stats.record(usage.prompt_tokens, cached_tokens)
+
+    def _cache_key(self, prompt: str, temperature: float, *extra: str) -> str:
+        # El prompt de sistema también condiciona la respuesta
+        return ResponseCache.make_key(self.provider, self.model, temperature, prompt, self.system_prompt, *extra)
 
+    def _get_async_client(self) -> AsyncOpenAI:
+        """El cliente asíncrono mantiene conexiones ligadas a un event loop, se crea uno por loop"""
+        loop = asyncio.get_running_loop()
+        # (cliente, loop) se lee y se escribe de una vez: varios hilos pueden compartir el agente
+        client, client_loop = self._async_client
+        if client is None or client_loop is not loop:
+            client = AsyncOpenAI(**self.client_params)
+            self._async_client = (client, loop)
+        return client
@@ -1,7 +1,8 @@
-import json
-import re
+import asyncio
+import hashlib
+import threading
 import time
-from typing import Dict
+from typing import Dict, Iterator, Optional, Tuple
 from dotenv import load_dotenv
 import os
 from google.genai import types
@@ -9,56 +10,230 @@ from google.genai import types
 load_dotenv()
 api_key = os.getenv("API_KEY_GEMINI")
 from google import genai
-from ConversationalAgents.ConversationalAgent import ConversationalAgent
+from ConversationalAgents.ConversationalAgent import ConversationalAgent, join_prefix
+from ConversationalAgents.ResponseCache import ResponseCache
+from ConversationalAgents.RateLimiter import RateLimiter, call_with_retries, call_with_retries_async, estimate_tokens, get_rate_limiter, is_retryable
 
 class Gemini (ConversationalAgent):
-    def __init__(self, model : str = "gemini-2.0-flash-exp"):
-        super().__init__(model)
+    provider = "gemini"
+    default_temperature = 0.6
+    # Tokens mínimos que admite la caché de contexto explícita; con prefijos más cortos el
+    # prefijo se envía al principio del prompt (los modelos 2.5 lo cachean implícitamente)
+    min_cache_tokens = 4096
+    # Vida de cada caché de contexto; se renueva si se sigue usando cuando está a punto de
+    # expirar y se borra antes con release_prefix cuando la historia ya no la necesita
+    cache_ttl_seconds = 900
+
+    def __init__(self, model : str = "gemini-2.0-flash-exp", max_concurrency: int = 4,
+                 max_retries: int = 6, rate_limiter: RateLimiter = None, cache: ResponseCache = None):
+        """
+        Args:
+            model: Nombre del modelo de Gemini
+            max_concurrency: Número máximo de peticiones simultáneas
+            max_retries: Reintentos (con backoff exponencial) ante errores del servidor
+            rate_limiter: Limitador a usar; por defecto el compartido para este modelo
+            cache: Caché de respuestas; por defecto se configura desde el entorno
+        """
+        super().__init__(model, max_concurrency, cache)
         self.client = genai.Client(api_key=api_key)
+        self.max_retries = max_retries
+        self.rate_limiter = rate_limiter or get_rate_limiter("gemini", model)
+        self._async_client = (None, None)
+        # Cachés de contexto creadas por este agente: hash del prefijo -> (nombre, expiración)
+        self._context_caches: Dict[str, Tuple[str, float]] = {}
+        # Cachés que se están creando: los hilos que piden el mismo prefijo esperan a la primera
+        self._pending_caches: Dict[str, threading.Event] = {}
+        # Prefijos que el proveedor ha rechazado (ej: por no llegar al mínimo de tokens)
+        self._uncacheable: set = set()
+        self._context_caches_lock = threading.Lock()
+        # Se desactiva si el modelo no admite caché de contexto explícita
+        self.context_caching = True
         #print(self.client.models.list())
         
 
-    def ask(self, prompt: str, temperature: float = 0.6) -> str:
-        time.sleep(5)
-        try:
+    def _ask(self, prompt: str, temperature: float, prefix: Optional[str] = None) -> str:
+        contents, config = self._request(prompt, temperature, prefix, self._cached_content(prefix))
+
+        def generate():
             response = self.client.models.generate_content(
-                    model= self.model, contents=prompt,
-                    config=types.GenerateContentConfig(
-                        temperature=temperature)
+                    model= self.model, contents=contents,
+                    config=config
+            )
+            self._record_usage(response, prefix)
+            return response.text if isinstance(response.text, str) else None
+
+        return call_with_retries(generate, self.rate_limiter, estimate_tokens(join_prefix(prefix, prompt)),
+                                 self.max_retries, description=f"Gemini {self.model}")
+
+    async def _ask_async(self, prompt: str, temperature: float, prefix: Optional[str] = None) -> str:
+        """Versión asíncrona de _ask usando el cliente asíncrono de genai"""
+        cached_content = await asyncio.to_thread(self._cached_content, prefix) if prefix is not None else None
+        contents, config = self._request(prompt, temperature, prefix, cached_content)
+
+        async def generate():
+            response = await self._get_async_client().aio.models.generate_content(
+                    model= self.model, contents=contents,
+                    config=config
             )
+            self._record_usage(response, prefix)
+            return response.text if isinstance(response.text, str) else None
+
+        return await call_with_retries_async(generate, self.rate_limiter, estimate_tokens(join_prefix(prefix, prompt)),
+                                             self.max_retries, description=f"Gemini {self.model}")
+
+    def _ask_json(self, prompt: str, temperature: float, schema: Optional[Dict]) -> str:
+        """Modo JSON de Gemini: response_mime_type y, si se indica, response_schema"""
+        config = types.GenerateContentConfig(temperature=temperature, response_mime_type="application/json")
+        if schema is not None:
+            config.response_schema = schema
+
+        def generate():
+            response = self.client.models.generate_content(model= self.model, contents=prompt, config=config)
+            return response.text if isinstance(response.text, str) else None
+
+        return call_with_retries(generate, self.rate_limiter, estimate_tokens(prompt),
+                                 self.max_retries, description=f"Gemini {self.model}")
+
+    def _ask_stream(self, prompt: str, temperature: float, prefix: Optional[str] = None) -> Iterator[str]:
+        """
+        Devuelve la respuesta por fragmentos con generate_content_stream. El stream de genai es
+        perezoso (la petición sale al pedir el primer fragmento), así que se reintenta hasta
+        recibir el primer fragmento con texto; un error a mitad de respuesta se propaga.
+        """
+        contents, config = self._request(prompt, temperature, prefix, self._cached_content(prefix))
+
+        def open_stream():
+            stream = iter(self.client.models.generate_content_stream(
+                    model= self.model, contents=contents,
+                    config=config
+            ))
+            for chunk in stream:
+                if isinstance(chunk.text, str) and chunk.text:
+                    return chunk, stream
+            return None  # Respuesta sin texto: se reintenta
+
+        first_chunk, stream = call_with_retries(open_stream, self.rate_limiter, estimate_tokens(join_prefix(prefix, prompt)),
+                                                self.max_retries, description=f"Gemini {self.model}")
+        yield first_chunk.text
+        last_chunk = first_chunk
+        for chunk in stream:
+            last_chunk = chunk
+            if isinstance(chunk.text, str) and chunk.text:
+                yield chunk.text
+        # El uso de tokens completo llega en el último fragmento
+        self._record_usage(last_chunk, prefix)
+
+    def _request(self, prompt: str, temperature: float, prefix: Optional[str],
+                 cached_content: Optional[str]) -> Tuple[str, types.GenerateContentConfig]:
+        """Contenido y configuración de la petición: con caché de contexto solo se envía el prompt"""
+        if cached_content is None:
+            return join_prefix(prefix, prompt), types.GenerateContentConfig(temperature=temperature)
+        return prompt, types.GenerateContentConfig(temperature=temperature, cached_content=cached_content)
+
+    def caches_prefix(self, prefix: str) -> bool:
+        """True si el prefijo es apto para la caché de contexto explícita"""
+        return (self.context_caching and estimate_tokens(prefix) >= self.min_cache_tokens
+                and self._prefix_key(prefix) not in self._uncacheable)
+
+    def release_prefix(self, prefix: str) -> None:
+        """Borra la caché de contexto del prefijo (si existe) para que no siga generando coste"""
+        key = self._prefix_key(prefix)
+        with self._context_caches_lock:
+            entry = self._context_caches.pop(key, None)
+        if entry is not None:
+            self._delete_cache(entry[0])
+
+    def release_context_caches(self) -> None:
+        """Borra todas las cachés de contexto creadas por este agente (ej: al cerrar el bot)"""
+        with self._context_caches_lock:
+            names = [name for name, _ in self._context_caches.values()]
+            self._context_caches.clear()
+        for name in names:
+            self._delete_cache(name)
+
+    def _delete_cache(self, name: str) -> None:
+        try:
+            self.client.caches.delete(name=name)
         except Exception as e:
-            print(f"Error del servidor: {e}")
-            time.sleep(5)
-            return self.ask(prompt, temperature)
-        if isinstance(response.text, str):
-            return response.text
-        else :
-            time.sleep(5)
-            return self.ask(prompt, temperature)
-    
-    def clean_answer(self, answer: str) -> Dict:
+            # Si no se puede borrar, expira sola al terminar su TTL
+            print(f"No se ha podido borrar la caché de contexto {name}: {e}")
+
+    @staticmethod
+    def _prefix_key(prefix: str) -> str:
+        return hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+
+    def _cached_content(self, prefix: Optional[str]) -> Optional[str]:
         """
-        Limpia la respuesta del modelo para eliminar caracteres innecesarios.
-        Args:
-            answer: Respuesta cruda del modelo.
-        Returns:
-            Respuesta limpia.
+        Nombre de la caché de contexto del prefijo, creándola (client.caches.create) la primera
+        vez que se usa o si está a punto de expirar. None si el prefijo no es apto (ver
+        caches_prefix) o no se ha podido crear; en ese caso se envía como texto. La creación se
+        hace fuera del lock, con el limitador y los reintentos de las demás peticiones; solo
+        esperan a ella los hilos que piden el mismo prefijo.
         """
+        if prefix is None or not self.caches_prefix(prefix):
+            return None
+        key = self._prefix_key(prefix)
+        while True:
+            with self._context_caches_lock:
+                now = time.monotonic()
+                # Margen para que la caché no expire entre la consulta y la petición
+                for expired in [k for k, (_, expires) in self._context_caches.items() if expires - 60 < now]:
+                    del self._context_caches[expired]
+                if key in self._context_caches:
+                    return self._context_caches[key][0]
+                pending = self._pending_caches.get(key)
+                if pending is None:
+                    self._pending_caches[key] = threading.Event()
+                    break
+            pending.wait()
+            if not self.caches_prefix(prefix):
+                return None
+            with self._context_caches_lock:
+                if key not in self._context_caches:
+                    return None  # La creación ha fallado: se envía el prefijo como texto
+
+        name = None
         try:
-            # Limpieza robusta (incluye casos con '```json' y '```' en líneas separadas)
-            clean_response = re.sub(r'^```json|```$', '', answer.strip(), flags=re.DOTALL).strip()
-            
-            # Parsear y validar
-            parsed = json.loads(clean_response)
-            return parsed
-        except json.JSONDecodeError as e:
-            print(f"Error de JSON (posible respuesta corrupta): {e}")
-            new_prompt = f"""El siguiente texto no es un JSON válido:
-            {clean_response}
-            Por favor, corrige el formato y devuelve solo un JSON válido, sin comentarios adicionales, sabiendo que está dando el siguiente error:
-            {e}
-            """
-            return self.clean_answer(self.ask(new_prompt))
+            cache = call_with_retries(
+                lambda: self.client.caches.create(
+                    model=self.model,
+                    config=types.CreateCachedContentConfig(contents=[prefix], ttl=f"{self.cache_ttl_seconds}s")),
+                self.rate_limiter, estimate_tokens(prefix),
+                self.max_retries, description=f"Gemini {self.model} (caché de contexto)")
+            name = cache.name
         except Exception as e:
-            print(f"Error inesperado: {e}")
-            return {}
\ No newline at end of file
+            if is_retryable(e) or isinstance(e, RuntimeError):
+                # Fallo transitorio (o reintentos agotados): se vuelve a intentar en la próxima petición
+                print(f"No se ha podido crear la caché de contexto, se envía el prefijo en el prompt: {e}")
+            elif "token" in str(e).lower():
+                print(f"Gemini {self.model} rechaza cachear este prefijo, se envía en el prompt: {e}")
+                self._uncacheable.add(key)
+            else:
+                print(f"Gemini {self.model} no admite caché de contexto, se envía el prefijo en el prompt: {e}")
+                self.context_caching = False
+        finally:
+            with self._context_caches_lock:
+                if name is not None:
+                    self._context_caches[key] = (name, time.monotonic() + self.cache_ttl_seconds)
+                self._pending_caches.pop(key).set()
+        return name
+
+    def _record_usage(self, response, prefix: Optional[str]) -> None:
+        """Registra los tokens de entrada servidos desde la caché en las peticiones con prefijo"""
+        if prefix is None:
+            return
+        usage = getattr(response, "usage_metadata", None)
+        if usage is None or usage.prompt_token_count is None:
+            self.prefix_cache_stats.record(None, None)
+        else:
+            self.prefix_cache_stats.record(usage.prompt_token_count, usage.cached_content_token_count or 0)
+
+    def _get_async_client(self) -> genai.Client:
+        """El cliente asíncrono mantiene conexiones ligadas a un event loop, se crea uno por loop"""
+        loop = asyncio.get_running_loop()
+        # (cliente, loop) se lee y se escribe de una vez: varios hilos pueden compartir el agente
+        client, client_loop = self._async_client
+        if client is None or client_loop is not loop:
+            client = genai.Client(api_key=api_key)
+            self._async_client = (client, loop)
+        return client
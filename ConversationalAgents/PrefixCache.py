@@ -0,0 +1,42 @@
+import threading
+from typing import Dict, Optional
+
+
+class PrefixCacheStats:
+    def __init__(self):
+        """
+        Cuenta, para las peticiones con prefijo estable (ver ConversationalAgent.ask), cuántos
+        tokens de entrada ha enviado el proveedor y cuántos ha servido desde su caché de
+        prefijos (caché de contexto explícita de Gemini o caché de prefijos de DeepSeek).
+        """
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.requests_with_hits = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        # Peticiones con prefijo en las que el proveedor no informa de los tokens en caché
+        self.unreported = 0
+
+    def record(self, prompt_tokens: Optional[int], cached_tokens: Optional[int]) -> None:
+        with self._lock:
+            self.requests += 1
+            if prompt_tokens is None or cached_tokens is None:
+                self.unreported += 1
+                return
+            self.prompt_tokens += prompt_tokens
+            self.cached_tokens += cached_tokens
+            self.requests_with_hits += cached_tokens > 0
+
+    def summary(self) -> Dict[str, float]:
+        """Contadores, fracción de tokens de entrada servidos desde la caché y de peticiones con acierto"""
+        with self._lock:
+            reported = self.requests - self.unreported
+            return {
+                "requests": self.requests,
+                "requests_with_hits": self.requests_with_hits,
+                "unreported": self.unreported,
+                "prompt_tokens": self.prompt_tokens,
+                "cached_tokens": self.cached_tokens,
+                "token_hit_rate": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+                "request_hit_rate": self.requests_with_hits / reported if reported else 0.0,
+            }
@@ -0,0 +1,201 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+T = TypeVar("T")
+
+# Límites por defecto de cada proveedor (peticiones/minuto, tokens/minuto).
+# Se pueden sobrescribir con variables de entorno, ej: GEMINI_RPM=15, GEMINI_TPM=1000000
+DEFAULT_LIMITS: Dict[str, Tuple[float, float]] = {
+    "gemini": (15, 1_000_000),
+    "deepseek": (60, 1_000_000),
+}
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float):
+        """
+        Cubo de tokens clásico: se rellena de forma continua hasta su capacidad.
+
+        Args:
+            capacity: Número máximo de tokens acumulables (ráfaga permitida)
+            refill_per_second: Tokens que se recuperan por segundo
+        """
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self.last_refill
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_second)
+        self.last_refill = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Segundos que hay que esperar para poder consumir amount tokens (0 si ya es posible)"""
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.refill_per_second
+
+    def consume(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        """
+        Limita las peticiones a un modelo con dos cubos: peticiones/minuto y tokens/minuto.
+        Es seguro compartirlo entre hilos y entre corrutinas.
+
+        Args:
+            requests_per_minute: Peticiones permitidas por minuto
+            tokens_per_minute: Tokens de entrada permitidos por minuto
+        """
+        self.requests = TokenBucket(requests_per_minute, requests_per_minute / 60.0)
+        self.tokens = TokenBucket(tokens_per_minute, tokens_per_minute / 60.0)
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        """Consume la cuota si está disponible; si no, devuelve cuánto hay que esperar"""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(self.requests.wait_time(1, now), self.tokens.wait_time(tokens, now))
+            if wait == 0.0:
+                self.requests.consume(1)
+                self.tokens.consume(tokens)
+            return wait
+
+    def acquire(self, tokens: int = 1) -> None:
+        """Bloquea hasta que haya cuota para una petición de tokens tokens"""
+        while True:
+            wait = self._reserve(tokens)
+            if wait == 0.0:
+                return
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int = 1) -> None:
+        """Igual que acquire pero sin bloquear el event loop"""
+        while True:
+            wait = self._reserve(tokens)
+            if wait == 0.0:
+                return
+            await asyncio.sleep(wait)
+
+
+_limiters: Dict[Tuple[str, str], RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(provider: str, model: str,
+                     requests_per_minute: Optional[float] = None,
+                     tokens_per_minute: Optional[float] = None) -> RateLimiter:
+    """
+    Devuelve el limitador compartido para (proveedor, modelo), creándolo la primera vez.
+    Todas las instancias de un mismo modelo comparten la cuota.
+    """
+    key = (provider, model)
+    with _limiters_lock:
+        if key not in _limiters:
+            default_rpm, default_tpm = DEFAULT_LIMITS.get(provider, (60, 1_000_000))
+            prefix = provider.upper()
+            rpm = requests_per_minute or float(os.getenv(f"{prefix}_RPM", default_rpm))
+            tpm = tokens_per_minute or float(os.getenv(f"{prefix}_TPM", default_tpm))
+            _limiters[key] = RateLimiter(rpm, tpm)
+        return _limiters[key]
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación barata del número de tokens (~4 caracteres por token)"""
+    return max(1, len(text) // 4)
+
+
+# Códigos HTTP que indican un fallo transitorio (además de cualquier 5xx)
+RETRYABLE_STATUS = (408, 409, 429)
+# Errores de red y de tiempo de espera de los clientes (httpx, openai, google-genai), por nombre
+# para no depender de qué SDK está instalado
+_RETRYABLE_ERROR_NAMES = ("Timeout", "Connect", "RemoteProtocol", "RateLimit", "ServerError", "Unavailable")
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    True si merece la pena reintentar: límite de peticiones (429), tiempo de espera, error de
+    red o error del servidor (5xx). Los demás 4xx (petición incorrecta, autenticación, modelo
+    inexistente) y los errores de programación se propagan sin reintentar.
+    """
+    if isinstance(error, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(error, "code", None)  # google.genai.errors.APIError
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS or status >= 500
+    return any(name in type(error).__name__ for name in _RETRYABLE_ERROR_NAMES)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, max_delay: float = 60.0) -> float:
+    """Backoff exponencial con jitter completo: uniforme en [0, min(max_delay, base * 2^attempt)]"""
+    return random.uniform(0, min(max_delay, base * (2 ** attempt)))
+
+
+def call_with_retries(func: Callable[[], Optional[T]],
+                      limiter: RateLimiter,
+                      tokens: int,
+                      max_retries: int,
+                      description: str = "modelo") -> T:
+    """
+    Ejecuta func respetando el limitador y reintentando con backoff si lanza una
+    excepción transitoria (ver is_retryable) o devuelve None.
+
+    Raises:
+        RuntimeError: si se agotan los reintentos
+        Exception: la excepción de func, sin reintentar, si no es transitoria
+    """
+    error = None
+    for attempt in range(max_retries + 1):
+        limiter.acquire(tokens)
+        try:
+            result = func()
+            if result is not None:
+                return result
+            error = "respuesta vacía"
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            error = e
+        print(f"Error del servidor ({description}, intento {attempt + 1}/{max_retries + 1}): {error}")
+        if attempt < max_retries:
+            time.sleep(backoff_delay(attempt))
+    raise RuntimeError(f"{description} no respondió tras {max_retries + 1} intentos: {error}")
+
+
+async def call_with_retries_async(func: Callable[[], Awaitable[Optional[T]]],
+                                  limiter: RateLimiter,
+                                  tokens: int,
+                                  max_retries: int,
+                                  description: str = "modelo") -> T:
+    """Versión asíncrona de call_with_retries"""
+    error = None
+    for attempt in range(max_retries + 1):
+        await limiter.acquire_async(tokens)
+        try:
+            result = await func()
+            if result is not None:
+                return result
+            error = "respuesta vacía"
+        except Exception as e:
+            if not is_retryable(e):
+                raise
+            error = e
+        print(f"Error del servidor ({description}, intento {attempt + 1}/{max_retries + 1}): {error}")
+        if attempt < max_retries:
+            await asyncio.sleep(backoff_delay(attempt))
+    raise RuntimeError(f"{description} no respondió tras {max_retries + 1} intentos: {error}")
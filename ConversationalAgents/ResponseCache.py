@@ -0,0 +1,154 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class CacheMissError(KeyError):
+    """Se lanza en modo replay cuando un prompt no está en la caché"""
+
+
+class ResponseCache:
+    # off: sin caché | read_write: lee y escribe | read_only: solo lee | replay: solo lee y falla si no hay respuesta
+    MODES = ("off", "read_write", "read_only", "replay")
+
+    def __init__(self,
+                 path: str = "llm_cache.sqlite",
+                 mode: str = "read_write",
+                 ttl_seconds: Optional[float] = None,
+                 max_entries: Optional[int] = None):
+        """
+        Caché persistente de respuestas de los modelos, direccionada por contenido.
+
+        Args:
+            path: Ruta del fichero SQLite
+            mode: Modo de funcionamiento (ver MODES)
+            ttl_seconds: Tiempo de vida de cada entrada (None para no expirar)
+            max_entries: Número máximo de entradas; se expulsan las usadas hace más tiempo
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"Modo de caché desconocido '{mode}', debe ser uno de {self.MODES}")
+        self.path = path
+        self.mode = mode
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )"""
+        )
+        self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+        self._connection.commit()
+
+    @classmethod
+    def from_env(cls) -> Optional["ResponseCache"]:
+        """
+        Construye la caché a partir de las variables de entorno LLM_CACHE_MODE, LLM_CACHE_PATH,
+        LLM_CACHE_TTL y LLM_CACHE_MAX_ENTRIES. Devuelve None si el modo es 'off' (por defecto).
+        """
+        mode = os.getenv("LLM_CACHE_MODE", "off")
+        if mode == "off":
+            return None
+        ttl = os.getenv("LLM_CACHE_TTL")
+        max_entries = os.getenv("LLM_CACHE_MAX_ENTRIES")
+        return cls(path=os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite"),
+                   mode=mode,
+                   ttl_seconds=float(ttl) if ttl else None,
+                   max_entries=int(max_entries) if max_entries else None)
+
+    @staticmethod
+    def make_key(provider: str, model: str, temperature: float, prompt: str, *extra: str) -> str:
+        """Hash SHA-256 de (proveedor, modelo, temperatura, prompt, extras)"""
+        payload = json.dumps([provider, model, round(float(temperature), 4), prompt, *extra], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Devuelve la respuesta guardada o None si no existe o ha expirado.
+
+        Raises:
+            CacheMissError: en modo replay si la respuesta no está en la caché
+        """
+        if self.mode == "off":
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._connection.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                if self.mode == "read_write":
+                    self._connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+                    self._connection.commit()
+        if row is None:
+            if self.mode == "replay":
+                raise CacheMissError(key)
+            return None
+        return row[0]
+
+    def put(self, key: str, response: str) -> None:
+        """Guarda una respuesta (solo en modo read_write) y aplica la política de expulsión"""
+        if self.mode != "read_write" or not isinstance(response, str):
+            return
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            self._evict(now)
+            self._connection.commit()
+
+    def _evict(self, now: float) -> None:
+        """Elimina las entradas expiradas y, si se supera max_entries, las menos usadas recientemente"""
+        if self.ttl_seconds is not None:
+            self._connection.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        if self.max_entries is not None:
+            self._connection.execute(
+                """DELETE FROM responses WHERE key IN (
+                    SELECT key FROM responses ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )""",
+                (self.max_entries,),
+            )
+
+    def clear(self) -> None:
+        """Vacía la caché"""
+        with self._lock:
+            self._connection.execute("DELETE FROM responses")
+            self._connection.commit()
+
+    def stats(self) -> dict:
+        """Estadísticas de uso de la caché"""
+        total = self.hits + self.misses
+        return {
+            "entries": len(self),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
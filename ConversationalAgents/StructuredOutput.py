@@ -0,0 +1,313 @@
+import json
+import re
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Bloque de código markdown alrededor del JSON (```json ... ```)
+_FENCE = re.compile(r"^```(?:json)?\s*|\s*```$", re.IGNORECASE)
+# Literales de Python que los modelos escriben a veces en lugar de los de JSON
+_LITERALS = {"True": "true", "False": "false", "None": "null"}
+# Puntos de corte (comas) que se prueban, desde el final, para descartar un último valor a medias
+MAX_CUTS = 8
+
+OUTCOMES = ("parsed", "repaired", "reprompted", "failed")
+
+
+class JSONRepairError(ValueError):
+    """La respuesta no contiene un JSON que se pueda leer ni reparar"""
+
+
+def json_instructions(schema: Optional[Dict] = None) -> str:
+    """Instrucciones que se añaden al prompt cuando el proveedor no admite un esquema de respuesta"""
+    instructions = "\nResponde solo con un JSON válido, sin texto adicional"
+    if schema is not None:
+        instructions += f" que siga este esquema JSON:\n{json.dumps(schema, ensure_ascii=False)}"
+    return instructions
+
+
+def strip_code_fences(text: str) -> str:
+    return _FENCE.sub("", text.strip()).strip()
+
+
+def parse_json(text: str) -> Tuple[Any, bool]:
+    """
+    Lee el JSON de una respuesta del modelo, reparándolo si hace falta (ver repair_json).
+    Se ignoran el bloque de código markdown y el texto antes y después del JSON.
+
+    Returns:
+        (valor, True si ha habido que repararlo)
+
+    Raises:
+        JSONRepairError: si no hay JSON o no se puede reparar
+    """
+    text = strip_code_fences(text or "")
+    starts = [i for i in (text.find("{"), text.find("[")) if i >= 0]
+    if not starts:
+        raise JSONRepairError("La respuesta no contiene JSON")
+    text = text[min(starts):]
+    try:
+        value, _ = json.JSONDecoder().raw_decode(text)
+        return value, False
+    except json.JSONDecodeError:
+        pass
+    return repair_json(text), True
+
+
+def repair_json(text: str) -> Any:
+    """
+    Repara localmente los errores más habituales del JSON generado por los modelos, sin
+    volver a preguntarles: comas finales, comillas simples, claves sin comillas, saltos de
+    línea dentro de cadenas, True/False/None y respuestas truncadas (se cierran las cadenas
+    y estructuras abiertas; si el texto está truncado se prefiere cortarlo en una de las últimas
+    comas, descartando el último valor a medias, antes que completarlo con un valor inventado).
+
+    Raises:
+        JSONRepairError: si ninguna de las reparaciones da un JSON válido
+    """
+    for candidate in _repair_candidates(text):
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+    raise JSONRepairError("No se ha podido reparar el JSON")
+
+
+def _repair_candidates(text: str) -> List[str]:
+    """
+    Reescribe el texto como JSON en una sola pasada. Devuelve el resultado cerrando lo que
+    quede abierto y el mismo resultado cortado en las últimas comas. Si el texto está truncado
+    (queda una cadena o una estructura abierta) van primero los cortes, para no dar por bueno
+    un valor cortado a mitad de palabra ni un ': null' añadido al cerrar.
+    """
+    out: List[str] = []
+    closers: List[str] = []
+    cuts: List[Tuple[int, Tuple[str, ...]]] = []
+    quote: Optional[str] = None
+    i, n = 0, len(text)
+    while i < n:
+        c = text[i]
+        if quote:
+            if c == "\\":
+                if i + 1 < n:
+                    out.append("'" if text[i + 1] == "'" else text[i:i + 2])
+                i += 2
+                continue
+            if c == quote:
+                out.append('"')
+                quote = None
+            elif c == '"':
+                out.append('\\"')
+            elif c == "\n":
+                out.append("\\n")
+            elif c == "\t":
+                out.append("\\t")
+            else:
+                out.append(c)
+        elif c in "\"'":
+            quote = c
+            out.append('"')
+        elif c in "{[":
+            closers.append("}" if c == "{" else "]")
+            out.append(c)
+        elif c in "}]":
+            _drop_trailing_comma(out)
+            if closers:
+                closers.pop()
+            out.append(c)
+            if not closers:
+                break  # Fin del JSON: se ignora lo que venga después
+        elif c == ",":
+            cuts.append((len(out), tuple(closers)))
+            out.append(c)
+        elif c.isalpha() or c == "_":
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            if word in _LITERALS:
+                word = _LITERALS[word]
+            elif closers and closers[-1] == "}" and text[j:].lstrip().startswith(":"):
+                word = f'"{word}"'  # Clave sin comillas
+            out.append(word)
+            i = j
+            continue
+        else:
+            out.append(c)
+        i += 1
+
+    truncated = bool(quote or closers)
+    if quote:
+        out.append('"')  # Cadena truncada
+    full = [_close("".join(out), closers)]
+    cut = [_close("".join(out[:position]), list(cut_closers)) for position, cut_closers in list(reversed(cuts))[:MAX_CUTS]]
+    return cut + full if truncated else full + cut
+
+
+def _drop_trailing_comma(out: List[str]) -> None:
+    end = len(out)
+    while end and out[end - 1].isspace():
+        end -= 1
+    if end and out[end - 1] == ",":
+        del out[end - 1]
+
+
+def _close(text: str, closers: List[str]) -> str:
+    """Cierra las estructuras abiertas, quitando una coma o un ':' colgando al final"""
+    text = text.rstrip()
+    if text.endswith(","):
+        text = text[:-1]
+    elif text.endswith(":"):
+        text += " null"
+    return text + "".join(reversed(closers))
+
+
+class IncrementalJSONExtractor:
+    def __init__(self):
+        """
+        Extrae uno a uno los objetos completos que son elementos de una lista JSON (ej: cada
+        relación de {"relationships": [...]}) a medida que llega el texto, sin esperar a que
+        el documento entero sea válido. Un objeto mal formado o una respuesta truncada solo
+        hacen perder ese objeto, no los demás. Se puede alimentar con los fragmentos de
+        ask_stream o con la respuesta completa de una vez.
+        """
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        # Profundidad a la que empezó el objeto que se está leyendo y su texto
+        self._start: Optional[int] = None
+        self._buffer: List[str] = []
+        self.found = 0
+        self.invalid = 0
+        self.truncated = False
+
+    def feed(self, chunk: str) -> List[Dict]:
+        """Procesa un fragmento de texto y devuelve los objetos que se han completado en él"""
+        objects = []
+        for c in chunk:
+            if self._start is not None:
+                self._buffer.append(c)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c in "{[":
+                if c == "{" and self._start is None and self._stack and self._stack[-1] == "[":
+                    self._start = len(self._stack)
+                    self._buffer = [c]
+                self._stack.append(c)
+            elif c in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if self._start is not None and len(self._stack) == self._start:
+                    self._emit("".join(self._buffer), objects)
+                    self._start = None
+                    self._buffer = []
+        return objects
+
+    def close(self) -> List[Dict]:
+        """
+        Termina la lectura. Si el texto acaba a mitad de un objeto, ese objeto se cuenta como
+        inválido: repararlo supondría inventar el final de un valor que no ha llegado.
+        """
+        if self._start is not None:
+            self.truncated = True
+            self.found += 1
+            self.invalid += 1
+            self._start = None
+            self._buffer = []
+        return []
+
+    def _emit(self, text: str, objects: List[Dict]) -> None:
+        self.found += 1
+        try:
+            value, _ = parse_json(text)
+        except JSONRepairError:
+            value = None
+        if isinstance(value, dict):
+            objects.append(value)
+        else:
+            self.invalid += 1
+
+
+@dataclass
+class SalvageReport:
+    """Cómo se ha leído la lista de una respuesta (ver extract_items)"""
+    # parsed: JSON válido | repaired: reparado entero | salvaged: objeto a objeto | failed: nada
+    mode: str
+    items: int = 0
+    invalid: int = 0
+    truncated: bool = False
+    chunk: Optional[int] = None
+    kind: str = ""
+
+
+def extract_items(text: str, key: Optional[str] = None, required: Iterable[str] = ()) -> Tuple[List[Dict], SalvageReport]:
+    """
+    Elementos de la lista `key` de una respuesta JSON (o de la lista de primer nivel si
+    key es None). Primero se lee la respuesta entera (reparándola si hace falta); si no se
+    puede, si la respuesta está truncada o si objeto a objeto se recuperan más elementos, se
+    usa IncrementalJSONExtractor, que solo devuelve objetos completos. Los elementos en los
+    que algún campo de `required` falta o no es una cadena no vacía se descartan uno a uno.
+
+    Returns:
+        (elementos válidos, informe de cómo se han obtenido)
+    """
+    items: Optional[List] = None
+    mode = "failed"
+    try:
+        data, repaired = parse_json(text)
+        candidate = data.get(key) if key is not None and isinstance(data, dict) else data
+        if isinstance(candidate, list):
+            items, mode = candidate, "repaired" if repaired else "parsed"
+    except JSONRepairError:
+        pass
+
+    truncated = False
+    unreadable = 0
+    if mode != "parsed":
+        extractor = IncrementalJSONExtractor()
+        salvaged = extractor.feed(text or "") + extractor.close()
+        truncated = extractor.truncated
+        if items is None or truncated or len(salvaged) > len(items):
+            items, mode = salvaged, "salvaged" if salvaged else "failed"
+            unreadable = extractor.invalid
+
+    valid = [item for item in items or [] if isinstance(item, dict) and all(_present(item.get(field)) for field in required)]
+    return valid, SalvageReport(mode, len(valid), len(items or []) - len(valid) + unreadable, truncated)
+
+
+def _present(value: Any) -> bool:
+    """Un campo obligatorio tiene que ser una cadena con contenido (no null ni "")"""
+    return isinstance(value, str) and bool(value.strip())
+
+
+class StructuredOutputStats:
+    def __init__(self):
+        """
+        Cuenta cómo se ha obtenido cada respuesta JSON: leída directamente (parsed),
+        reparada localmente (repaired), tras volver a preguntar al modelo (reprompted) o
+        descartada (failed), y cuántas peticiones extra ha costado volver a preguntar.
+        """
+        self._lock = threading.Lock()
+        self.counts: Dict[str, int] = dict.fromkeys(OUTCOMES, 0)
+        self.reprompts = 0
+
+    def record(self, outcome: str, reprompts: int = 0) -> None:
+        with self._lock:
+            self.counts[outcome] += 1
+            self.reprompts += reprompts
+
+    def summary(self) -> Dict[str, float]:
+        """Contadores y fracción de respuestas de cada tipo"""
+        with self._lock:
+            total = sum(self.counts.values())
+            summary: Dict[str, float] = {**self.counts, "total": total, "extra_requests": self.reprompts}
+            for outcome in OUTCOMES:
+                summary[f"{outcome}_rate"] = self.counts[outcome] / total if total else 0.0
+            return summary
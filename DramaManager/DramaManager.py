@@ -1,6 +1,7 @@
 from collections import deque
 import time
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple
+import networkx as nx
 from ConversationalAgents.ConversationalAgent import ConversationalAgent
 from StorySpace.Character import Character
 from StorySpace.Event import Event
@@ -14,7 +15,68 @@ class DramaManager:
 
     def impove_characters(self, characters :List[Character], story: str)-> str:
         try:
-            prompt = f"""
+            prompt = self._build_improve_characters_prompt(characters, story)
+            resp = self.model.ask(prompt, temperature=0.8)
+            return resp
+        except Exception as e:
+            print(f"Error al mejorar los personajes: {e}")
+            time.sleep(5)
+        return self.impove_characters(characters, story)
+    
+
+    def impove_locations(self, locations :List[Location], story: str)-> str:
+        try:
+            prompt = self._build_improve_locations_prompt(locations, story)
+            resp = self.model.ask(prompt, temperature=0.8)
+            return resp
+        except Exception as e:
+            print(f"Error al mejorar los ubicaciones: {e}")
+            time.sleep(5)
+        return self.impove_locations(locations, story)
+    
+
+    def impove_items(self, items :List[Item], story: str)-> str:
+        try:
+            prompt = self._build_improve_items_prompt(items, story)
+            resp = self.model.ask(prompt, temperature=0.8)
+            return resp
+        except Exception as e:
+            print(f"Error al mejorar los items: {e}")
+            time.sleep(5)
+        return self.impove_items(items, story)
+    
+
+    def improve_world(self, characters: List[Character], locations: List[Location], items: List[Item], story: str) -> Tuple[str, str, str]:
+        """
+        Mejora personajes, ubicaciones e items enviando las tres peticiones en paralelo,
+        ya que no dependen entre sí.
+        
+        Returns:
+            Tupla con las respuestas crudas (personajes, ubicaciones, items)
+        """
+        prompts = [
+            self._build_improve_characters_prompt(characters, story),
+            self._build_improve_locations_prompt(locations, story),
+            self._build_improve_items_prompt(items, story),
+        ]
+        responses = self.model.ask_many(prompts, return_exceptions=True, temperature=0.8)
+
+        # Si alguna petición falla se reintenta por la vía secuencial, que reintenta hasta obtener respuesta
+        fallbacks = [
+            lambda: self.impove_characters(characters, story),
+            lambda: self.impove_locations(locations, story),
+            lambda: self.impove_items(items, story),
+        ]
+        results = []
+        for response, fallback in zip(responses, fallbacks):
+            if isinstance(response, BaseException) or not response:
+                print(f"Error al mejorar el mundo de la historia: {response}")
+                response = fallback()
+            results.append(response)
+        return tuple(results)
+
+    def _build_improve_characters_prompt(self, characters :List[Character], story: str) -> str:
+        return f"""
                 Let's enrich the world of the story by bringing the characters to life!
                 Generates:
                 {{
@@ -29,17 +91,9 @@ class DramaManager:
                 Story to analize:
                 {story}
             """
-            resp = self.model.ask(prompt, temperature=0.8)
-            return resp
-        except Exception as e:
-            print(f"Error al mejorar los personajes: {e}")
-            time.sleep(5)
-        return self.impove_characters(characters, story)
-    
 
-    def impove_locations(self, locations :List[Location], story: str)-> str:
-        try:
-            prompt = f"""
+    def _build_improve_locations_prompt(self, locations :List[Location], story: str) -> str:
+        return f"""
                 Let's enrich the world of history by defining the scenarios!
                 Generates:
                 {{
@@ -54,17 +108,9 @@ class DramaManager:
                 Story to analize:
                 {story}
             """
-            resp = self.model.ask(prompt, temperature=0.8)
-            return resp
-        except Exception as e:
-            print(f"Error al mejorar los ubicaciones: {e}")
-            time.sleep(5)
-        return self.impove_locations(locations, story)
-    
 
-    def impove_items(self, items :List[Item], story: str)-> str:
-        try:
-            prompt = f"""
+    def _build_improve_items_prompt(self, items :List[Item], story: str) -> str:
+        return f"""
                 Let's enrich the world of history by better defining the important objects in it!
                 Generates:
                 {{
@@ -79,12 +125,6 @@ class DramaManager:
                 Story to analize:
                 {story}
             """
-            resp = self.model.ask(prompt, temperature=0.8)
-            return resp
-        except Exception as e:
-            print(f"Error al mejorar los items: {e}")
-            time.sleep(5)
-        return self.impove_items(items, story)
     
 
     def simulate_character(self, character: Character, events: List[Event]) -> Character:
@@ -102,7 +142,11 @@ class DramaManager:
             print("No hay eventos para simular.")
             return character
         
-        str_character = character.to_dict()
+        # El personaje es igual en todos los prompts: va en el prefijo, que el proveedor puede cachear
+        prefix = f"""
+            You act as a character whose personality and traits are defined as follows:
+            {character.to_dict()}
+            """
         
         for i in range(len(events)):
             event = events[i]
@@ -116,8 +160,7 @@ class DramaManager:
                 motivations: (str) motivaciones del personaje en este evento
                 goals: (str) metas del personaje en este evento
             }}
-            in valid JSON format, according to how would you act if your personality and traits are defined as follows:
-            {str_character}
+            in valid JSON format, according to how would you act in the following event, being consistent with your personality and traits.
             The event is:
             {event.to_dict()}
             """
@@ -127,7 +170,7 @@ class DramaManager:
                 prompt += f"\nYour last goals were: {', '.join(g_deque)}"
             
             try:
-                response = self.model.ask(prompt)
+                response = self.model.ask(prompt, prefix=prefix)
                 if response:
                     d = self.model.clean_answer(response)
                     character.actions[event.title] = d.get("actions", "")
@@ -145,15 +188,189 @@ class DramaManager:
         return character
     
 
-    def simulate_event(self, event: Event, characters : List[Character]) -> List[Character]:
+    def simulate_event(self,
+                       event: Event,
+                       characters : List[Character],
+                       prefix: Optional[str] = None,
+                       cast_in_prefix: bool = False) -> List[Character]:
         """
         Simula las acciones de los personajes en base al evento dado.
         
         Args:
             characters: Lista de la clase Character que representa los personajes involucrados en el evento
             event: Evento que se simulará 
+            prefix: Prefijo común de los prompts de simulación (ver _simulation_prefix); por
+                defecto el de los personajes del evento
+            cast_in_prefix: Si el prefijo ya describe a los personajes
             
         """
+        if prefix is None:
+            prefix, cast_in_prefix = self._simulation_prefix(characters)
+        prompt = self._build_event_simulation_prompt(event, characters, cast_in_prefix)
+        print(f"Simulando el evento: {event.title}")
+        try:
+            resp = self.model.ask(prompt, prefix=prefix)
+            # print("respuesta obtenida")
+            if resp:
+                d = self.model.clean_answer(resp)
+                self._apply_event_simulation(event, characters, d)
+
+        except Exception as e:
+            print(f"Error al simular el evento: {e}")
+            return ""
+        
+        return characters
+
+    def simulate_events(self,
+                        events: List[Event],
+                        characters: Dict[str, Character],
+                        graph: Optional[nx.MultiDiGraph] = None,
+                        events_per_prompt: int = 1) -> Dict[str, Character]:
+        """
+        Simula todos los eventos de la historia agrupándolos en lotes independientes que
+        se ejecutan en paralelo (ver schedule_simulation).
+        
+        Args:
+            events: Eventos en el orden de la historia
+            characters: Diccionario nombre -> personaje
+            graph: Grafo de eventos con las relaciones 'prerequisite' y 'causal'
+            events_per_prompt: Si es mayor que 1, se empaquetan varios eventos del mismo lote en un
+                único prompt; debe ser al menos 1
+            
+        Returns:
+            El diccionario de personajes actualizado
+        """
+        if events_per_prompt < 1:
+            raise ValueError(f"events_per_prompt debe ser al menos 1, no {events_per_prompt}")
+        # Todos los prompts comparten el prefijo, que no cambia al simular
+        prefix, cast_in_prefix = self._simulation_prefix(list(characters.values()))
+        try:
+            self._simulate_batches(events, characters, graph, events_per_prompt, prefix, cast_in_prefix)
+        finally:
+            self.model.release_prefix(prefix)
+        return characters
+
+    def _simulate_batches(self,
+                          events: List[Event],
+                          characters: Dict[str, Character],
+                          graph: Optional[nx.MultiDiGraph],
+                          events_per_prompt: int,
+                          prefix: str,
+                          cast_in_prefix: bool) -> None:
+        """Simula los lotes de schedule_simulation, cada uno en paralelo"""
+        for batch in self.schedule_simulation(events, graph):
+            involved = {event.title: [character for name, character in characters.items() if name in event.characters_involved]
+                        for event in batch}
+            print(f"Simulando en paralelo los eventos: {[event.title for event in batch]}")
+
+            packs = [batch[i:i + events_per_prompt] for i in range(0, len(batch), events_per_prompt)]
+            prompts = [
+                self._build_event_simulation_prompt(pack[0], involved[pack[0].title], cast_in_prefix) if len(pack) == 1
+                else self._build_multi_event_simulation_prompt(pack, involved, cast_in_prefix)
+                for pack in packs
+            ]
+            responses = self.model.ask_many(prompts, return_exceptions=True, prefix=prefix)
+
+            for pack, resp in zip(packs, responses):
+                if isinstance(resp, BaseException) or not resp:
+                    print(f"Error al simular el lote de eventos, se simulan por separado: {resp}")
+                    for event in pack:
+                        self.simulate_event(event, involved[event.title], prefix, cast_in_prefix)
+                    continue
+
+                d = self.model.clean_answer(resp)
+                if len(pack) == 1:
+                    self._apply_event_simulation(pack[0], involved[pack[0].title], d)
+                    continue
+
+                events_data = d.get("events", {}) if isinstance(d, dict) else {}
+                for event in pack:
+                    if event.title in events_data:
+                        self._apply_event_simulation(event, involved[event.title], events_data[event.title])
+                    else:
+                        # El modelo omitió el evento en la respuesta conjunta
+                        self.simulate_event(event, involved[event.title], prefix, cast_in_prefix)
+
+    def schedule_simulation(self, events: List[Event], graph: Optional[nx.MultiDiGraph] = None) -> List[List[Event]]:
+        """
+        Agrupa los eventos en lotes que se pueden simular a la vez.
+        
+        Un evento depende de otro anterior si comparten algún personaje (la simulación usa
+        las últimas acciones de cada personaje) o si hay una relación 'prerequisite' o
+        'causal' entre ellos en el grafo. Las dependencias siempre van del evento que
+        aparece antes en la historia al que aparece después, así que forman un DAG; cada
+        evento se coloca en el primer lote posterior a todas sus dependencias.
+        
+        Returns:
+            Lista de lotes en orden de ejecución; los eventos de un mismo lote no comparten personajes
+        """
+        position = {event.title: i for i, event in enumerate(events)}
+        dependencies = [set() for _ in events]
+
+        last_event_of_character: Dict[str, int] = {}
+        for i, event in enumerate(events):
+            for name in event.characters_involved:
+                if name in last_event_of_character:
+                    dependencies[i].add(last_event_of_character[name])
+                last_event_of_character[name] = i
+
+        if graph is not None:
+            for u, v, data in graph.edges(data=True):
+                if data.get("relation") in ("prerequisite", "causal") and u in position and v in position and u != v:
+                    first, second = sorted((position[u], position[v]))
+                    dependencies[second].add(first)
+
+        level = [0] * len(events)
+        for i in range(len(events)):
+            if dependencies[i]:
+                level[i] = 1 + max(level[j] for j in dependencies[i])
+
+        batches: List[List[Event]] = [[] for _ in range(max(level, default=-1) + 1)]
+        for i, event in enumerate(events):
+            batches[level[i]].append(event)
+        return batches
+
+    def _simulation_prefix(self, characters: List[Character]) -> Tuple[str, bool]:
+        """
+        Prefijo estable de los prompts de simulación y si incluye la descripción de los
+        personajes. Todo el reparto solo va en el prefijo si el proveedor lo sirve desde una
+        caché explícita; si no, el prefijo es solo la tarea y cada prompt describe a los
+        personajes de su evento.
+        """
+        task = "You simulate the characters of a story event by event. Each character acts consistently with their personality and traits"
+        with_cast = f"""
+            {task}, defined as follows:
+            {[character.to_dict() for character in characters]}
+            """
+        if self.model.caches_prefix(with_cast):
+            return with_cast, True
+        return f"""
+            {task}, described in each prompt.
+            """, False
+
+    def _describe_characters_for_simulation(self, characters: List[Character], cast_in_prefix: bool = False) -> str:
+        """Personajes y su comportamiento reciente (si cast_in_prefix, su descripción está en el prefijo)"""
+        description = ""
+        for character in characters:
+            last_three_actions = deque(character.actions.items(), maxlen=3)
+            last_three_dict_actions = dict(last_three_actions) 
+
+            last_three_motivations = deque(character.motivations.items(), maxlen=3)
+            last_three_dict_motivations = dict(last_three_motivations) 
+
+            last_three_goals = deque(character.goals.items(), maxlen=3)
+            last_three_dict_goals = dict(last_three_goals) 
+
+            identity = f"Character: {character.name}" if cast_in_prefix else character.to_dict()
+            description += f"""
+                {identity}
+                Last three actions: {last_three_dict_actions}
+                Last three motivations: {last_three_dict_motivations}
+                Last three goals: {last_three_dict_goals}
+                """
+        return description
+
+    def _build_event_simulation_prompt(self, event: Event, characters: List[Character], cast_in_prefix: bool = False) -> str:
         prompt = f"""
             Generate :
             {{characters:{{[
@@ -167,46 +384,51 @@ class DramaManager:
             in valid JSON format, depending on how each of the characters would act, being consistent with their personality in the given event.
             The event is:
             {event.to_dict()}
-            The characters are described as:
+            The characters of the event are:
         """
-        print(f"Simulando el evento: {event.title}")
-        for character in characters:
-            last_three_actions = deque(character.actions.items(), maxlen=3)
-            last_three_dict_actions = dict(last_three_actions) 
-
-            last_three_motivations = deque(character.motivations.items(), maxlen=3)
-            last_three_dict_motivations = dict(last_three_motivations) 
-
-            last_three_goals = deque(character.goals.items(), maxlen=3)
-            last_three_dict_goals = dict(last_three_goals) 
+        return prompt + self._describe_characters_for_simulation(characters, cast_in_prefix)
 
+    def _build_multi_event_simulation_prompt(self,
+                                             events: List[Event],
+                                             involved: Dict[str, List[Character]],
+                                             cast_in_prefix: bool = False) -> str:
+        prompt = """
+            Generate :
+            {events:{
+                event_title (str título exacto del evento) : {
+                    characters:{[
+                        character_name (str nombre del personaje) : {
+                            actions: (str) descripción de las acciones que el personaje realiza en este evento
+                            motivations: (str) motivaciones del personaje en este evento
+                            goals: (str) metas del personaje en este evento
+                        },]
+                    }
+                },
+            }
+            }
+            in valid JSON format, simulating each of the following events independently, depending on how each of its characters would act, being consistent with their personality in the given event.
+        """
+        for event in events:
             prompt += f"""
-                {character.to_dict()}
-                Last three actions: {last_three_dict_actions}
-                Last three motivations: {last_three_dict_motivations}
-                Last three goals: {last_three_dict_goals}
-                """
-        try:
-            resp = self.model.ask(prompt)
-            # print("respuesta obtenida")
-            if resp:
-                d = self.model.clean_answer(resp)
-                for character in characters:
-                    if character.name in d.get("characters", {}):
-                        char_data = d["characters"][character.name]
-                        character.actions[event.title] = char_data.get("actions", "")
-                        character.motivations[event.title] = char_data.get("motivations", "")
-                        character.goals[event.title] = char_data.get("goals", "")
-                        # print(f"Simulación para {character.name} en el evento {event.title} completada.")
-                        # print(f"Acciones: {character.actions[event.title]}")
-                        # print(f"Motivaciones: {character.motivations[event.title]}")
-                        # print(f"Metas: {character.goals[event.title]}")
+            The event is:
+            {event.to_dict()}
+            The characters of this event are:
+            """
+            prompt += self._describe_characters_for_simulation(involved[event.title], cast_in_prefix)
+        return prompt
 
-        except Exception as e:
-            print(f"Error al simular el evento: {e}")
-            return ""
-        
-        return characters
+    def _apply_event_simulation(self, event: Event, characters: List[Character], d: Dict) -> None:
+        """Guarda en cada personaje las acciones, motivaciones y metas simuladas para el evento"""
+        for character in characters:
+            if character.name in d.get("characters", {}):
+                char_data = d["characters"][character.name]
+                character.actions[event.title] = char_data.get("actions", "")
+                character.motivations[event.title] = char_data.get("motivations", "")
+                character.goals[event.title] = char_data.get("goals", "")
+                # print(f"Simulación para {character.name} en el evento {event.title} completada.")
+                # print(f"Acciones: {character.actions[event.title]}")
+                # print(f"Motivaciones: {character.motivations[event.title]}")
+                # print(f"Metas: {character.goals[event.title]}")
     
 
     def check_character_actions(self, character: Character):
@@ -252,8 +474,7 @@ class DramaManager:
         prompt += f"{actions_summary}"
         
         try:
-            resp = self.model.ask(prompt, temperature=0.7)
-            response = self.model.clean_answer(resp)
+            response = self.model.ask_json(prompt, temperature=0.7)
             if response:
                 suggested_changes = response.get("suggested changes", [])
                 suggested_events = response.get("suggested events", [])
@@ -314,8 +535,7 @@ class DramaManager:
         """
         
         try:
-            response = self.model.ask(prompt, temperature=0.8)
-            significant_events = self.model.clean_answer(response)
+            significant_events = self.model.ask_json(prompt, temperature=0.8)
             significant_events = significant_events.get("significant_events", [])
             return [Event(**event) for event in significant_events]
         except Exception as e:
@@ -354,8 +574,7 @@ class DramaManager:
         """
         
         try:
-            response = self.model.ask(prompt)
-            enriched_events = self.model.clean_answer(response)
+            enriched_events = self.model.ask_json(prompt)
             enriched_events = enriched_events.get("enriched_events", [])
             dict_enriched_events = {e["title"]: e["description"] for e in enriched_events}
             for event in events:
@@ -0,0 +1,91 @@
+import datetime
+import json
+import os
+import pickle
+import shutil
+import uuid
+from typing import Any, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+class CheckpointStore:
+    def __init__(self, directory: str = "checkpoints"):
+        """
+        Guarda en disco el estado de PlotMind al terminar cada etapa del pipeline para
+        poder reanudar una ejecución sin repetir las llamadas al modelo ya hechas.
+
+        Cada ejecución tiene su carpeta con un manifest.json (descripción inicial y etapas
+        completadas) y un fichero pickle por etapa.
+
+        Args:
+            directory: Carpeta raíz de los checkpoints
+        """
+        self.directory = directory
+
+    @classmethod
+    def from_env(cls) -> Optional["CheckpointStore"]:
+        """Crea el almacén en PLOTMIND_CHECKPOINT_DIR si está definida; si no, devuelve None"""
+        directory = os.getenv("PLOTMIND_CHECKPOINT_DIR")
+        return cls(directory) if directory else None
+
+    def new_run(self, inicial_description: str) -> str:
+        """Registra una ejecución nueva y devuelve su identificador"""
+        run_id = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]
+        os.makedirs(self._run_dir(run_id), exist_ok=True)
+        self._write_manifest(run_id, {
+            "inicial_description": inicial_description,
+            "created": datetime.datetime.now().isoformat(),
+            "completed_stages": [],
+        })
+        return run_id
+
+    def save(self, run_id: str, stage: str, state: Dict[str, Any]) -> None:
+        """Guarda el estado tras completar una etapa (escritura atómica)"""
+        path = self._stage_path(run_id, stage)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+        manifest = self.manifest(run_id)
+        if stage not in manifest["completed_stages"]:
+            manifest["completed_stages"].append(stage)
+        self._write_manifest(run_id, manifest)
+
+    def load(self, run_id: str, stage: str) -> Dict[str, Any]:
+        """Carga el estado guardado al terminar una etapa"""
+        with open(self._stage_path(run_id, stage), "rb") as file:
+            return pickle.load(file)
+
+    def manifest(self, run_id: str) -> Dict[str, Any]:
+        with open(os.path.join(self._run_dir(run_id), "manifest.json"), encoding="utf-8") as file:
+            return json.load(file)
+
+    def completed_stages(self, run_id: str) -> List[str]:
+        return self.manifest(run_id)["completed_stages"]
+
+    def runs(self) -> List[str]:
+        """Identificadores de las ejecuciones guardadas, de la más antigua a la más reciente"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory)
+                      if os.path.isfile(os.path.join(self.directory, name, "manifest.json")))
+
+    def delete(self, run_id: str) -> None:
+        shutil.rmtree(self._run_dir(run_id), ignore_errors=True)
+
+    def _run_dir(self, run_id: str) -> str:
+        return os.path.join(self.directory, run_id)
+
+    def _stage_path(self, run_id: str, stage: str) -> str:
+        return os.path.join(self._run_dir(run_id), f"{stage}.pkl")
+
+    def _write_manifest(self, run_id: str, manifest: Dict[str, Any]) -> None:
+        path = os.path.join(self._run_dir(run_id), "manifest.json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(manifest, file, indent=2, ensure_ascii=False)
+        os.replace(tmp_path, path)
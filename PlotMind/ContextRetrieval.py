@@ -12,104 +12,441 @@
 # print(f"all-mpnet-base-v2: {embeddings_mpnet.shape}")  # (768,)
 # print(f"e5-large-v2: {embeddings_e5.shape}")           # (1024,)
 
+from collections import OrderedDict
+import hashlib
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from typing import List, Dict, Union, Optional
+from typing import Any, Hashable, List, Dict, Tuple, Union, Optional
 import faiss
-from functools import lru_cache
-from sklearn.cluster import DBSCAN
 
+from PlotMind import IndexPersistence
+from PlotMind.EventStore import EventStore
+from PlotMind.MetadataIndex import MetadataIndex, matches
+from PlotMind.SubplotClustering import SubplotClustering
+from PlotMind.IndexFactory import IndexConfig, build_index, create_index, flat_vectors, index_type_of, resolve_index_type, search_parameters, set_search_params
+from PlotMind.EmbeddingModels import DEFAULT_EMBEDDING_BACKEND, DEFAULT_EMBEDDING_MODEL, get_embedding_model, get_profile
 from StorySpace.Event import Event
 
+class _LRUCache:
+    """Caché LRU acotada con contadores de aciertos y fallos"""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self.data: "OrderedDict[Hashable, Any]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        if key in self.data:
+            self.data.move_to_end(key)
+            self.hits += 1
+            return self.data[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: Hashable, value: Any) -> None:
+        self.data[key] = value
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def clear(self) -> None:
+        self.data.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+def cluster_statistics(embeddings: np.ndarray, labels: np.ndarray) -> Dict[int, Dict]:
+    """
+    Estadísticas de cada cluster (sin el ruido, -1) calculadas con operaciones matriciales
+    sobre el bloque de embeddings del cluster, en O(n·d) en lugar de comparar cada par.
+    
+    Args:
+        embeddings: Matriz (n, d) de embeddings
+        labels: Cluster de cada fila
+        
+    Returns:
+        Por cluster: índices de sus filas, tamaño, similitud media entre pares distintos
+        (media de E·Eᵀ fuera de la diagonal), centroide, radio (distancia máxima al centroide),
+        distancia media al centroide y fila representativa (la más cercana al centroide)
+    """
+    labels = np.asarray(labels)
+    statistics = {}
+    for label in np.unique(labels):
+        if label == -1:
+            continue
+        indices = np.flatnonzero(labels == label)
+        block = np.asarray(embeddings[indices], dtype='float32')
+        n = len(indices)
+
+        # sum_{i != j} e_i·e_j = ||sum e_i||² - sum ||e_i||²
+        total = block.sum(axis=0)
+        squared_norms = np.einsum('ij,ij->i', block, block)
+        avg_similarity = (float(total @ total) - float(squared_norms.sum())) / (n * (n - 1)) if n > 1 else 1.0
+
+        centroid = total / n
+        distances = np.sqrt(np.maximum(squared_norms - 2 * block @ centroid + centroid @ centroid, 0.0))
+        statistics[int(label)] = {
+            'indices': indices,
+            'size': n,
+            'avg_similarity': avg_similarity,
+            'centroid': centroid,
+            'radius': float(distances.max()),
+            'mean_radius': float(distances.mean()),
+            'representative': int(indices[np.argmin(distances)]),
+        }
+    return statistics
+
+
+def event_metadata(event: Event) -> Dict:
+    """Metadatos que se guardan de cada evento: to_dict y los campos por los que se puede filtrar"""
+    return {
+        **event.to_dict(),
+        "locations": event.locations,
+        "characters_involved": event.characters_involved,
+        "items_involved": event.items_involved,
+        "narrative_part": event.narrative_part,
+        "plot_part": event.plot_part,
+        "is_mandatory": event.is_mandatory,
+    }
+
+
 class ContextRetrieval:
     def __init__(self, 
-                 model_name: str = 'intfloat/e5-large-v2',
-                 faiss_index_size: int = 1024,
-                 cache_size: int = 1000):
+                 model_name: str = DEFAULT_EMBEDDING_MODEL,
+                 faiss_index_size: Optional[int] = None,
+                 cache_size: int = 1000,
+                 index_config: Optional[IndexConfig] = None,
+                 embedding_dtype: str = "float32",
+                 clustering: Optional[SubplotClustering] = None,
+                 brute_force_threshold: int = 4096,
+                 backend: str = DEFAULT_EMBEDDING_BACKEND,
+                 compact_ratio: float = 0.25):
         """
         Inicializa el sistema de recuperación de contexto con embeddings.
         
         Args:
-            model_name: Nombre del modelo de embeddings
-            faiss_index_size: Dimensión de los embeddings
-            cache_size: Tamaño máximo de la caché LRU
+            model_name: Alias o nombre del modelo de embeddings (se comparte entre instancias, ver
+                EmbeddingModels); su perfil fija la dimensión, los prefijos y la normalización
+            faiss_index_size: Dimensión de los embeddings (None: la del perfil del modelo)
+            cache_size: Tamaño máximo de las cachés LRU de embeddings de consultas y de resultados
+            index_config: Tipo de índice FAISS y sus parámetros (por defecto flat, ver IndexFactory)
+            embedding_dtype: Tipo de la copia de los embeddings que se guarda cuando el índice
+                no conserva los vectores (IVF/PQ): "float32" o "float16"
+            clustering: Motor de clustering de subtramas (por defecto DBSCAN sobre FAISS)
+            brute_force_threshold: En búsquedas filtradas, número de candidatos hasta el que se
+                calcula la similitud directamente en lugar de buscar en FAISS con un IDSelector
+            backend: Backend de inferencia del modelo (ver EMBEDDING_BACKENDS)
+            compact_ratio: Fracción de eventos borrados o sustituidos a partir de la que el
+                índice se compacta (ver compact)
         """
         
-        self.model = SentenceTransformer(model_name)
-        self.model.max_seq_length = 512  
+        self.profile = get_profile(model_name)
+        self.model_name = self.profile.model_name
+        self.model = get_embedding_model(model_name, backend=backend)
+        if faiss_index_size is None:
+            faiss_index_size = self.profile.dimension
+        elif faiss_index_size != self.profile.dimension:
+            raise ValueError(f"El modelo {self.model_name} genera embeddings de dimensión {self.profile.dimension}, no {faiss_index_size}")
         
         # Configurar FAISS
-        self.index = faiss.IndexFlatIP(faiss_index_size)  
-        self.faiss_id_to_event = {}
+        self.index_config = index_config or IndexConfig()
+        self.index = create_index(faiss_index_size, self.index_config)
+        # True si el índice se cargó proyectado en memoria (solo lectura, ver load_index)
+        self.index_mmapped = False
+        # Textos y metadatos de los eventos por id de FAISS (y embeddings si el índice no los guarda)
+        self.event_store = EventStore(faiss_index_size, embedding_dtype)
         self.current_id = 0
+        # Índice invertido de los metadatos para el filtrado previo (se completa al filtrar)
+        self.metadata_index = MetadataIndex()
+        self.brute_force_threshold = brute_force_threshold
+        # Id vigente y hash del contenido de cada evento por título (se completa al actualizar)
+        # e ids de las versiones borradas o sustituidas, que se excluyen de las búsquedas
+        self.title_to_id: Dict[str, int] = {}
+        self.content_hashes: Dict[str, str] = {}
+        self._titles_size = 0
+        self.deleted_ids: set = set()
+        self.compact_ratio = compact_ratio
         
         # Metadatos y caché
         # self.metadata: Dict[int, Dict] = {}
-        self.cache = lru_cache(maxsize=cache_size)
+        # Los embeddings de las consultas no dependen del índice; los resultados sí, por eso su
+        # clave incluye index_version, que cambia cada vez que se modifica el índice
+        self.index_version = 0
+        self.query_embedding_cache = _LRUCache(cache_size)
+        self.result_cache = _LRUCache(cache_size)
+        
+        # Clustering de subtramas; cluster_labels tiene el cluster de cada evento ya agrupado
+        self.clustering = clustering or SubplotClustering()
+        self.cluster_labels: Optional[np.ndarray] = None
         
         # Normalizar embeddings para cosine similarity
-        self.do_normalize = True if "e5" in model_name else False
+        self.do_normalize = self.profile.normalize
     
     def add_events(self, events: List[Event]) -> None:
         """
-        Añade eventos con metadatos opcionales.
+        Añade eventos con metadatos opcionales. Los eventos se identifican por su título: si
+        ya hay uno con el mismo título se sustituye (ver upsert_events).
         
         Args:
             events: Lista de strings con los eventos
             metadata_list: Lista de diccionarios con metadatos
         """
+        self.upsert_events(events)
+
+    def upsert_events(self, events: List[Event]) -> Dict[str, int]:
+        """
+        Añade o actualiza eventos por título. Solo se calculan embeddings de los eventos nuevos
+        o cuya descripción ha cambiado (según un hash del contenido); si solo cambian los
+        metadatos se reutiliza el vector ya indexado.
+        
+        La versión anterior de un evento actualizado no se borra del índice (HNSW no admite
+        borrados y los ids son las filas del EventStore): se marca como borrada, se excluye de
+        las búsquedas y se elimina al compactar.
+        
+        Args:
+            events: Eventos a añadir o actualizar (si se repite un título vale el último)
+            
+        Returns:
+            Número de eventos añadidos, actualizados, sin cambios y cuyo embedding se ha recalculado
+        """
+        stats = {"added": 0, "updated": 0, "unchanged": 0, "embedded": 0}
         try:
             if not events:
-                return
-                
-            processed_events = [f"passage: {event.description}" for event in events]
+                return stats
+            self._update_title_index()
             
-            # Generación de embeddings
-            embeddings = self.model.encode(processed_events, 
-                                        convert_to_tensor=False,
-                                        normalize_embeddings=self.do_normalize)
+            changed: List[Tuple[Event, Dict, Optional[int], str]] = []
+            for event in {event.title: event for event in events}.values():
+                metadata = event_metadata(event)
+                content_hash = self._content_hash(event.description)
+                previous = self.title_to_id.get(event.title)
+                if previous is not None and self.content_hashes[event.title] == content_hash \
+                        and self.event_store.metadata(previous) == metadata:
+                    stats["unchanged"] += 1
+                    continue
+                stats["added" if previous is None else "updated"] += 1
+                changed.append((event, metadata, previous, content_hash))
+            if not changed:
+                return stats
             
-            # Conversión y validación de embeddings
-            embeddings = np.array(embeddings).astype('float32')
-            if len(embeddings.shape) != 2:
-                raise ValueError("Embeddings debe ser matriz 2D")
+            # Generación de embeddings (solo de los textos que han cambiado)
+            to_embed = [i for i, (event, _, previous, content_hash) in enumerate(changed)
+                        if previous is None or self.content_hashes[event.title] != content_hash]
+            embeddings = np.empty((len(changed), self.index.d), dtype='float32')
+            if to_embed:
+                processed_events = self.profile.passages(changed[i][0].description for i in to_embed)
+                encoded = self.model.encode(processed_events, 
+                                            convert_to_tensor=False,
+                                            normalize_embeddings=self.do_normalize)
                 
+                # Conversión y validación de embeddings
+                encoded = np.array(encoded).astype('float32')
+                if len(encoded.shape) != 2:
+                    raise ValueError("Embeddings debe ser matriz 2D")
+                embeddings[to_embed] = encoded
+                stats["embedded"] = len(to_embed)
+            reused = sorted(set(range(len(changed))) - set(to_embed))
+            if reused:
+                # Copia: la vista de los vectores del índice deja de ser válida al añadir
+                embeddings[reused] = self._embedding_matrix()[[changed[i][2] for i in reused]]
+            
             # Añadir a FAISS
-            start_id = self.current_id
-            self.index.add(embeddings)
+            self._add_to_index(embeddings)
             
             # Almacenar metadatos
-            for i in range(len(events)):
-                self.faiss_id_to_event[start_id + i] = {
-                    "text": events[i].description,
-                    "embedding": embeddings[i],
-                    "metadata": events[i].to_dict()
-                }
+            self.event_store.append([event.description for event, _, _, _ in changed], [metadata for _, metadata, _, _ in changed])
+            self._delete_ids([previous for _, _, previous, _ in changed if previous is not None])
+            for offset, (event, _, _, content_hash) in enumerate(changed):
+                self.title_to_id[event.title] = self.current_id + offset
+                self.content_hashes[event.title] = content_hash
                 
-            self.current_id += len(events)
+            self.current_id += len(changed)
+            self._titles_size = self.current_id
+            self._index_changed()
+            self._maybe_compact()
+            return stats
             
         except Exception as e:
             print(f"Error añadiendo eventos: {str(e)}")
             raise
-    
+
+    def delete_events(self, titles: List[str]) -> int:
+        """Borra eventos por título y devuelve cuántos había"""
+        self._update_title_index()
+        ids = [self.title_to_id.pop(title) for title in titles if title in self.title_to_id]
+        for title in titles:
+            self.content_hashes.pop(title, None)
+        if ids:
+            self._delete_ids(ids)
+            self._index_changed()
+            self._maybe_compact()
+        return len(ids)
+
+    def compact(self) -> None:
+        """
+        Reconstruye el índice solo con las versiones vigentes de los eventos, sin recalcular
+        embeddings. Cambia los ids, así que también se reinician el clustering y los índices
+        de títulos y metadatos.
+        """
+        if not self.deleted_ids:
+            return
+        live = np.flatnonzero(self._live_mask())
+        embeddings = np.array(self._embedding_matrix()[live], dtype='float32')
+        event_store = EventStore(self.index.d, self.event_store.dtype)
+        event_store.append([self.event_store.texts[i] for i in live], [self.event_store.metadata(i) for i in live])
+
+        self.index = build_index(embeddings, self.index_config)
+        self.index_mmapped = False
+        if flat_vectors(self.index) is None:
+            event_store.set_embeddings(embeddings)
+        self.event_store = event_store
+        self.current_id = len(live)
+        self.deleted_ids = set()
+        self.title_to_id, self.content_hashes, self._titles_size = {}, {}, 0
+        self.metadata_index.clear()
+        self.cluster_labels = None
+        self._index_changed()
+
+    def _maybe_compact(self) -> None:
+        if self.current_id and len(self.deleted_ids) > self.compact_ratio * self.current_id:
+            self.compact()
+
+    def _delete_ids(self, ids: List[int]) -> None:
+        self.deleted_ids.update(ids)
+        self.metadata_index.remove(ids)
+
+    def _live_mask(self) -> np.ndarray:
+        """True en las filas de los eventos vigentes (no borrados ni sustituidos)"""
+        mask = np.ones(self.current_id, dtype=bool)
+        if self.deleted_ids:
+            mask[list(self.deleted_ids)] = False
+        return mask
+
+    @staticmethod
+    def _content_hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _update_title_index(self) -> None:
+        """Añade al índice de títulos los eventos que aún no están en él (ej: tras load_index)"""
+        for i in range(self._titles_size, self.current_id):
+            if i in self.deleted_ids:
+                continue
+            title = self.event_store.metadata(i).get("title")
+            self.title_to_id[title] = i
+            self.content_hashes[title] = self._content_hash(self.event_store.texts[i])
+        self._titles_size = self.current_id
+
+    def _add_to_index(self, embeddings: np.ndarray) -> None:
+        """
+        Añade embeddings al índice. Si con los nuevos vectores cambia el tipo de índice que
+        corresponde (modo auto, o un IVF que ya tiene datos para entrenarse) se reconstruye
+        con todos los embeddings.
+        
+        Los embeddings se guardan una sola vez: en el propio índice si es flat o HNSW, o en
+        la matriz del EventStore si el índice solo guarda códigos (IVF/PQ).
+        """
+        n_vectors = self.index.ntotal + len(embeddings)
+        previous = None
+        if resolve_index_type(self.index_config, n_vectors) == index_type_of(self.index):
+            if flat_vectors(self.index) is None and not self.event_store.has_embeddings(self.current_id):
+                previous = self._embedding_matrix()
+            if self.index_mmapped:
+                # El índice proyectado es de solo lectura: se copia a memoria antes de modificarlo
+                self.index = faiss.clone_index(self.index)
+                self.index_mmapped = False
+            self.index.add(embeddings)
+        else:
+            previous = self._embedding_matrix()
+            self.index = build_index(np.vstack([previous, embeddings]), self.index_config)
+            self.index_mmapped = False
+            print(f"Índice reconstruido como {index_type_of(self.index)} con {self.index.ntotal} eventos")
+
+        if flat_vectors(self.index) is not None:
+            self.event_store.clear_embeddings()
+        elif previous is not None:
+            self.event_store.set_embeddings(np.vstack([previous, embeddings]))
+        else:
+            self.event_store.append_embeddings(embeddings)
+
+    def _embedding_matrix(self) -> np.ndarray:
+        """
+        Embeddings de todos los eventos indexados, en orden de id. Con un índice flat o HNSW es
+        una vista sin copia de los vectores del índice (válida mientras no se modifique); si no,
+        la matriz del EventStore o, para índices cargados de disco, su reconstrucción.
+        """
+        if self.current_id == 0:
+            return np.zeros((0, self.index.d), dtype='float32')
+        vectors = flat_vectors(self.index)
+        if vectors is not None:
+            return vectors
+        if self.event_store.has_embeddings(self.current_id):
+            return self.event_store.embeddings.astype('float32', copy=False)
+        ivf = faiss.try_extract_index_ivf(self.index)
+        if ivf is not None:
+            ivf.make_direct_map()
+        return self.index.reconstruct_n(0, self.current_id)
+
+    def set_search_params(self, ef_search: Optional[int] = None, nprobe: Optional[int] = None) -> None:
+        """Ajusta el compromiso recall/latencia del índice (efSearch en HNSW, nprobe en IVF)"""
+        if ef_search is not None:
+            self.index_config.ef_search = ef_search
+        if nprobe is not None:
+            self.index_config.nprobe = nprobe
+        set_search_params(self.index, ef_search=ef_search, nprobe=nprobe)
+        self._index_changed()
+
+    def _index_changed(self) -> None:
+        """Invalida los resultados cacheados tras modificar el índice"""
+        self.index_version += 1
+        self.result_cache.clear()
+
+    @staticmethod
+    def _normalize_query(query: Union[str, List[str]]) -> Tuple[str, ...]:
+        """Clave de caché de una consulta: sus textos sin espacios sobrantes"""
+        texts = [query] if isinstance(query, str) else query
+        return tuple(" ".join(text.split()) for text in texts)
+
+    def _encode_queries(self, texts: Tuple[str, ...]) -> np.ndarray:
+        """
+        Embeddings de los textos de consulta, uno por fila. Los que no están en la caché se
+        codifican juntos en un único lote.
+        """
+        embeddings = {text: self.query_embedding_cache.get(text) for text in dict.fromkeys(texts)}
+        missing = [text for text, embedding in embeddings.items() if embedding is None]
+        if missing:
+            # e5 espera el prefijo "query:" en las consultas (y "passage:" en los documentos)
+            processed = self.profile.queries(missing)
+            encoded = np.asarray(self.model.encode(processed,
+                                                   convert_to_tensor=False,
+                                                   normalize_embeddings=self.do_normalize), dtype='float32')
+            for text, embedding in zip(missing, encoded):
+                self.query_embedding_cache.put(text, embedding)
+                embeddings[text] = embedding
+        return np.stack([embeddings[text] for text in texts])
+
     def _query_processing(self, query: Union[str, List[str]]) -> np.ndarray:
-        """Obtiene el embedding para una consulta (puede ser un evento o lista de eventos)"""
-        if "e5" in self.model._get_name():
-            if isinstance(query, list):
-                processed = [f"query: {q}" for q in query]
-            else:
-                processed = [f"query: {query}"]
-
-            return self.model.encode(processed, 
-                              convert_to_tensor=False, 
-                              normalize_embeddings=self.do_normalize)
-        else :
-            if isinstance(query, list):
-                # Promediar los embeddings si es una lista de eventos
-                embeddings = self.model.encode(query, convert_to_tensor=False)
-                return np.mean(embeddings, axis=0)
-            else:
-                return self.model.encode(query, convert_to_tensor=False)
+        """
+        Obtiene el embedding (1, d) para una consulta. Si es una lista de eventos la consulta
+        es el centroide de la ventana: la media de los embeddings de cada evento, normalizada
+        si el modelo normaliza. Los embeddings de cada evento se cachean por separado, así las
+        ventanas de narración que se solapan reutilizan los ya calculados.
+
+        Antes, con los modelos e5 se codificaba una fila por evento pero solo se buscaba con
+        la primera (el resto de la ventana no influía) y con el resto de modelos se usaba la
+        media sin normalizar; ahora todos los eventos de la ventana pesan lo mismo en el
+        orden de los resultados (ver tests/test_context_retrieval.py).
+        """
+        embedding = self._encode_queries(self._normalize_query(query)).mean(axis=0, keepdims=True)
+        if self.do_normalize:
+            embedding /= max(float(np.linalg.norm(embedding)), 1e-12)
+        return embedding.astype('float32')
             
         
     # @lru_cache(maxsize=1000)
@@ -156,42 +493,70 @@ class ContextRetrieval:
         
     #     return sorted(results, key=lambda x: x['similarity'], reverse=True)[:k]
 
-    @lru_cache(maxsize=1000)
     def retrieve_similar_events(self, 
                             query: Union[str, List[str]], 
                             k: int = 5,
                             filter_func: Optional[callable] = None,
-                            exclude_query_events: bool = True) -> List[Dict]:
+                            exclude_query_events: bool = True,
+                            filter_key: Optional[Hashable] = None,
+                            filter_rules: Optional[Dict] = None) -> List[Dict]:
         """
         Encuentra los k eventos más similares a la consulta, excluyendo los eventos de consulta si se especifica.
+        Los resultados se cachean por instancia hasta que cambia el índice.
         
         Args:
             query: Consulta o lista de consultas (texto de eventos a comparar)
             k: Número de resultados a devolver
             filter_func: Función para filtrar por metadatos
             exclude_query_events: Si True, excluye los eventos idénticos a la consulta
+            filter_key: Identifica filter_func en la caché de resultados; si hay filtro sin
+                clave el resultado no se cachea
+            filter_rules: Reglas de filtrado por metadatos; la búsqueda se hace solo entre los
+                eventos que las cumplen (ver _search) y forman parte de la clave de la caché
             
         Returns:
             Lista de resultados con texto, similitud y metadatos (sin incluir consultas si exclude_query_events=True)
         """
+        cacheable = filter_func is None or filter_key is not None
+        rules_func, rules_key = self._build_filter(filter_rules)
+        cache_key = (self.index_version, self._normalize_query(query), k, exclude_query_events, filter_key, rules_key)
+        if cacheable:
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                return list(cached)
+
         # Generar embedding de consulta
         query_embedding = self._query_processing(query)
-        if len(query_embedding.shape) == 1:
-            query_embedding = query_embedding.reshape(1, -1)
         
         # Búsqueda ampliada en FAISS (buscar k + m para compensar exclusiones)
         m = len(query.split('|')) if isinstance(query, str) else len(query)  # Número de eventos en consulta
-        distances, indices = self.index.search(query_embedding, k + m if exclude_query_events else k)
-        
+        distances, indices = self._search(query_embedding, k + m if exclude_query_events else k, filter_rules)
+        if filter_func is not None and rules_func is not None:
+            results_filter = lambda meta: filter_func(meta) and rules_func(meta)
+        else:
+            results_filter = filter_func or rules_func
+        results = self._collect_results(query, distances[0], indices[0], k, results_filter, exclude_query_events)
+        if cacheable:
+            self.result_cache.put(cache_key, results)
+        return list(results)
+
+    def _collect_results(self,
+                         query: Union[str, List[str]],
+                         distances: np.ndarray,
+                         indices: np.ndarray,
+                         k: int,
+                         filter_func: Optional[callable],
+                         exclude_query_events: bool) -> List[Dict]:
+        """Convierte una fila de resultados de FAISS en la lista de eventos similares"""
         # Procesar resultados
         results = []
         query_texts = set([query] if isinstance(query, str) else query)  # Normalizar a conjunto
         
-        for idx, distance in zip(indices[0], distances[0]):
-            if idx < 0:
-                continue  # Índice inválido en FAISS
+        for idx, distance in zip(indices, distances):
+            if idx < 0 or idx in self.deleted_ids:
+                continue  # Índice inválido en FAISS o evento sustituido
                 
-            event_data = self.faiss_id_to_event.get(idx)
+            event_data = self.event_store.get(int(idx))
             if event_data:
                 # Excluir eventos idénticos a la consulta
                 if exclude_query_events and event_data['text'] in query_texts:
@@ -222,90 +587,233 @@ class ContextRetrieval:
             events: Lista de eventos para los que se necesita contexto
             k: Número de eventos contextuales a recuperar
             m: Límite para usar recuperación semántica
-            filter_rules: Diccionario con reglas de filtrado (e.g., {'type': 'conflicto', 'location': 'forest'})
+            filter_rules: Diccionario con reglas de filtrado (e.g., {'locations': 'bosque', 'plot_part': ['nudo', 'clímax']});
+                cada regla se cumple si el campo tiene alguno de los valores (en listas, si los contiene)
         """
-        # Construir función de filtrado
-        filter_func = None
-        if filter_rules:
-            filter_func = lambda meta: all(
-                meta.get(key) == value for key, value in filter_rules.items()
-            )
-        
         # if len(events) <= m:
         #     return [{"text": e} for e in events]
             
-        return self.retrieve_similar_events(tuple(events), k=k, filter_func=filter_func)
+        return self.retrieve_similar_events(tuple(events), k=k, filter_rules=filter_rules)
+
+    def get_context_batch(self,
+                          windows: List[List[str]],
+                          k: int = 5,
+                          filter_rules: Optional[Dict] = None) -> List[List[Dict]]:
+        """
+        Igual que get_context para varias ventanas de eventos a la vez: todos los textos que no
+        están en caché se codifican en un único lote y se hace una sola búsqueda en FAISS con
+        una matriz de consultas.
+        
+        Args:
+            windows: Lista de ventanas (listas de títulos de eventos)
+            k: Número de eventos contextuales a recuperar por ventana
+            filter_rules: Reglas de filtrado, como en get_context
+            
+        Returns:
+            Contexto de cada ventana, en el mismo orden
+        """
+        filter_func, filter_key = self._build_filter(filter_rules)
+        contexts: List[Optional[List[Dict]]] = [None] * len(windows)
+        pending = []
+        for i, window in enumerate(windows):
+            cache_key = (self.index_version, self._normalize_query(window), k, True, None, filter_key)
+            cached = self.result_cache.get(cache_key)
+            if cached is not None:
+                contexts[i] = list(cached)
+            else:
+                pending.append((i, cache_key))
+
+        if pending:
+            queries = [cache_key[1] for _, cache_key in pending]
+            # Un único encode con todos los textos distintos de las ventanas pendientes
+            texts = tuple(dict.fromkeys(text for query in queries for text in query))
+            rows = dict(zip(texts, self._encode_queries(texts)))
+            query_matrix = np.stack([np.mean([rows[text] for text in query], axis=0) for query in queries]).astype('float32')
+            if self.do_normalize:
+                query_matrix /= np.maximum(np.linalg.norm(query_matrix, axis=1, keepdims=True), 1e-12)
+
+            max_m = max(len(query) for query in queries)
+            distances, indices = self._search(query_matrix, k + max_m, filter_rules)
+            for row, (i, cache_key) in enumerate(pending):
+                results = self._collect_results(windows[i], distances[row], indices[row], k, filter_func, True)
+                self.result_cache.put(cache_key, results)
+                contexts[i] = list(results)
+
+        return contexts
+
+    def _search(self, query_matrix: np.ndarray, n_results: int, filter_rules: Optional[Dict] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Búsqueda en FAISS. Si hay reglas de filtrado se calculan antes los eventos candidatos
+        (con el índice invertido para los campos indexados y recorriendo los metadatos de esos
+        candidatos para el resto) y solo se busca entre ellos, de modo que se obtienen n_results
+        resultados (si hay tantos candidatos) en tiempo proporcional al subconjunto: con pocos
+        candidatos se calcula la similitud directamente y con muchos se usa un IDSelector de
+        FAISS. Las versiones borradas o sustituidas de los eventos nunca se devuelven.
+        """
+        if not filter_rules:
+            if not self.deleted_ids:
+                return self.index.search(query_matrix, n_results)
+            deleted = faiss.IDSelectorBatch(np.fromiter(self.deleted_ids, dtype=np.int64))
+            selector = faiss.IDSelectorNot(deleted)
+            return self.index.search(query_matrix, n_results, params=search_parameters(self.index, selector))
+
+        indexed = {key: value for key, value in filter_rules.items() if key in self.metadata_index.postings}
+        others = {key: value for key, value in filter_rules.items() if key not in indexed}
+        if indexed:
+            self._update_metadata_index()
+            ids = self.metadata_index.candidates(indexed)
+        else:
+            ids = np.flatnonzero(self._live_mask()).astype(np.int64)
+        if others and len(ids):
+            ids = ids[np.fromiter((matches(self.event_store.metadata(int(i)), others) for i in ids), dtype=bool, count=len(ids))]
+        distances = np.full((len(query_matrix), n_results), -np.inf, dtype='float32')
+        indices = np.full((len(query_matrix), n_results), -1, dtype=np.int64)
+        if len(ids) == 0:
+            return distances, indices
+
+        if len(ids) <= self.brute_force_threshold:
+            scores = query_matrix @ self._embedding_matrix()[ids].astype('float32', copy=False).T
+            top = np.argsort(-scores, axis=1)[:, :n_results]
+            distances[:, :top.shape[1]] = np.take_along_axis(scores, top, axis=1)
+            indices[:, :top.shape[1]] = ids[top]
+            return distances, indices
+
+        selector = faiss.IDSelectorBatch(ids)
+        return self.index.search(query_matrix, n_results, params=search_parameters(self.index, selector))
+
+    def _update_metadata_index(self) -> None:
+        """Añade al índice invertido los eventos que aún no están en él"""
+        for i in range(self.metadata_index.size, self.current_id):
+            self.metadata_index.add(i, self.event_store.metadata(i))
+
+    def _build_filter(self, filter_rules: Optional[Dict]) -> Tuple[Optional[callable], Optional[Hashable]]:
+        """Construye la función de filtrado de filter_rules y su clave para la caché de resultados"""
+        if not filter_rules:
+            return None, None
+        filter_func = lambda meta: matches(meta, filter_rules)
+        filter_key = tuple(sorted((key, repr(value)) for key, value in filter_rules.items()))
+        return filter_func, filter_key
     
     def save_index(self, filename: str):
-        """Guarda el índice FAISS en disco"""
-        faiss.write_index(self.index, filename)
+        """
+        Guarda el índice FAISS en disco junto con los textos y metadatos de los eventos en un
+        sidecar SQLite (filename + ".meta.sqlite"), de forma atómica (ver IndexPersistence).
+        Antes se compacta, para no guardar versiones sustituidas de los eventos.
+        """
+        self.compact()
+        IndexPersistence.save(
+            self.index, filename,
+            ((i, self.event_store.texts[i], self.event_store.metadata(i)) for i in range(self.current_id)),
+            {"model_name": self.model_name, "dimension": self.index.d, "index_type": index_type_of(self.index)},
+        )
     
-    def load_index(self, filename: str):
-        """Carga un índice FAISS desde disco"""
-        self.index = faiss.read_index(filename)
+    def load_index(self, filename: str, mmap: bool = False):
+        """
+        Carga un índice FAISS desde disco con sus textos y metadatos.
+        
+        Args:
+            filename: Ruta del índice
+            mmap: Si True, los vectores se proyectan en memoria en lugar de leerse enteros
+                (ver IndexPersistence.load_index; se copian a memoria si se añaden eventos)
+        """
+        index = IndexPersistence.load_index(filename, mmap=mmap)
+        if index.d != self.profile.dimension:
+            raise ValueError(f"El índice {filename} tiene dimensión {index.d} y el modelo {self.model_name} {self.profile.dimension}")
+        sidecar = IndexPersistence.load_sidecar(filename)
+        if sidecar is None:
+            print(f"Aviso: {filename} no tiene metadatos ({IndexPersistence.sidecar_path(filename)}), "
+                  "los resultados no se podrán asociar a eventos")
+            event_store = EventStore(index.d, self.event_store.dtype)
+        else:
+            info, rows = sidecar
+            if info.get("ntotal") != index.ntotal or len(rows) != index.ntotal:
+                raise ValueError(f"El índice {filename} ({index.ntotal} vectores) no corresponde con sus metadatos ({len(rows)} eventos)")
+            if info.get("model_name") != self.model_name:
+                print(f"Aviso: el índice se creó con {info.get('model_name')} y se consulta con {self.model_name}")
+            # Los metadatos se decodifican cuando se usan
+            event_store = EventStore(index.d, self.event_store.dtype)
+            event_store.extend_raw(rows)
+
+        self.index = index
+        self.index_mmapped = mmap
+        self.event_store = event_store
+        self.current_id = index.ntotal
+        self.cluster_labels = None
+        self.metadata_index.clear()
+        self.deleted_ids = set()
+        self.title_to_id, self.content_hashes, self._titles_size = {}, {}, 0
+        self._index_changed()
+
+    def cache_stats(self) -> Dict[str, dict]:
+        """Estadísticas de las cachés de embeddings de consultas y de resultados"""
+        return {
+            "query_embeddings": self.query_embedding_cache.stats(),
+            "results": self.result_cache.stats(),
+        }
     
     def __len__(self) -> int:
-        return self.index.ntotal
+        """Eventos vivos del índice (sin las versiones sustituidas o borradas pendientes de compactar)"""
+        return self.index.ntotal - len(self.deleted_ids)
 
 
-    def get_clusters(self, min_samples: int) -> dict:
+    def get_clusters(self, min_samples: int, refit: bool = True) -> dict:
         """
-        Agrupa eventos temáticamente similares usando DBSCAN.
+        Agrupa eventos temáticamente similares (DBSCAN sobre el grafo k-NN de FAISS o k-means,
+        ver SubplotClustering).
         
         Args:
             min_samples: Mínimo número de eventos para formar un cluster.
+            refit: Si False y ya hay un clustering con el mismo min_samples, solo se asignan los
+                eventos añadidos desde entonces, sin volver a agrupar todo el corpus
         
         Returns:
             Dict con:
             - 'labels': Array de clusters asignados (-1 es ruido)
             - 'n_clusters': Número de clusters encontrados
-            - 'avg_distance': Distancia promedio usada como eps
-            - 'cluster_details': Dict con metadatos por cluster
+            - 'avg_distance': Distancia media al vecino más cercano (eps = avg_distance * eps_factor)
+            - 'cluster_details': Dict con metadatos por cluster (ver cluster_statistics), con
+              títulos de ejemplo y el del evento representativo
         """
         try:
             # 1. Obtener embeddings como array numpy
-            all_data = list(self.faiss_id_to_event.values())
-            embeddings = np.array([data['embedding'] for data in all_data]).astype('float32')
+            embeddings = self._embedding_matrix()
             
             if len(embeddings) == 0:
                 return {'labels': [], 'n_clusters': 0, 'avg_distance': 0.0, 'cluster_details': {}}
             
-            # 2. Calcular eps como distancia promedio entre puntos cercanos (más robusto)
-            from sklearn.neighbors import NearestNeighbors
-            neigh = NearestNeighbors(n_neighbors=2)
-            neigh.fit(embeddings)
-            distances, _ = neigh.kneighbors(embeddings)
-            avg_distance = np.mean(distances[:, 1])  # Distancia al vecino más cercano
-            
-            # 3. Aplicar DBSCAN
-            clustering = DBSCAN(
-                eps=avg_distance * 1.5,  # Ajuste heurístico
-                min_samples=min_samples,
-                metric='euclidean'
-            ).fit(embeddings)
+            # 2-3. Agrupar (o asignar solo los eventos nuevos)
+            incremental = (not refit and self.clustering.fitted and self.cluster_labels is not None
+                           and self.clustering.min_samples == min_samples)
+            if incremental:
+                new_labels = self.clustering.assign(embeddings[len(self.cluster_labels):])
+                self.cluster_labels = np.concatenate([self.cluster_labels, new_labels])
+            elif not self.deleted_ids:
+                # El índice solo sirve para el grafo k-NN si sus ids son las filas de embeddings
+                index = self.index if self.index.ntotal == len(embeddings) else None
+                self.cluster_labels = self.clustering.fit(embeddings, min_samples, index=index)
+            else:
+                # Solo se agrupan las versiones vigentes de los eventos
+                live = self._live_mask()
+                self.cluster_labels = np.full(len(embeddings), -1, dtype=np.int64)
+                self.cluster_labels[live] = self.clustering.fit(embeddings[live], min_samples)
+            if self.deleted_ids:
+                self.cluster_labels[~self._live_mask()] = -1
+            avg_distance = self.clustering.avg_distance
             
             # 4. Procesar resultados
-            labels = clustering.labels_
+            labels = self.cluster_labels
             unique_labels = set(labels)
             n_clusters = len(unique_labels) - (1 if -1 in unique_labels else 0)
             
             # 5. Generar metadatos por cluster
             cluster_details = {}
-            for label in unique_labels:
-                if label == -1:
-                    continue
-                    
-                cluster_indices = np.where(labels == label)[0]
-                cluster_events = [all_data[i]['metadata'] for i in cluster_indices]
+            for label, statistics in cluster_statistics(embeddings, labels).items():
+                indices = statistics.pop('indices')
                 
                 cluster_details[label] = {
-                    'size': len(cluster_events),
-                    'sample_titles': [e['title'][:50] + "..." for e in cluster_events[:3]],
-                    'avg_similarity': np.mean([
-                        np.dot(embeddings[i], embeddings[j])
-                        for i in cluster_indices
-                        for j in cluster_indices if i != j
-                    ])
+                    **statistics,
+                    'sample_titles': [self.event_store.metadata(i)['title'][:50] + "..." for i in indices[:3]],
+                    'representative_title': self.event_store.metadata(statistics['representative'])['title'],
                 }
             
             return {
@@ -329,7 +837,7 @@ class ContextRetrieval:
                 
             # Obtener eventos del cluster
             cluster_events = [
-                self.faiss_id_to_event[i]['metadata']
+                self.event_store.metadata(i)
                 for i, l in enumerate(labels) if l == label
             ]
             
@@ -0,0 +1,216 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from dotenv import load_dotenv
+from sentence_transformers import SentenceTransformer
+
+load_dotenv()
+
+
+@dataclass(frozen=True)
+class EmbeddingProfile:
+    """
+    Cómo se usa un modelo de embeddings: su dimensión, los prefijos que espera en consultas
+    y documentos (los e5 se entrenaron con "query: " y "passage: ") y si se normalizan los
+    vectores (similitud coseno con el producto interno de FAISS).
+    """
+    model_name: str
+    dimension: int
+    query_prefix: str = ""
+    passage_prefix: str = ""
+    normalize: bool = True
+    max_seq_length: int = 512
+
+    def queries(self, texts: Iterable[str]) -> List[str]:
+        return [self.query_prefix + text for text in texts]
+
+    def passages(self, texts: Iterable[str]) -> List[str]:
+        return [self.passage_prefix + text for text in texts]
+
+
+# Perfiles conocidos, por alias
+EMBEDDING_PROFILES: Dict[str, EmbeddingProfile] = {
+    "e5-small": EmbeddingProfile("intfloat/e5-small-v2", 384, "query: ", "passage: "),
+    "e5-base": EmbeddingProfile("intfloat/e5-base-v2", 768, "query: ", "passage: "),
+    "e5-large": EmbeddingProfile("intfloat/e5-large-v2", 1024, "query: ", "passage: "),
+    "mpnet": EmbeddingProfile("sentence-transformers/all-mpnet-base-v2", 768, max_seq_length=384),
+}
+
+# torch: modelo tal cual | torch-int8: capas lineales cuantizadas a int8 (solo CPU) |
+# onnx: ONNX Runtime | onnx-int8: ONNX Runtime con el modelo cuantizado a int8 (solo CPU)
+EMBEDDING_BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+DEFAULT_EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "intfloat/e5-large-v2")
+DEFAULT_EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# Carpeta donde se guardan los modelos ONNX cuantizados para no cuantizarlos en cada arranque
+ONNX_CACHE_DIR = os.getenv("EMBEDDING_ONNX_CACHE", ".onnx_cache")
+
+# Modelos cargados en el proceso, compartidos por todas las instancias de ContextRetrieval
+_models: Dict[Tuple[str, Optional[str], str], SentenceTransformer] = {}
+_models_lock = threading.Lock()
+
+
+def get_profile(model_name: str = DEFAULT_EMBEDDING_MODEL) -> EmbeddingProfile:
+    """
+    Perfil de un modelo, por alias (ver EMBEDDING_PROFILES) o por nombre completo. Para un
+    modelo sin perfil la dimensión se lee del propio modelo y los prefijos se deducen del
+    nombre (e5).
+    """
+    if model_name in EMBEDDING_PROFILES:
+        return EMBEDDING_PROFILES[model_name]
+    for profile in EMBEDDING_PROFILES.values():
+        if profile.model_name == model_name:
+            return profile
+    is_e5 = "e5" in model_name
+    # Se carga con el backend por defecto y queda en caché para get_embedding_model
+    with _models_lock:
+        model = _models.get((model_name, None, "torch"))
+        if model is None:
+            model = _models[(model_name, None, "torch")] = SentenceTransformer(model_name)
+            model.max_seq_length = 512
+    profile = EmbeddingProfile(model_name, model.get_sentence_embedding_dimension(),
+                               "query: " if is_e5 else "", "passage: " if is_e5 else "", normalize=is_e5)
+    EMBEDDING_PROFILES[model_name] = profile
+    return profile
+
+
+def get_embedding_model(model_name: str = DEFAULT_EMBEDDING_MODEL,
+                        device: Optional[str] = None,
+                        backend: str = DEFAULT_EMBEDDING_BACKEND) -> SentenceTransformer:
+    """
+    Devuelve el modelo de embeddings compartido del proceso, cargándolo solo la primera
+    vez que se pide. La carga se hace bajo un lock para que varios hilos (ej: los workers
+    de StoryService) no carguen el mismo modelo a la vez.
+
+    Args:
+        model_name: Alias de EMBEDDING_PROFILES o nombre del modelo de sentence-transformers
+        device: Dispositivo donde cargarlo (None para que lo elija sentence-transformers)
+        backend: Uno de EMBEDDING_BACKENDS; los int8 están pensados para workers sin GPU
+    """
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Backend de embeddings desconocido '{backend}', debe ser uno de {EMBEDDING_BACKENDS}")
+    profile = get_profile(model_name)
+    key = (profile.model_name, device, backend)
+    model = _models.get(key)
+    if model is not None:
+        return model
+    with _models_lock:
+        if key not in _models:
+            model = _load(profile.model_name, device, backend)
+            model.max_seq_length = profile.max_seq_length
+            _models[key] = model
+        return _models[key]
+
+
+def _load(model_name: str, device: Optional[str], backend: str) -> SentenceTransformer:
+    if backend == "torch":
+        return SentenceTransformer(model_name, device=device)
+    if backend == "torch-int8":
+        import torch
+        model = SentenceTransformer(model_name, device="cpu")
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == "onnx":
+        return SentenceTransformer(model_name, device=device, backend="onnx")
+
+    # onnx-int8: se exporta a ONNX, se cuantiza una vez y se reutiliza desde ONNX_CACHE_DIR
+    from sentence_transformers import export_dynamic_quantized_onnx_model
+    local_dir = os.path.join(ONNX_CACHE_DIR, model_name.replace("/", "__"))
+    file_name = "onnx/model_qint8_avx2.onnx"
+    if not os.path.exists(os.path.join(local_dir, file_name)):
+        model = SentenceTransformer(model_name, device="cpu", backend="onnx")
+        model.save(local_dir)
+        export_dynamic_quantized_onnx_model(model, "avx2", local_dir)
+    return SentenceTransformer(local_dir, device="cpu", backend="onnx", model_kwargs={"file_name": file_name})
+
+
+def warmup(model_names: Iterable[str] = (DEFAULT_EMBEDDING_MODEL,),
+           device: Optional[str] = None,
+           backend: str = DEFAULT_EMBEDDING_BACKEND) -> None:
+    """
+    Carga los modelos y hace una codificación de prueba para que la primera petición real
+    no pague la carga ni la inicialización perezosa del backend. Pensado para el arranque del bot.
+    """
+    for model_name in model_names:
+        profile = get_profile(model_name)
+        get_embedding_model(model_name, device, backend).encode(profile.queries(["warmup"]), convert_to_tensor=False)
+
+
+def loaded_models() -> List[str]:
+    """Nombres (y backend) de los modelos ya cargados en el proceso"""
+    return [f"{model_name} ({backend})" for model_name, _, backend in _models]
+
+
+def benchmark(passages: List[str],
+              queries: List[str],
+              configs: List[Tuple[str, str]],
+              k: int = 5,
+              device: Optional[str] = None) -> List[Dict]:
+    """
+    Compara modelos y backends codificando los mismos textos. La calidad se mide contra la
+    primera configuración (la de referencia): fracción de sus k documentos más parecidos a
+    cada consulta que recupera también la configuración evaluada.
+
+    Args:
+        passages: Documentos (ej: descripciones de eventos)
+        queries: Consultas
+        configs: Pares (modelo, backend); el primero es la referencia
+        k: Documentos recuperados por consulta
+        device: Dispositivo de los modelos
+
+    Returns:
+        Por configuración: dimensión, tiempo de carga (s), latencia por documento (ms) y
+        solapamiento@k con la referencia
+    """
+    results = []
+    reference = None
+    for model_name, backend in configs:
+        profile = get_profile(model_name)
+        start = time.perf_counter()
+        model = get_embedding_model(model_name, device, backend)
+        load_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        passage_embeddings = np.asarray(model.encode(profile.passages(passages), convert_to_tensor=False,
+                                                     normalize_embeddings=profile.normalize), dtype='float32')
+        encode_time = time.perf_counter() - start
+        query_embeddings = np.asarray(model.encode(profile.queries(queries), convert_to_tensor=False,
+                                                   normalize_embeddings=profile.normalize), dtype='float32')
+
+        top = np.argsort(-(query_embeddings @ passage_embeddings.T), axis=1)[:, :k]
+        if reference is None:
+            reference = top
+        overlap = np.mean([len(set(top[i]) & set(reference[i])) / k for i in range(len(queries))])
+        results.append({
+            "model": profile.model_name,
+            "backend": backend,
+            "dimension": profile.dimension,
+            "load_s": load_time,
+            "ms_per_passage": 1000 * encode_time / max(len(passages), 1),
+            f"overlap@{k}": float(overlap),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    # Benchmark con los párrafos de las historias generadas: documentos y, como consultas,
+    # la primera frase de algunos de ellos
+    with open("stories.txt", encoding="utf-8") as file:
+        paragraphs = [p.strip() for p in file.read().split("\n\n") if len(p.strip()) > 200][:500]
+    sample = paragraphs[::max(1, len(paragraphs) // 50)]
+    first_sentences = [p.split(".")[0] for p in sample]
+
+    for row in benchmark(paragraphs, first_sentences, [
+        ("e5-large", "torch"),
+        ("e5-large", "onnx-int8"),
+        ("e5-base", "torch"),
+        ("e5-base", "onnx-int8"),
+        ("e5-small", "torch"),
+        ("e5-small", "onnx-int8"),
+        ("e5-small", "torch-int8"),
+        ("mpnet", "torch"),
+    ]):
+        print(row)
@@ -0,0 +1,86 @@
+import json
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+
+
+class EventStore:
+    def __init__(self, dimension: int, dtype: str = "float32"):
+        """
+        Almacén columnar de los eventos indexados en ContextRetrieval: una columna de textos,
+        otra de metadatos (los que vienen de disco se guardan en JSON y se decodifican al
+        usarlos) y, solo cuando el índice FAISS no conserva los vectores tal cual (IVF/PQ),
+        una matriz contigua con los embeddings.
+
+        Args:
+            dimension: Dimensión de los embeddings
+            dtype: Tipo con el que se guardan los embeddings ("float32" o "float16")
+        """
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self.texts: List[str] = []
+        self._metadata: List[Union[Dict, str]] = []
+        self._embeddings: Optional[np.ndarray] = None
+        self._n_embeddings = 0
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def append(self, texts: List[str], metadata: List[Dict]) -> None:
+        self.texts.extend(texts)
+        self._metadata.extend(metadata)
+
+    def extend_raw(self, rows: Iterable[Tuple[int, str, str]]) -> None:
+        """Añade filas (id, texto, metadatos en JSON) leídas de disco, en orden de id"""
+        for _, text, metadata in rows:
+            self.texts.append(text)
+            self._metadata.append(metadata)
+
+    def metadata(self, i: int) -> Dict:
+        metadata = self._metadata[i]
+        if isinstance(metadata, str):
+            metadata = json.loads(metadata)
+            self._metadata[i] = metadata
+        return metadata
+
+    def get(self, i: int) -> Optional[Dict]:
+        """Texto y metadatos del evento i, o None si no existe"""
+        if not 0 <= i < len(self.texts):
+            return None
+        return {"text": self.texts[i], "metadata": self.metadata(i)}
+
+    def has_embeddings(self, n: int) -> bool:
+        """True si la matriz de embeddings cubre los n primeros eventos"""
+        return self._n_embeddings == n
+
+    @property
+    def embeddings(self) -> Optional[np.ndarray]:
+        """Vista (sin copia) de los embeddings guardados"""
+        if self._embeddings is None:
+            return None
+        return self._embeddings[:self._n_embeddings]
+
+    def set_embeddings(self, embeddings: np.ndarray) -> None:
+        self._embeddings = np.array(embeddings, dtype=self.dtype)
+        self._n_embeddings = len(embeddings)
+
+    def append_embeddings(self, embeddings: np.ndarray) -> None:
+        """Añade filas a la matriz, duplicando su capacidad cuando se llena"""
+        needed = self._n_embeddings + len(embeddings)
+        if self._embeddings is None or needed > len(self._embeddings):
+            capacity = max(needed, 2 * (0 if self._embeddings is None else len(self._embeddings)), 64)
+            grown = np.empty((capacity, self.dimension), dtype=self.dtype)
+            if self._n_embeddings:
+                grown[:self._n_embeddings] = self._embeddings[:self._n_embeddings]
+            self._embeddings = grown
+        self._embeddings[self._n_embeddings:needed] = embeddings
+        self._n_embeddings = needed
+
+    def clear_embeddings(self) -> None:
+        """Libera la matriz (el índice ya guarda los vectores)"""
+        self._embeddings = None
+        self._n_embeddings = 0
+
+    def nbytes(self) -> int:
+        """Memoria aproximada de la matriz de embeddings"""
+        return 0 if self._embeddings is None else self._embeddings.nbytes
@@ -0,0 +1,234 @@
+import time
+from dataclasses import dataclass, replace
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+
+# flat: búsqueda exacta | hnsw: grafo HNSW | ivf_flat: listas invertidas | ivf_pq: listas invertidas
+# con cuantización de producto (menos memoria) | auto: se elige según el número de vectores
+INDEX_TYPES = ("flat", "hnsw", "ivf_flat", "ivf_pq", "auto")
+
+
+@dataclass
+class IndexConfig:
+    """
+    Configuración del índice FAISS de ContextRetrieval. Todos los índices usan producto
+    interno (similitud coseno con embeddings normalizados).
+
+    Args:
+        index_type: Uno de INDEX_TYPES
+        hnsw_m: Vecinos por nodo del grafo HNSW
+        ef_construction: Amplitud de la búsqueda al construir HNSW
+        ef_search: Amplitud de la búsqueda en HNSW (más alto: más recall, más latencia)
+        nlist: Número de listas de IVF (None: 4 * sqrt(n))
+        nprobe: Listas que se visitan al buscar en IVF (más alto: más recall, más latencia)
+        pq_m: Subcuantizadores de PQ (se ajusta a un divisor de la dimensión)
+        pq_bits: Bits por subcuantizador de PQ
+        auto_hnsw_threshold: En modo auto, vectores a partir de los que se usa HNSW
+        auto_ivf_threshold: En modo auto, vectores a partir de los que se usa IVF-Flat
+        auto_pq_threshold: En modo auto, vectores a partir de los que se usa IVF-PQ
+    """
+    index_type: str = "flat"
+    hnsw_m: int = 32
+    ef_construction: int = 200
+    ef_search: int = 64
+    nlist: Optional[int] = None
+    nprobe: int = 16
+    pq_m: int = 64
+    pq_bits: int = 8
+    auto_hnsw_threshold: int = 10_000
+    auto_ivf_threshold: int = 200_000
+    auto_pq_threshold: int = 2_000_000
+
+    def __post_init__(self):
+        if self.index_type not in INDEX_TYPES:
+            raise ValueError(f"Tipo de índice desconocido '{self.index_type}', debe ser uno de {INDEX_TYPES}")
+
+
+def resolve_index_type(config: IndexConfig, n_vectors: int) -> str:
+    """
+    Tipo de índice concreto para n_vectors vectores. Los índices IVF necesitan entrenarse,
+    así que mientras no haya vectores suficientes se usa flat.
+    """
+    index_type = config.index_type
+    if index_type == "auto":
+        if n_vectors >= config.auto_pq_threshold:
+            index_type = "ivf_pq"
+        elif n_vectors >= config.auto_ivf_threshold:
+            index_type = "ivf_flat"
+        elif n_vectors >= config.auto_hnsw_threshold:
+            index_type = "hnsw"
+        else:
+            index_type = "flat"
+    if index_type in ("ivf_flat", "ivf_pq") and n_vectors < min_training_size(config, index_type, n_vectors):
+        return "flat"
+    return index_type
+
+
+def nlist_for(config: IndexConfig, n_vectors: int) -> int:
+    """Número de listas de IVF: el configurado o 4 * sqrt(n)"""
+    if config.nlist is not None:
+        return config.nlist
+    return max(1, int(4 * np.sqrt(max(n_vectors, 1))))
+
+
+def min_training_size(config: IndexConfig, index_type: str, n_vectors: int) -> int:
+    """Vectores necesarios para entrenar el índice (FAISS recomienda ~39 por centroide)"""
+    if index_type == "ivf_flat":
+        return 39 * nlist_for(config, n_vectors)
+    if index_type == "ivf_pq":
+        return max(39 * nlist_for(config, n_vectors), 39 * 2 ** config.pq_bits)
+    return 0
+
+
+def _pq_subquantizers(config: IndexConfig, dimension: int) -> int:
+    """Mayor divisor de la dimensión que no supera pq_m"""
+    return max(m for m in range(1, min(config.pq_m, dimension) + 1) if dimension % m == 0)
+
+
+def create_index(dimension: int, config: IndexConfig, n_vectors: int = 0) -> faiss.Index:
+    """
+    Crea un índice vacío (sin entrenar si es IVF) para n_vectors vectores.
+
+    Args:
+        dimension: Dimensión de los embeddings
+        config: Configuración del índice
+        n_vectors: Número de vectores previsto (decide el tipo en modo auto y nlist)
+    """
+    index_type = resolve_index_type(config, n_vectors)
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dimension)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, config.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = config.ef_construction
+    elif index_type == "ivf_flat":
+        index = faiss.index_factory(dimension, f"IVF{nlist_for(config, n_vectors)},Flat", faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.index_factory(dimension,
+                                    f"IVF{nlist_for(config, n_vectors)},PQ{_pq_subquantizers(config, dimension)}x{config.pq_bits}",
+                                    faiss.METRIC_INNER_PRODUCT)
+    set_search_params(index, ef_search=config.ef_search, nprobe=config.nprobe)
+    return index
+
+
+def build_index(embeddings: np.ndarray, config: IndexConfig) -> faiss.Index:
+    """Crea el índice adecuado para los embeddings, lo entrena si hace falta y los añade"""
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    index = create_index(embeddings.shape[1], config, len(embeddings))
+    if not index.is_trained:
+        index.train(embeddings)
+    if len(embeddings):
+        index.add(embeddings)
+    return index
+
+
+def index_type_of(index: faiss.Index) -> str:
+    """Tipo (de INDEX_TYPES) de un índice ya creado"""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf_flat"
+    return "flat"
+
+
+def flat_vectors(index: faiss.Index) -> Optional[np.ndarray]:
+    """
+    Vista (sin copia) de los vectores de un índice flat o HNSW-flat, o None si el índice no
+    los guarda tal cual (IVF/PQ). La vista deja de ser válida si se modifica el índice.
+    """
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    if not isinstance(index, faiss.IndexFlat) or index.ntotal == 0:
+        return None
+    return faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+
+
+def search_parameters(index: faiss.Index, selector: faiss.IDSelector) -> faiss.SearchParameters:
+    """
+    Parámetros de búsqueda que restringen la búsqueda a los ids de selector, del tipo que
+    espera cada índice y conservando su efSearch/nprobe.
+    """
+    concrete = faiss.downcast_index(index)
+    if isinstance(concrete, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=concrete.hnsw.efSearch)
+    if isinstance(concrete, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=concrete.nprobe)
+    return faiss.SearchParameters(sel=selector)
+
+
+def set_search_params(index: faiss.Index, ef_search: Optional[int] = None, nprobe: Optional[int] = None) -> None:
+    """Ajusta el compromiso recall/latencia: efSearch en HNSW y nprobe en IVF"""
+    index = faiss.downcast_index(index)
+    if ef_search is not None and isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+    if nprobe is not None and isinstance(index, faiss.IndexIVF):
+        index.nprobe = nprobe
+
+
+def benchmark(embeddings: np.ndarray,
+              queries: np.ndarray,
+              configs: Dict[str, IndexConfig],
+              k: int = 10) -> List[Dict]:
+    """
+    Compara varias configuraciones de índice con la búsqueda exacta (flat).
+
+    Args:
+        embeddings: Vectores a indexar (n, d)
+        queries: Consultas (q, d)
+        configs: Configuraciones a comparar, por nombre
+        k: Vecinos a recuperar
+
+    Returns:
+        Por configuración: tipo de índice, recall@k respecto a flat, tiempo de construcción (s)
+        y latencia media por consulta (ms)
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    queries = np.ascontiguousarray(queries, dtype='float32')
+
+    exact = faiss.IndexFlatIP(embeddings.shape[1])
+    exact.add(embeddings)
+    _, ground_truth = exact.search(queries, k)
+
+    results = []
+    for name, config in configs.items():
+        start = time.perf_counter()
+        index = build_index(embeddings, config)
+        build_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        _, found = index.search(queries, k)
+        search_time = time.perf_counter() - start
+
+        recall = np.mean([len(set(found[i]) & set(ground_truth[i])) / k for i in range(len(queries))])
+        results.append({
+            "name": name,
+            "index_type": index_type_of(index),
+            f"recall@{k}": float(recall),
+            "build_s": build_time,
+            "ms_per_query": 1000 * search_time / max(len(queries), 1),
+        })
+    return results
+
+
+if __name__ == "__main__":
+    # Benchmark con vectores aleatorios normalizados (dimensión de e5-large-v2)
+    rng = np.random.default_rng(0)
+    data = rng.standard_normal((100_000, 1024)).astype('float32')
+    data /= np.linalg.norm(data, axis=1, keepdims=True)
+    query_vectors = data[rng.choice(len(data), 200, replace=False)] + 0.05 * rng.standard_normal((200, 1024)).astype('float32')
+
+    base = IndexConfig()
+    for row in benchmark(data, query_vectors, {
+        "flat": base,
+        "hnsw": replace(base, index_type="hnsw"),
+        "hnsw_ef128": replace(base, index_type="hnsw", ef_search=128),
+        "ivf_flat": replace(base, index_type="ivf_flat"),
+        "ivf_flat_nprobe64": replace(base, index_type="ivf_flat", nprobe=64),
+        "ivf_pq": replace(base, index_type="ivf_pq"),
+    }):
+        print(row)
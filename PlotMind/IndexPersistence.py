@@ -0,0 +1,108 @@
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Dict, Iterable, Optional, Tuple
+
+import faiss
+
+# Versión del formato del sidecar de metadatos
+SIDECAR_FORMAT = 1
+
+# Bloque con el que se lee el índice para calcular su checksum
+_CHECKSUM_BLOCK = 1 << 20
+
+
+def sidecar_path(index_path: str) -> str:
+    """Ruta del fichero SQLite con los metadatos de un índice"""
+    return index_path + ".meta.sqlite"
+
+
+def file_checksum(path: str) -> str:
+    """SHA-256 de un fichero, leído por bloques"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(_CHECKSUM_BLOCK), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def save(index: faiss.Index, index_path: str, rows: Iterable[Tuple[int, str, Dict]], info: Dict[str, object]) -> None:
+    """
+    Guarda el índice FAISS y sus metadatos (id, texto y metadatos de cada evento) en un
+    sidecar SQLite. Ambos ficheros se escriben primero en temporales y después se
+    sustituyen con os.replace, así que ninguno de los dos queda a medias. Como son dos
+    sustituciones, un fallo entre ambas sí puede dejar el sidecar nuevo junto al índice
+    anterior: para detectarlo, el sidecar guarda el número de vectores y el checksum del
+    índice, que se comprueban al cargar (ver load_sidecar).
+
+    Args:
+        index: Índice FAISS
+        index_path: Ruta del índice
+        rows: Filas (id, texto, metadatos) de los eventos indexados
+        info: Información adicional del índice (modelo, dimensión...)
+    """
+    tmp_index = index_path + ".tmp"
+    tmp_sidecar = sidecar_path(index_path) + ".tmp"
+    if os.path.exists(tmp_sidecar):
+        os.remove(tmp_sidecar)
+
+    faiss.write_index(index, tmp_index)
+    checksum = file_checksum(tmp_index)
+
+    connection = sqlite3.connect(tmp_sidecar)
+    try:
+        connection.execute("CREATE TABLE info (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        connection.execute("CREATE TABLE events (id INTEGER PRIMARY KEY, text TEXT NOT NULL, metadata TEXT NOT NULL)")
+        connection.executemany("INSERT INTO events (id, text, metadata) VALUES (?, ?, ?)",
+                               ((int(i), text, json.dumps(metadata, ensure_ascii=False)) for i, text, metadata in rows))
+        info = {**info, "format": SIDECAR_FORMAT, "ntotal": index.ntotal, "index_sha256": checksum}
+        connection.executemany("INSERT INTO info (key, value) VALUES (?, ?)",
+                               ((key, json.dumps(value)) for key, value in info.items()))
+        connection.commit()
+    finally:
+        connection.close()
+
+    os.replace(tmp_sidecar, sidecar_path(index_path))
+    os.replace(tmp_index, index_path)
+
+
+def mmap_flags() -> int:
+    """
+    Flags de lectura proyectada en memoria. IO_FLAG_MMAP solo proyecta las listas invertidas
+    de los índices IVF; IO_FLAG_MMAP_IFC proyecta también los vectores de los índices flat y
+    HNSW sin copiarlos. Las versiones de FAISS sin IO_FLAG_MMAP_IFC leen esos índices enteros.
+    """
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return flags | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+
+def load_index(index_path: str, mmap: bool = False) -> faiss.Index:
+    """
+    Lee un índice FAISS. Con mmap=True los vectores se proyectan en memoria desde el fichero
+    (ver mmap_flags) y solo se cargan las páginas que usan las búsquedas; el índice queda de
+    solo lectura. La estructura del índice (ej: el grafo HNSW o los ids) sí se lee entera.
+    """
+    return faiss.read_index(index_path, mmap_flags() if mmap else 0)
+
+
+def load_sidecar(index_path: str) -> Optional[Tuple[Dict[str, object], Iterable[Tuple[int, str, str]]]]:
+    """
+    Lee el sidecar de un índice. Devuelve (info, filas) con las filas (id, texto, metadatos en
+    JSON) ordenadas por id, o None si el índice no tiene sidecar (formato antiguo). Lanza
+    ValueError si el índice del disco no es el que se guardó con el sidecar (ver save).
+    """
+    path = sidecar_path(index_path)
+    if not os.path.exists(path):
+        return None
+    connection = sqlite3.connect(path)
+    try:
+        info = {key: json.loads(value) for key, value in connection.execute("SELECT key, value FROM info")}
+        rows = connection.execute("SELECT id, text, metadata FROM events ORDER BY id").fetchall()
+    finally:
+        connection.close()
+    checksum = info.get("index_sha256")
+    if checksum is not None and checksum != file_checksum(index_path):
+        raise ValueError(f"El índice {index_path} no es el que se guardó con sus metadatos ({path}): "
+                         "el último guardado se interrumpió")
+    return info, rows
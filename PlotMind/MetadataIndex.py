@@ -0,0 +1,72 @@
+from collections import defaultdict
+from typing import Any, Dict, Hashable, Iterable, List, Optional
+
+import numpy as np
+
+# Campos de los metadatos de los eventos que se indexan para el filtrado previo
+INDEXED_FIELDS = ("locations", "characters_involved", "items_involved", "narrative_part", "plot_part", "story_id")
+
+
+def rule_values(value: Any) -> List[Hashable]:
+    """Valores de una regla o de un campo: las listas se tratan como conjuntos de valores"""
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [v for v in value if isinstance(v, Hashable)]
+    return [value] if isinstance(value, Hashable) else []
+
+
+def matches(metadata: Dict, filter_rules: Dict) -> bool:
+    """
+    True si los metadatos cumplen todas las reglas. Una regla se cumple si el campo tiene
+    alguno de los valores pedidos (en campos lista basta con que los contenga).
+    """
+    for key, value in filter_rules.items():
+        field_values = set(rule_values(metadata.get(key)))
+        if not any(v in field_values for v in rule_values(value)):
+            return False
+    return True
+
+
+class MetadataIndex:
+    def __init__(self, fields: Iterable[str] = INDEXED_FIELDS):
+        """
+        Índice invertido campo -> valor -> ids de FAISS, para calcular qué eventos cumplen
+        unas reglas de filtrado antes de buscar (ver ContextRetrieval.get_context).
+
+        Args:
+            fields: Campos de los metadatos que se indexan
+        """
+        self.fields = tuple(fields)
+        self.postings: Dict[str, Dict[Hashable, List[int]]] = {field: defaultdict(list) for field in self.fields}
+        # Número de ids indexados (se indexan en orden: 0..size-1)
+        self.size = 0
+        self._removed: set = set()
+
+    def add(self, event_id: int, metadata: Dict) -> None:
+        for field in self.fields:
+            for value in dict.fromkeys(rule_values(metadata.get(field))):
+                self.postings[field][value].append(event_id)
+        self.size = max(self.size, event_id + 1)
+
+    def remove(self, event_ids: Iterable[int]) -> None:
+        """Marca ids como borrados; dejan de aparecer en candidates"""
+        self._removed.update(int(i) for i in event_ids)
+
+    def candidates(self, filter_rules: Dict) -> np.ndarray:
+        """Ids (ordenados) de los eventos que cumplen todas las reglas"""
+        result: Optional[np.ndarray] = None
+        for key, value in filter_rules.items():
+            postings = self.postings[key]
+            lists = [postings[v] for v in rule_values(value) if v in postings]
+            ids = np.unique(np.concatenate(lists)) if lists else np.zeros(0, dtype=np.int64)
+            result = ids if result is None else np.intersect1d(result, ids, assume_unique=True)
+            if len(result) == 0:
+                break
+        result = np.zeros(0, dtype=np.int64) if result is None else result.astype(np.int64)
+        if self._removed:
+            result = result[~np.isin(result, list(self._removed))]
+        return result
+
+    def clear(self) -> None:
+        self.postings = {field: defaultdict(list) for field in self.fields}
+        self.size = 0
+        self._removed = set()
@@ -1,11 +1,18 @@
-from collections import deque
+import asyncio
+import itertools
 import json
 import re
+import threading
+import time
+import uuid
 from ConversationalAgents.ConversationalAgent import ConversationalAgent
 from ConversationalAgents.Gemini import Gemini
+from PlotMind.CheckpointStore import CheckpointStore
 from PlotMind.ContextRetrieval import ContextRetrieval
+from PlotMind.PromptBuilder import PromptBudget, PromptBuilder
+from PlotMind.StoryCorpus import StoryCorpus
 from StoryGraphGenerator.EntityRecognition import EntityRecognition
-from StoryGraphGenerator.RelationshipManager import EntityRelationship, RelationshipManager
+from StoryGraphGenerator.RelationshipManager import EntityRelationship, Relationship, RelationshipManager
 from StoryGraphGenerator.GraphGenerator import GraphGenerator
 from DramaManager.DramaManager import DramaManager
 from DependencyManager.DependencyManager import DependencyManager
@@ -14,14 +21,87 @@ from StorySpace.Entity import Entity
 from StorySpace.Event import Event
 from StorySpace.Item import Item
 from StorySpace.Location import Location
-from typing import Dict, List
+from PlotMind.StoryUpdates import PassageChunk, PassageReady, StageFinished, StageStarted, StoryFinished, StoryUpdate
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
 import networkx as nx
 
 
+NARRATION_MODES = ("sequential", "outline", "speculative")
+
+# Etapas del pipeline de PlotMind, en orden de ejecución (ver PlotMind.stream)
+STAGES = (
+    "preferences", "entities", "events", "world", "entities_in_events", "relations", "simulation",
+    "character_review", "literary_elements", "embeddings", "subplots", "graph", "narration", "editing",
+)
+
+STAGE_DESCRIPTIONS = {
+    "preferences": "Analizando la descripción de la historia",
+    "entities": "Extrayendo personajes, lugares, objetos y eventos",
+    "events": "Generando los eventos de la trama",
+    "world": "Enriqueciendo el mundo de la historia",
+    "entities_in_events": "Relacionando entidades y eventos",
+    "relations": "Infiriendo relaciones",
+    "simulation": "Simulando a los personajes",
+    "character_review": "Revisando la coherencia de los personajes",
+    "literary_elements": "Añadiendo elementos literarios",
+    "embeddings": "Indexando los eventos",
+    "subplots": "Detectando subtramas",
+    "graph": "Construyendo el grafo de la historia",
+    "narration": "Narrando la historia",
+    "editing": "Editando el texto final",
+}
+
+# Estado de PlotMind que se guarda en cada checkpoint. El modelo, los gestores y el índice
+# de contexto no se guardan: se reconstruyen al reanudar (ver PlotMind.resume_stream)
+CHECKPOINT_ATTRIBUTES = (
+    "characters", "locations", "items", "graph", "relations", "narrative_structure", "gender",
+    "extension", "style", "rules", "inicial_description", "outline_text", "story",
+)
+
+
+@dataclass
+class NarrationStep:
+    """
+    Prompt de narración de un evento. El texto de los eventos anteriores se inserta
+    entre head y tail cuando se conoce (texto narrado o esquema, según el modo).
+    """
+    event: Event
+    head: str
+    tail: Optional[str] = None
+
+    def prompt(self, previous_texts: List[str]) -> str:
+        if self.tail is None:
+            return self.head
+        return self.head + ", ".join(previous_texts) + self.tail
+
+
 class PlotMind:
-    def __init__(self, model : ConversationalAgent = Gemini()):
-        """Inicializa la clase PlotMind"""
+    def __init__(self, model : ConversationalAgent = Gemini(),
+                 narration_mode: str = "sequential",
+                 narration_parallelism: int = 4,
+                 simulation_events_per_prompt: int = 1,
+                 checkpoint_store: Optional[CheckpointStore] = None,
+                 corpus: Optional[StoryCorpus] = None,
+                 prompt_budget: Optional[PromptBudget] = None):
+        """
+        Inicializa la clase PlotMind
+        
+        Args:
+            model: Agente conversacional a usar
+            narration_mode: Modo de narración final, uno de NARRATION_MODES (ver narrate)
+            narration_parallelism: Número máximo de eventos narrados a la vez en los modos paralelos
+            simulation_events_per_prompt: Eventos independientes que se simulan en un mismo prompt
+            checkpoint_store: Almacén donde se guarda el estado tras cada etapa; por defecto se
+                configura desde el entorno (PLOTMIND_CHECKPOINT_DIR) y si no está definido no se guarda
+            corpus: Corpus compartido al que se añade la historia terminada (salvo que sea casi
+                idéntica a otra ya guardada, ver StoryCorpus.find_duplicates)
+            prompt_budget: Presupuesto de tokens por sección del prompt de generación de eventos
+        """
         self.model = model
+        self.narration_mode = narration_mode
+        self.narration_parallelism = narration_parallelism
+        self.simulation_events_per_prompt = simulation_events_per_prompt
         self.recognizer = EntityRecognition(model)
         self.relationshipsManager = RelationshipManager(model)
         self.graph = GraphGenerator()
@@ -35,16 +115,146 @@ class PlotMind:
         self.extension = None
         self.style :str = ""
         self.rules : List[str] = []
+        self.inicial_description : str = ""
+        self.outline_text : str = ""
+        self.relations : List[Relationship] = []
+        self.story : str = ""
+        self.checkpoint_store = checkpoint_store if checkpoint_store is not None else CheckpointStore.from_env()
+        self.run_id : Optional[str] = None
+        self.corpus = corpus
+        self.prompt_builder = PromptBuilder(prompt_budget)
 
     def run(self, inicial_description: str):
         """
         Ejecuta el generador interactivo de tramas
         """
+        story = ""
+        for update in self.stream(inicial_description):
+            if isinstance(update, StoryFinished):
+                story = update.story
+        return story
+
+    def stream(self, inicial_description: str) -> Iterator[StoryUpdate]:
+        """
+        Ejecuta el generador de tramas emitiendo el progreso a medida que avanza: el inicio
+        y fin de cada etapa, cada pasaje narrado en cuanto está listo (y sus fragmentos si
+        el proveedor admite streaming) y, al final, la historia editada.
+        
+        Args:
+            inicial_description: Descripción de la historia que pide el usuario
+            
+        Returns:
+            Iterador de StoryUpdate
+        """
+        self.inicial_description = inicial_description
+        if self.checkpoint_store is not None:
+            self.run_id = self.checkpoint_store.new_run(inicial_description)
+            print(f"Guardando checkpoints de la ejecución {self.run_id} en {self.checkpoint_store.directory}")
+        yield from self._run_stages(STAGES)
+
+    def resume(self, run_id: str, from_stage: Optional[str] = None) -> str:
+        """
+        Reanuda una ejecución guardada en el almacén de checkpoints y devuelve la historia
+        """
+        story = ""
+        for update in self.resume_stream(run_id, from_stage):
+            if isinstance(update, StoryFinished):
+                story = update.story
+        return story
+
+    def resume_stream(self, run_id: str, from_stage: Optional[str] = None) -> Iterator[StoryUpdate]:
+        """
+        Reanuda una ejecución guardada: restaura el estado de la última etapa anterior a
+        from_stage y ejecuta el pipeline desde ahí, sin repetir las llamadas al modelo de
+        las etapas ya completadas.
+        
+        Args:
+            run_id: Identificador de la ejecución (ver CheckpointStore.runs)
+            from_stage: Etapa desde la que continuar; por defecto la siguiente a la última completada
+            
+        Returns:
+            Iterador de StoryUpdate, como stream
+        """
+        if self.checkpoint_store is None:
+            raise ValueError("No hay almacén de checkpoints configurado para reanudar la ejecución")
+
+        completed = self.checkpoint_store.completed_stages(run_id)
+        if from_stage is None:
+            from_stage = next((stage for stage in STAGES if stage not in completed), None)
+        elif from_stage not in STAGES:
+            raise ValueError(f"Etapa desconocida '{from_stage}', debe ser una de {STAGES}")
+
+        self.run_id = run_id
+        self.inicial_description = self.checkpoint_store.manifest(run_id)["inicial_description"]
+        start_index = STAGES.index(from_stage) if from_stage is not None else len(STAGES)
+        if start_index > 0:
+            previous_stage = STAGES[start_index - 1]
+            if previous_stage not in completed:
+                raise ValueError(f"La etapa '{previous_stage}' no tiene checkpoint en la ejecución {run_id}")
+            self._restore_checkpoint(self.checkpoint_store.load(run_id, previous_stage))
+            # El índice de contexto no se guarda: se reconstruye con los eventos (sin llamadas al modelo)
+            if start_index > STAGES.index("embeddings"):
+                self.context_retriever = ContextRetrieval()
+                self.context_retriever.add_events(list(self.graph.events.values()))
+
+        print(f"Reanudando la ejecución {run_id} desde la etapa {from_stage or 'final'}")
+        yield from self._run_stages(STAGES[start_index:])
+
+    def _run_stages(self, stages: Tuple[str, ...]) -> Iterator[StoryUpdate]:
+        """Ejecuta las etapas indicadas y guarda un checkpoint al terminar cada una"""
+        for stage in stages:
+            yield StageStarted(stage, STAGE_DESCRIPTIONS[stage])
+            start = time.monotonic()
+            result = getattr(self, f"_stage_{stage}")()
+            if result is not None:
+                yield from result
+            if self.checkpoint_store is not None and self.run_id is not None:
+                self.checkpoint_store.save(self.run_id, stage, self._checkpoint_state())
+            yield StageFinished(stage, time.monotonic() - start)
+        yield StoryFinished(self.story)
+
+    def _checkpoint_state(self) -> Dict[str, object]:
+        """Estado de la historia que se guarda tras cada etapa"""
+        return {attribute: getattr(self, attribute) for attribute in CHECKPOINT_ATTRIBUTES}
+
+    def _restore_checkpoint(self, state: Dict[str, object]) -> None:
+        for attribute in CHECKPOINT_ATTRIBUTES:
+            setattr(self, attribute, state[attribute])
+
+    async def astream(self, inicial_description: str) -> AsyncIterator[StoryUpdate]:
+        """
+        Versión asíncrona de stream: el pipeline se ejecuta en un hilo aparte y los avisos
+        se entregan en el event loop sin bloquearlo.
+        """
+        loop = asyncio.get_running_loop()
+        updates: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        def produce():
+            try:
+                for update in self.stream(inicial_description):
+                    loop.call_soon_threadsafe(updates.put_nowait, update)
+            except BaseException as e:
+                loop.call_soon_threadsafe(updates.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(updates.put_nowait, done)
+
+        threading.Thread(target=produce, daemon=True).start()
+        while True:
+            update = await updates.get()
+            if update is done:
+                return
+            if isinstance(update, BaseException):
+                raise update
+            yield update
+
+    def _stage_preferences(self):
+        """Extrae la estructura narrativa, el género, la extensión, el estilo y las reglas de la descripción inicial"""
         start = True
         print("Bienvenido a PlotMind, el generador interactivo de tramas.")
         print("Escribe 'salir' para terminar la sesión.")
         if start:
-            user_input = inicial_description
+            user_input = self.inicial_description
             
             prompt = f"""
             Extract:
@@ -61,9 +271,7 @@ class PlotMind:
             In valid JSON format. 
             """
             #print(prompt)
-            resp = self.model.ask(prompt)
-
-            data = self.model.clean_answer(resp)
+            data = self.model.ask_json(prompt)
             
             self.narrative_structure = data.get("narrative_structure", "Estructura básica")
             self.gender = data.get("gender", "Género no especificado")
@@ -77,9 +285,10 @@ class PlotMind:
             
         else:
             user_input = input("Escribe algo más sobre tu historia: ")
-        
 
-        extraction = self.recognizer.extract_entities(user_input, [Location, Character, Item, Event])
+    def _stage_entities(self):
+        """Extrae los personajes, ubicaciones, items y eventos mencionados en la descripción inicial"""
+        extraction = self.recognizer.extract_entities(self.inicial_description, [Location, Character, Item, Event])
 
         rm : List[str] = []
         e_rm : List[str] = []
@@ -151,10 +360,25 @@ class PlotMind:
 
         self.graph = GraphGenerator()
 
+    def _stage_events(self):
+        """
+        Genera los eventos de la trama en lotes de 20. Cada sección del prompt tiene su
+        presupuesto de tokens (ver PromptBuilder): los eventos anteriores se resumen más
+        cuanto más antiguos y solo se incluyen las entidades más relevantes para el lote.
+        """
+        builder = self.prompt_builder
         while isinstance(self.extension, int) and self.extension > 0:
             extension = min(self.extension, 20)
             self.extension -= 20
 
+            builder.reset()
+            budget = builder.budget
+            events = list(self.graph.events.values())
+            # Relevancia de las entidades: la descripción de la historia y los últimos eventos
+            query = " ".join([self.inicial_description] + [event.description for event in events[-5:]])
+            mentioned = {name for event in events
+                         for name in itertools.chain(event.characters_involved, event.locations, event.items_involved)}
+
             prompt = f"""
             Genera {extension} eventos narrativos coherentemente que sigan como estructura narrativa {self.narrative_structure}, con género {self.gender}, con tono {self.style}.
             La salida debe ser de la siguiente forma:
@@ -168,35 +392,44 @@ class PlotMind:
                 ]
             }}
             Incluye los siguientes eventos:
-            {     " - ".join([f"{event.description}" for event in self.graph.events.values()]) }
+            {builder.events_section(events)}
             Ten en cuenta las siguientes reglas:
-            {", ".join(self.rules)}
+            {builder.fit("rules", self.rules, budget.rules)}
             Ten en cuenta los siguientes personajes:
-            {", ".join([f"{character.description_summary()}" for character in self.characters.values()]) }
+            {builder.entities_section("characters", self.characters.values(), query, budget.characters, mentioned)}
             Ten en cuenta los siguientes lugares:
-            {", ".join([f"{location.description_summary()}" for location in self.locations.values()]) }
+            {builder.entities_section("locations", self.locations.values(), query, budget.locations, mentioned)}
             Ten en cuenta los siguientes items:
-            {", ".join([f"{item.description_summary()}" for item in self.items.values()]) }
+            {builder.entities_section("items", self.items.values(), query, budget.items, mentioned)}
             """
 
+            tokens = builder.check(prompt)
+            print(f"Prompt de eventos: {tokens} tokens {builder.report}")
             print(prompt)
-            resp = self.model.ask(prompt, temperature=0.9)
-            data = self.model.clean_answer(resp)
+            data = self.model.ask_json(prompt, temperature=0.9)
             suggested_events = data.get("eventos_sugeridos", [])
-            text = ""
+            self.outline_text = ""
 
             for e in suggested_events:
                 self.graph.add_event(Event(**e) )
                 
         for e in self.graph.events.values():
-            text += (e.description)
+            self.outline_text += (e.description)
             print(e.description)
             print("\n")
 
-
+    def _stage_world(self):
+        """Mejora los personajes, ubicaciones e items según los eventos sugeridos"""
         # Mejorando el mundo de la historia según los eventos sugeridos
 
-        characters_data = self.model.clean_answer(self.dramaManager.impove_characters([character for character in self.characters.values()], text))
+        # Las tres mejoras son independientes, se piden en paralelo
+        characters_resp, locations_resp, items_resp = self.dramaManager.improve_world(
+            [character for character in self.characters.values()],
+            [location for location in self.locations.values()],
+            [item for item in self.items.values()],
+            self.outline_text)
+
+        characters_data = self.model.clean_answer(characters_resp)
         if isinstance(characters_data, dict):
             new_characters = characters_data.get("personajes", [])
         else:
@@ -207,7 +440,7 @@ class PlotMind:
 
         # print("Nuevos personajes::", json.dumps(new_characters, indent=2, ensure_ascii=False))
 
-        locations_data = self.model.clean_answer(self.dramaManager.impove_locations([location for location in self.locations.values()], text))
+        locations_data = self.model.clean_answer(locations_resp)
         if isinstance(locations_data, dict):
             new_locations = locations_data.get("ubicaciones", [])
         else:
@@ -218,7 +451,7 @@ class PlotMind:
 
         # print("Nuevas ubicaciones:", json.dumps(new_locations, indent=2, ensure_ascii=False))
 
-        items_data = self.model.clean_answer(self.dramaManager.impove_items([item for item in self.items.values()], text))
+        items_data = self.model.clean_answer(items_resp)
         if isinstance(items_data, dict):
             new_items = items_data.get("items", [])
         else:
@@ -228,17 +461,21 @@ class PlotMind:
             self.items[item["name"]] = Item(**item)
 
         # print("Nuevos ítems:", json.dumps(new_items, indent=2, ensure_ascii=False))
-        
+
+    def _stage_entities_in_events(self):
+        """Relaciona las entidades con los eventos en los que participan"""
         # Relacionar entidades y eventos
         self.update_entities_in_events(events=[e for e in self.graph.events.values()], entities=[character for character in self.characters.values()] + [location for location in self.locations.values()] + [item for item in self.items.values()])
 
+    def _stage_relations(self):
+        """Infiere las relaciones entre eventos y entre entidades y las añade al grafo"""
         entities = [character for character in self.characters.keys()] + [location for location in self.locations.keys()] + [item for item in self.items.keys()]
 
         print("Extrayendo relaciones...")
-        relations = self.relationshipsManager.infer_relationships_from_text(entities, list(self.graph.events.values()))
+        self.relations = self.relationshipsManager.infer_relationships_from_text(entities, list(self.graph.events.values()))
 
         # Añadir relaciones al grafo
-        for relation in relations:
+        for relation in self.relations:
             if relation.relationship_type == 'causal':
                 self.graph.add_causal_relation(relation.entity1, relation.entity2)
             elif relation.relationship_type == 'prereq':
@@ -250,6 +487,8 @@ class PlotMind:
         # print("\nVisualizando grafo de eventos...")
         # self.graph.visualize_graph()
 
+    def _stage_simulation(self):
+        """Simula a los personajes en cada evento"""
         # Simulando el personaje sobre toda la historia
         # for name,character in self.characters.items():
         #     print(f"Personaje {name}:")
@@ -266,12 +505,12 @@ class PlotMind:
         #     print(self.characters[name].goals)
 
 
-        # Simulando cada paso de la historia con todos los personajes
-        for event in self.graph.events.values():
-            updated_characters = self.dramaManager.simulate_event(event, [character for name,character in self.characters.items() if name in event.characters_involved])
-            for character in updated_characters:
-                self.characters[character.name]= character
-        
+        # Simulando cada paso de la historia con todos los personajes (en lotes de eventos independientes)
+        self.dramaManager.simulate_events(list(self.graph.events.values()), self.characters, self.graph.graph,
+                                          events_per_prompt=self.simulation_events_per_prompt)
+
+    def _stage_character_review(self):
+        """Revisa las acciones de los personajes y añade los eventos sugeridos que aporten a la trama"""
         # Comprobando acciones de los personajes y tomando sugerencias para enriquecer la historia
         suggested_events_for_the_characters = []
         for character in self.characters.values():
@@ -282,19 +521,23 @@ class PlotMind:
         #print(suggested_events_for_the_characters)
 
         # Seleccionando de los eventos sugeridos los que aporten a la trama sin desviarla
-        events_to_add = self.dramaManager.select_significant_events(suggested_events_for_the_characters, text, self.rules)
+        events_to_add = self.dramaManager.select_significant_events(suggested_events_for_the_characters, self.outline_text, self.rules)
 
         #print("Eventos escogidos:")
         for e in events_to_add:
             #print(e.to_dict())
             self.graph.add_event(e)
 
+    def _stage_literary_elements(self):
+        """Enriquece los eventos con elementos literarios y comprueba que el grafo sea un DAG"""
         # Añadiendo elementos literarios a los eventos existentes
         new_events = self.dramaManager.add_literary_elements([event for event in self.graph.events.values()], self.gender, self.style)
         for e in new_events:
             self.graph.events[e.title] = e
             #print(f"Evento mejorado: {e.description}")
 
+        # Los eventos aún no están indexados (la etapa de embeddings va después); upsert_events y
+        # delete_events quedan para quien revise con la API de ContextRetrieval una historia ya indexada
 
         # Comprobar dependencias y relaciones entre el mundo de la historia y los eventos
         if not DependencyManager.is_multidigraph_dag(self.graph.graph):
@@ -304,10 +547,13 @@ class PlotMind:
             for cycle in cycles:
                 print(f"Ciclo: {cycle}")
 
-        
+    def _stage_embeddings(self):
+        """Indexa los eventos para la recuperación de contexto"""
         # Generar embeddings de texto para los eventos
         self.context_retriever.add_events(list(self.graph.events.values()))
 
+    def _stage_subplots(self):
+        """Detecta subtramas mediante clustering semántico y componentes conexas de eventos"""
         # Detección de subtramas mediante clustering semántico y componentes conexas de eventos
         # 1. Obtener subgrafos de eventos conectados
         subgraphs = [self.graph.graph.subgraph(c) for c in nx.weakly_connected_components(self.graph.graph)]
@@ -348,8 +594,9 @@ class PlotMind:
                     if event:
                         events_description.append(event.description)
                 print(self.relationshipsManager.verify_subplot(events_description))
-                    
 
+    def _stage_graph(self):
+        """Relaciona personajes, items y entidades con los eventos en el grafo y lo visualiza"""
         # Crear relaciones entre los personajes y los eventos en el grafo
         for c in self.characters.values():
             if len(c.actions) > 0:
@@ -363,7 +610,7 @@ class PlotMind:
                 if item.name in event.items_involved:
                     self.graph.link_item_to_event(item.name, event.title)
 
-        for relation in relations:
+        for relation in self.relations:
             if isinstance(relation, EntityRelationship):
                 self.graph.add_entities_relation(relation)
 
@@ -371,32 +618,180 @@ class PlotMind:
         print("\nVisualizando grafo de eventos...")
         self.graph.visualize_graph()
 
-
+    def _stage_narration(self):
+        """Genera el texto narrativo de cada evento, emitiendo cada pasaje en cuanto está listo"""
         # Generar el texto narrativo 
         plot=list(self.graph.events.values())
+        yield from self._narrate_stream(plot)
+        # El índice de contexto no se actualiza con el texto narrado: ninguna etapa posterior lo consulta
+
+    def _stage_editing(self):
+        """Edita la historia completa y la guarda en stories.txt"""
+        # Guardar la historia en un archivo de texto
+        plot=list(self.graph.events.values())
+        story = ("\n\n").join([e.description for e in plot])	
+        story = self.editar_texto_largo(story)
+
+        with open("stories.txt", "a", encoding="utf-8") as archivo:
+            archivo.write("\n Prompt inicial: " + self.inicial_description + "\n\n")
+
+        with open("stories.txt", "a", encoding="utf-8") as archivo:
+            archivo.write(story)
+
+        self.story = story
+        print(f"Respuestas JSON del modelo (leídas, reparadas, repreguntadas, descartadas): {self.model.structured_output_stats.summary()}")
+        print(f"Caché de prefijos del proveedor (tokens de entrada servidos desde caché): {self.model.prefix_cache_stats.summary()}")
+        self._publish_to_corpus()
+
+    def _publish_to_corpus(self) -> None:
+        """Añade los eventos de la historia terminada al corpus compartido, si no hay ya una trama casi idéntica"""
+        if self.corpus is None:
+            return
+        events = list(self.graph.events.values())
+        duplicates = self.corpus.find_duplicates(events)
+        if duplicates:
+            story_id, similarity = duplicates[0]
+            print(f"La trama es casi idéntica a la historia {story_id} del corpus (similitud {similarity:.3f}), no se añade")
+            return
+        self.corpus.add_story(self.run_id or uuid.uuid4().hex, events)
+
+
+    def narrate(self, plot: List[Event]) -> None:
+        """
+        Genera el texto narrativo de cada evento y lo guarda en su descripción.
+        
+        Según self.narration_mode:
+            - "sequential": cada evento se narra a partir del texto ya narrado de los anteriores.
+            - "outline": cada evento se narra a partir del esquema (descripción previa) de los
+              anteriores, por lo que todos se generan en paralelo.
+            - "speculative": borradores en paralelo como en "outline" y una segunda pasada,
+              también en paralelo, que enlaza cada pasaje con el borrador anterior.
+        
+        Args:
+            plot: Eventos de la historia en orden
+        """
+        for _ in self._narrate_stream(plot):
+            pass
+
+    def _narrate_stream(self, plot: List[Event]) -> Iterator[StoryUpdate]:
+        """
+        Implementación de narrate que emite cada pasaje (PassageReady) en el orden de la
+        historia tan pronto como él y todos los anteriores están listos.
+        """
+        if self.narration_mode not in NARRATION_MODES:
+            raise ValueError(f"Modo de narración desconocido '{self.narration_mode}', debe ser uno de {NARRATION_MODES}")
+
+        # Todos los prompts de narración empiezan por el mismo prefijo (ver _narration_prefix)
+        prefix, entities_in_prefix = self._narration_prefix()
+        steps = self._plan_narration(plot, entities_in_prefix)
+        try:
+            yield from self._narrate_steps(steps, prefix)
+        finally:
+            self.model.release_prefix(prefix)
+
+    def _narrate_steps(self, steps: List["NarrationStep"], prefix: str) -> Iterator[StoryUpdate]:
+        """Envía los prompts de narración según self.narration_mode (ver narrate)"""
+        if self.narration_mode == "sequential":
+            texts = []
+            for i, step in enumerate(steps):
+                chunks = []
+                for chunk in self.model.ask_stream(step.prompt(texts[max(0, i-2):i]), prefix=prefix):
+                    chunks.append(chunk)
+                    yield PassageChunk(i, step.event.title, chunk)
+                texts.append("".join(chunks))
+                step.event.description = texts[i]
+                yield PassageReady(i, step.event.title, texts[i])
+            return
+
+        outline = [step.event.description for step in steps]
+        prompts = [step.prompt(outline[max(0, i-2):i]) for i, step in enumerate(steps)]
+
+        if self.narration_mode == "outline":
+            texts = self._iter_in_parallel(prompts, prefix)
+        else:
+            drafts = self._ask_in_parallel(prompts, prefix)
+            texts = itertools.chain([(0, drafts[0])], ((i + 1, text) for i, text in self._iter_in_parallel(self._stitch_prompts(drafts), prefix)))
+
+        for i, text in texts:
+            steps[i].event.description = text
+            yield PassageReady(i, steps[i].event.title, text)
+
+    def _narration_prefix(self) -> Tuple[str, bool]:
+        """
+        Prefijo común de los prompts de narración y si incluye la descripción de las entidades.
+        La biblia completa (con todo el reparto) solo compensa si el proveedor la sirve desde
+        una caché explícita; si no, el prefijo es solo el resumen estable de la historia y cada
+        prompt describe únicamente las entidades de su evento.
+        """
+        bible = self._world_bible()
+        if self.model.caches_prefix(bible):
+            return bible, True
+        return self._world_bible(with_entities=False), False
+
+    def _world_bible(self, with_entities: bool = True) -> str:
+        """
+        Prefijo estable de los prompts de narración: el papel del narrador, la estructura, el
+        género, el estilo y, si with_entities, la descripción de todas las ubicaciones,
+        personajes e items. Es el mismo para todos los eventos, así que el proveedor lo puede
+        servir desde su caché de prefijos y cada prompt solo añade lo propio del evento.
+        """
+        bible = f"""
+            Eres un narrador experto de historias. Vas a narrar, evento a evento, una historia que sigue la estructura narrativa {self.narrative_structure}.
+            Devuelve solo el texto narrativo del evento que se te pide, como se presentaría al lector, sin comentarios adicionales y en español.
+            """
+        if self.gender is not None:
+            bible += f"El género de la historia es {self.gender}."
+        if self.style is not None:
+            bible += f"El estilo de la historia es {self.style}."
+        if not with_entities:
+            return bible
+        bible += f"""
+            Biblia del mundo de la historia (cada evento indica qué ubicaciones, personajes e items intervienen en él):
+            Ubicaciones: {[location.to_dict() for location in self.locations.values()]}
+            Personajes: {[character.describe_character() for character in self.characters.values()]}
+            Items: {[item.to_dict() for item in self.items.values()]}
+            """
+        return bible
+
+    def _plan_narration(self, plot: List[Event], entities_in_prefix: bool = False) -> List["NarrationStep"]:
+        """
+        Construye la parte variable de los prompts de narración de todos los eventos (lo común
+        está en _world_bible). Lo único que depende del texto generado es el fragmento con los
+        eventos anteriores, que se deja como hueco en cada NarrationStep; el resto (presentación
+        de entidades, ubicación de los personajes y contexto semántico) se calcula aquí
+        recorriendo la trama en orden. Si entities_in_prefix, las entidades ya están descritas
+        en el prefijo y aquí solo se nombran.
+        """
+        described = " (descritos en la biblia del mundo)" if entities_in_prefix else ""
+
+        def entity_text(entity):
+            return entity.name if entities_in_prefix else entity.to_dict()
+
+        def character_text(character: Character, event: Event) -> str:
+            if entities_in_prefix:
+                return self._event_role(character, event)
+            return character.describe_character_with_event(event.title)
+
         characters_introduced = {character.name : False for character in self.characters.values()}
         locations_introduced = {location.name : False for location in self.locations.values()}
         items_introduced = {item.name : False for item in self.items.values()}
         events_introduced = {event.title : False for event in self.graph.events.values()}
-        window = deque(maxlen=3) 
+        steps = []
+
+        # Contexto semántico de todas las ventanas (el evento y sus dos anteriores) en una sola consulta
+        contexts = self.context_retriever.get_context_batch([[e.title for e in plot[max(0, i-2):i+1]] for i in range(1, max(len(plot), 2))])
 
         prompt = f"""
-            Eres un narrador experto de historias. Tu misión es generar un texto narrativo que describa el siguiente evento con el que comienza la historia.
+            Tu misión es generar un texto narrativo que describa el siguiente evento con el que comienza la historia.
             El evento se titula {plot[0].title}, se desarrolla en {plot[0].locations[0]} y se describe como: {plot[0].description}
-            Puedes introducir las ubicaciones, personajes e items haciendo breves descripciones de ellos ya que se presentan por primera vez, según consideres para no cargar el texto.
-            Las ubicaciones son: {[location.to_dict() for location in self.locations.values() if location.name in plot[0].locations]}
-            Los personajes son: {[character.describe_character_with_event(plot[0].title) for character in self.characters.values() if character.name in plot[0].characters_involved]}
-            Los items son: {[item.to_dict() for item in self.items.values() if item.name in plot[0].items_involved]}
-            La narración sigue la estructura narrativa {self.narrative_structure}, este evento pertenece a {plot[0].narrative_part}, tenlo en cuenta para la longitud del texto generado.
+            Puedes introducir las ubicaciones, personajes e items{described} haciendo breves descripciones de ellos ya que se presentan por primera vez, según consideres para no cargar el texto.
+            Las ubicaciones son: {[entity_text(location) for location in self.locations.values() if location.name in plot[0].locations]}
+            Los personajes son: {[character_text(character, plot[0]) for character in self.characters.values() if character.name in plot[0].characters_involved]}
+            Los items son: {[entity_text(item) for item in self.items.values() if item.name in plot[0].items_involved]}
+            Este evento pertenece a {plot[0].narrative_part}, tenlo en cuenta para la longitud del texto generado.
         """
-        
-        if self.gender is not None:
-            prompt += f"El género de la historia es {self.gender}."
-        if self.style is not None:
-            prompt += f"El estilo de la historia es {self.style}."
         # if len(self.rules) > 0:
         #     prompt += f"Ten en cuenta los siguientes deseos del autor: {', '.join(self.rules)}."
-        prompt += "Devuelve solo el texto narrativo como se presentaría al lector, sin comentarios adicionales y en español."
 
         # Marcar los personajes, ubicaciones e items introducidos en el texto
         for c in plot[0].characters_involved:
@@ -411,28 +806,24 @@ class PlotMind:
                 items_introduced[i] = True
 
         events_introduced[plot[0].title] = True
-        # print(prompt)
-        plot[0].description = self.model.ask(prompt)
-        window.append(plot[0])
+        steps.append(NarrationStep(plot[0], prompt))
       
-        for event in plot[1:-1]:
-            window.append(event)
-            context = self.context_retriever.get_context([e.title for e in window])
-            prompt = f"""
-                Eres un narrador experto de historias. Tu misión es generar un texto narrativo coherente para el siguiente evento.
-                Devuelve solo el texto narrativo de este evento, como se presentaría al lector, sin comentarios adicionales y en español.
+        for position, event in enumerate(plot[1:-1], start=1):
+            context = contexts[position-1]
+            head = f"""
+                Tu misión es generar un texto narrativo coherente para el siguiente evento.
                 El evento se titula {event.title}, se desarrolla en {event.locations[0] if len(event.locations)>0 else "lugar desconocido"} y se describe como: {event.description}
                 Redacta el texto de manera que sea coherente con el texto de los eventos anteriores, pero no los repitas, genera texto solo para este evento.
                 El texto de los eventos anteriores es:
-                {", ".join([f"{e.description}" for e in list(window)[:-1]])}
-            """
+                """
+            prompt = "\n            "
 
-            locations_to_present = [location.to_dict() for location in self.locations.values() if (location.name in event.locations and not locations_introduced[location.name])]
-            characters_to_present = [character.describe_character_with_event(event.title) for character in self.characters.values() if (character.name in event.characters_involved and not characters_introduced[character.name])]
-            items_to_present = [item.to_dict() for item in self.items.values() if (item.name in event.items_involved and not items_introduced[item.name])]
+            locations_to_present = [entity_text(location) for location in self.locations.values() if (location.name in event.locations and not locations_introduced[location.name])]
+            characters_to_present = [character_text(character, event) for character in self.characters.values() if (character.name in event.characters_involved and not characters_introduced[character.name])]
+            items_to_present = [entity_text(item) for item in self.items.values() if (item.name in event.items_involved and not items_introduced[item.name])]
 
             if len(locations_to_present) > 0 or len(characters_to_present) > 0 or len(items_to_present) > 0:
-                prompt += f"Puedes introducir las siguientes ubicaciones, personajes e items haciendo breves descripciones de ellos ya que se presentan por primera vez, según consideres para no cargar el texto.\n"
+                prompt += f"Puedes introducir las siguientes ubicaciones, personajes e items{described} haciendo breves descripciones de ellos ya que se presentan por primera vez, según consideres para no cargar el texto.\n"
                 if len(locations_to_present) > 0:
                     prompt += f"Las ubicaciones son: {locations_to_present}.\n"
                 if len(characters_to_present) > 0:
@@ -442,7 +833,7 @@ class PlotMind:
 
             characters_presented = [(character.name, character.current_location) for character in self.characters.values() if (character.name in event.characters_involved and characters_introduced[character.name])]
             if len(characters_presented) > 0:
-                prompt += f"Los personajes ya presentados en la historia que intervienen en este evento son: {', '.join([f' {self.characters[name].describe_character_with_event(event.title)} anteriormente estaba en {location}' for name, location in characters_presented])}.\n"
+                prompt += f"Los personajes ya presentados en la historia que intervienen en este evento son: {', '.join([f' {character_text(self.characters[name], event)} anteriormente estaba en {location}' for name, location in characters_presented])}.\n"
 
             # Eventos relacionados con el actual que ya se han escrito
             past_context = [c for c in context if events_introduced[c['metadata']['title']]]
@@ -457,11 +848,7 @@ class PlotMind:
                 prompt += f"Eventos que van a ocurrir en el futuro relacionados semánticamente con el evento actual (no mencionar directamente): {', '.join([c['text'] for c in future_context])}.\n"
 
 
-            prompt += f"La narración sigue la estructura narrativa {self.narrative_structure}, este evento pertenece a {event.narrative_part}, tenlo en cuenta para la longitud del texto generado."
-            if self.gender is not None:
-                prompt += f"El género de la historia es {self.gender}."
-            if self.style is not None:
-                prompt += f"El estilo de la historia es {self.style}."
+            prompt += f"Este evento pertenece a {event.narrative_part}, tenlo en cuenta para la longitud del texto generado."
             # if len(self.rules) > 0:
             #     prompt += f"Ten en cuenta los siguientes deseos del autor: {', '.join(self.rules)}."
             
@@ -479,54 +866,88 @@ class PlotMind:
                     items_introduced[i] = True
             events_introduced[event.title] = True
 
-            # print(prompt)
-            event.description = self.model.ask(prompt)
+            steps.append(NarrationStep(event, head, prompt))
             
         # Añadir el último evento
         last_event = plot[-1]
-        window.append(last_event)
-        context = self.context_retriever.get_context([e.title for e in window])
-
-        characters_presented = [character.describe_character_with_event(last_event.title) for character in self.characters.values() if character.name in last_event.characters_involved]
+        context = contexts[-1]
 
-        prompt = f"""
-            Eres un narrador experto de historias. Tu misión es generar un texto narrativo coherente para el último evento de una historia.
-            Devuelve solo el texto narrativo de este evento y que dará fin a la historia, como se presentaría al lector, sin comentarios adicionales y en español.
+        head = f"""
+            Tu misión es generar un texto narrativo coherente para el último evento de la historia.
+            Devuelve solo el texto narrativo de este evento y que dará fin a la historia.
             El evento se titula {last_event.title}, se desarrolla en {last_event.locations[0]} y se describe como: {last_event.description}
             Redacta el texto de manera que sea coherente con el texto de los eventos anteriores, pero no los repitas, genera texto solo para este evento.
             El texto de los eventos anteriores es:
-            {", ".join([f"{e.description}" for e in list(window)[:-1]])}
-            Las ubicaciones, personajes e items que aparecen en el evento se describen a continuación.
-            Las ubicaciones son: {[location.to_dict() for location in self.locations.values() if location.name in last_event.locations]}
-            Los personajes son: {[characters_presented[i] + "Anteriormente estaba en " + self.characters[character].current_location for i, character in enumerate(last_event.characters_involved)]}
-            Los items son: {[item.to_dict() for item in self.items.values() if item.name in last_event.items_involved]}
-            La narración sigue la estructura narrativa {self.narrative_structure}, este evento pertenece a {last_event.narrative_part}, tenlo en cuenta en la longitud del texto generado.
+            """
+        prompt = f"""
+            Las ubicaciones, personajes e items que aparecen en el evento{described} son:
+            Las ubicaciones son: {[entity_text(location) for location in self.locations.values() if location.name in last_event.locations]}
+            Los personajes son: {[character_text(character, last_event) + "Anteriormente estaba en " + str(character.current_location) for character in self.characters.values() if character.name in last_event.characters_involved]}
+            Los items son: {[entity_text(item) for item in self.items.values() if item.name in last_event.items_involved]}
+            Este evento pertenece a {last_event.narrative_part}, tenlo en cuenta en la longitud del texto generado.
         """
         prompt += f"A continuacion se describen eventos anteriores que pueden ser relevantes para el contexto de este evento: {', '.join([c['text'] for c in context])}.\n"
-
-        if self.gender is not None:
-            prompt += f"El género de la historia es {self.gender}."
-        if self.style is not None:
-            prompt += f"El estilo de la historia es {self.style}."
         # if len(self.rules) > 0:
         #     prompt += f"Ten en cuenta los siguientes deseos del autor: {', '.join(self.rules)}."
 
-        # print(prompt)
-        plot[-1].description = self.model.ask(prompt)	
-
-        # Guardar la historia en un archivo de texto
-        story = ("\n\n").join([e.description for e in plot])	
-        story = self.editar_texto_largo(story)
-
-        with open("stories.txt", "a", encoding="utf-8") as archivo:
-            archivo.write("\n Prompt inicial: " + inicial_description + "\n\n")
-
-        with open("stories.txt", "a", encoding="utf-8") as archivo:
-            archivo.write(story)
-
-        return story
+        steps.append(NarrationStep(last_event, head, prompt))
+        return steps
 
+    def _event_role(self, character: Character, event: Event) -> str:
+        """Papel del personaje en el evento; su descripción fija está en la biblia del mundo"""
+        return f"{character.name}: {character.describe_event_role(event.title)}"
 
+    def _ask_in_parallel(self, prompts: List[str], prefix: Optional[str] = None) -> List[str]:
+        """
+        Envía los prompts (con el prefijo común, si lo hay) en paralelo con el grado de
+        paralelismo configurado. Si alguno falla se reintenta de forma secuencial para no
+        perder el resto del trabajo.
+        """
+        responses = self.model.ask_many(prompts, concurrency=self.narration_parallelism, return_exceptions=True, prefix=prefix)
+        texts = []
+        for prompt, response in zip(prompts, responses):
+            if isinstance(response, BaseException):
+                print(f"Error en la narración en paralelo, reintentando: {response}")
+                response = self.model.ask(prompt, prefix=prefix)
+            texts.append(response)
+        return texts
+
+    def _iter_in_parallel(self, prompts: List[str], prefix: Optional[str] = None) -> Iterator[Tuple[int, str]]:
+        """
+        Envía los prompts en paralelo y devuelve (índice, respuesta) en el orden de los
+        prompts, cada una en cuanto ella y las anteriores están listas.
+        """
+        ready: Dict[int, str] = {}
+        next_index = 0
+        for i, response in self.model.iter_many(prompts, concurrency=self.narration_parallelism, prefix=prefix):
+            if isinstance(response, BaseException):
+                print(f"Error en la narración en paralelo, reintentando: {response}")
+                response = self.model.ask(prompts[i], prefix=prefix)
+            ready[i] = response
+            while next_index in ready:
+                yield next_index, ready.pop(next_index)
+                next_index += 1
+
+    def _stitch_prompts(self, drafts: List[str]) -> List[str]:
+        """
+        Prompts de la segunda pasada de la narración especulativa: reescribir cada borrador
+        (salvo el primero) para que continúe de forma natural el borrador anterior. Todas
+        las reescrituras son independientes entre sí, así que cada pasaje se cose con el
+        borrador del anterior y no con su versión revisada; el prompt lo advierte para que
+        solo se use como referencia de dónde termina la escena.
+        """
+        return [
+            "Eres un editor literario. A continuación tienes dos pasajes consecutivos de una historia que se escribieron por separado.\n"
+            "Reescribe solo el segundo pasaje para que continúe de forma natural al primero: ajusta las transiciones, las referencias temporales "
+            "y la situación de los personajes, elimina lo que repita el primer pasaje y conserva su contenido, estilo y longitud.\n"
+            "El primer pasaje es un borrador que también se está revisando: úsalo solo como referencia de dónde termina la escena "
+            "y en qué situación quedan los personajes, sin copiar sus frases.\n"
+            "Devuelve solo el texto del segundo pasaje reescrito, sin comentarios adicionales y en español.\n\n"
+            f"Pasaje anterior (borrador):\n{previous}\n\n"
+            f"Pasaje a reescribir:\n{draft}\n\n"
+            "Pasaje reescrito:"
+            for previous, draft in zip(drafts[:-1], drafts[1:])
+        ]
 
     def update_entities_in_events(self, events: List[Event], entities: List[Entity]) -> None:
         """
@@ -0,0 +1,192 @@
+import re
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+from ConversationalAgents.RateLimiter import estimate_tokens
+from PlotMind.EmbeddingModels import DEFAULT_EMBEDDING_MODEL, get_embedding_model, get_profile
+from StorySpace.Event import Event
+
+# Fin de la primera frase de una descripción
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+@dataclass
+class PromptBudget:
+    """
+    Tokens máximos de cada sección del prompt de eventos y del prompt completo. Las secciones
+    que no caben se recortan (ver PromptBuilder); total solo avisa, no recorta.
+    """
+    total: int = 6000
+    events: int = 2500
+    rules: int = 400
+    characters: int = 800
+    locations: int = 500
+    items: int = 500
+    # Fracción del presupuesto de eventos que se dedica a los más recientes con su descripción
+    # completa y, sumada a la anterior, a los siguientes con título y primera frase (ver events_section)
+    recent_share: float = 0.5
+    detailed_share: float = 0.8
+
+
+def first_sentence(text: str) -> str:
+    return _SENTENCE_END.split(text.strip(), maxsplit=1)[0]
+
+
+class PromptBuilder:
+    def __init__(self,
+                 budget: Optional[PromptBudget] = None,
+                 token_counter: Callable[[str], int] = estimate_tokens,
+                 model_name: str = DEFAULT_EMBEDDING_MODEL):
+        """
+        Construye prompts por secciones, cada una con su presupuesto de tokens, para que el
+        tamaño del prompt no crezca con la historia. Los eventos antiguos se resumen cada vez
+        más (ver events_section) y de las entidades solo entran las más relevantes según su
+        similitud con la consulta (ver entities_section).
+
+        Args:
+            budget: Presupuestos de tokens por sección
+            token_counter: Función que cuenta los tokens de un texto (por defecto una estimación
+                local, sin llamar al proveedor)
+            model_name: Modelo de embeddings con el que se ordenan las entidades por relevancia
+        """
+        self.budget = budget or PromptBudget()
+        self.count = token_counter
+        self.model_name = model_name
+        # Tokens, elementos incluidos y descartados de cada sección del último prompt
+        self.report: Dict[str, Dict[str, int]] = {}
+        # Embeddings de los textos de las entidades, que no cambian entre lotes de eventos
+        self._embeddings: Dict[str, np.ndarray] = {}
+
+    def reset(self) -> None:
+        """Empieza un prompt nuevo (la caché de embeddings se conserva)"""
+        self.report = {}
+
+    def fit(self, name: str, items: Sequence[str], budget: int, separator: str = ", ") -> str:
+        """
+        Une los elementos, en orden, mientras quepan en budget tokens; el resto se descarta.
+        Se registra en self.report cuánto ocupa la sección.
+        """
+        included: List[str] = []
+        tokens = 0
+        separator_tokens = self.count(separator) if separator.strip() else 0
+        for item in items:
+            item_tokens = self.count(item) + (separator_tokens if included else 0)
+            if tokens + item_tokens > budget:
+                break
+            included.append(item)
+            tokens += item_tokens
+        self.report[name] = {"tokens": tokens, "included": len(included), "dropped": len(items) - len(included)}
+        return separator.join(included)
+
+    def events_section(self, events: Sequence[Event], budget: Optional[int] = None) -> str:
+        """
+        Eventos de la historia, en orden, dentro de budget tokens y con más detalle cuanto más
+        recientes: los últimos con su descripción completa, los anteriores con título y primera
+        frase, después solo con el título y los más antiguos agrupados por parte narrativa
+        (cuántos son, el primero y el último). Los resúmenes son extractivos, sin llamar al modelo.
+        """
+        budget = self.budget.events if budget is None else budget
+        limits = (self.budget.recent_share * budget, self.budget.detailed_share * budget, budget)
+        levels: List[Callable[[Event], str]] = [
+            lambda e: e.description,
+            lambda e: f"{e.title}: {first_sentence(e.description)}",
+            lambda e: e.title,
+        ]
+
+        lines: List[str] = []
+        tokens = 0
+        level = 0
+        remaining = list(events)
+        while remaining and level < len(levels):
+            line = levels[level](remaining[-1])
+            line_tokens = self.count(line) + 1
+            if tokens + line_tokens > limits[level]:
+                level += 1
+                continue
+            lines.append(line)
+            tokens += line_tokens
+            remaining.pop()
+
+        summarized = len(remaining)
+        if remaining:
+            groups = self._group_summaries(remaining)
+            if tokens + sum(self.count(group) + 1 for group in groups) > budget:
+                groups = [f"{len(remaining)} eventos anteriores"]
+            lines.extend(reversed(groups))
+            tokens += sum(self.count(group) + 1 for group in groups)
+
+        self.report["events"] = {"tokens": tokens, "included": len(events) - summarized, "summarized": summarized}
+        return " - ".join(reversed(lines))
+
+    def _group_summaries(self, events: List[Event]) -> List[str]:
+        """Resume los eventos consecutivos de una misma parte narrativa en una línea"""
+        groups: List[List[Event]] = []
+        for event in events:
+            if groups and groups[-1][0].narrative_part == event.narrative_part:
+                groups[-1].append(event)
+            else:
+                groups.append([event])
+        summaries = []
+        for group in groups:
+            part = f" ({group[0].narrative_part})" if group[0].narrative_part else ""
+            if len(group) == 1:
+                summaries.append(f"1 evento anterior{part}: {group[0].title}")
+            else:
+                summaries.append(f"{len(group)} eventos anteriores{part}, de '{group[0].title}' a '{group[-1].title}'")
+        return summaries
+
+    def entities_section(self,
+                         name: str,
+                         entities: Iterable,
+                         query: str,
+                         budget: int,
+                         mentioned: Iterable[str] = ()) -> str:
+        """
+        Resúmenes de las entidades que caben en budget tokens: primero las mencionadas en los
+        eventos y después el resto, ambas por similitud de su resumen con la consulta.
+
+        Args:
+            name: Nombre de la sección en self.report
+            entities: Personajes, ubicaciones u objetos (con name y description_summary)
+            query: Texto con el que se mide la relevancia (ej: descripción y últimos eventos)
+            budget: Tokens de la sección
+            mentioned: Nombres que aparecen en los eventos
+        """
+        entities = list(entities)
+        if not entities:
+            self.report[name] = {"tokens": 0, "included": 0, "dropped": 0}
+            return ""
+        summaries = [entity.description_summary() for entity in entities]
+        mentioned = set(mentioned)
+
+        total = sum(self.count(summary) + 1 for summary in summaries)
+        if total <= budget:
+            order = range(len(entities))  # Caben todas: no hace falta calcular embeddings
+        else:
+            scores = self._similarities(query, summaries)
+            order = sorted(range(len(entities)), key=lambda i: (entities[i].name not in mentioned, -scores[i]))
+        return self.fit(name, [summaries[i] for i in order], budget)
+
+    def _similarities(self, query: str, texts: List[str]) -> np.ndarray:
+        """Similitud coseno de cada texto con la consulta, con los textos en caché entre prompts"""
+        profile = get_profile(self.model_name)
+        model = get_embedding_model(self.model_name)
+        missing = [text for text in dict.fromkeys(texts) if text not in self._embeddings]
+        if missing:
+            embeddings = model.encode(profile.passages(missing), convert_to_tensor=False, normalize_embeddings=True)
+            self._embeddings.update(zip(missing, np.asarray(embeddings, dtype='float32')))
+        query_embedding = np.asarray(model.encode(profile.queries([query]), convert_to_tensor=False,
+                                                  normalize_embeddings=True), dtype='float32')[0]
+        return np.stack([self._embeddings[text] for text in texts]) @ query_embedding
+
+    def check(self, prompt: str) -> int:
+        """
+        Cuenta los tokens del prompt antes de enviarlo y avisa si supera el presupuesto total
+        """
+        tokens = self.count(prompt)
+        self.report["total"] = {"tokens": tokens, "budget": self.budget.total}
+        if tokens > self.budget.total:
+            print(f"Aviso: el prompt ocupa {tokens} tokens, más que el presupuesto de {self.budget.total}")
+        return tokens
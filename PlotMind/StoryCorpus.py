@@ -0,0 +1,358 @@
+import json
+import os
+import threading
+from typing import Dict, List, Optional, Tuple, Union
+
+import faiss
+import numpy as np
+from dotenv import load_dotenv
+
+from PlotMind import IndexPersistence
+from PlotMind.ContextRetrieval import event_metadata
+from PlotMind.EmbeddingModels import DEFAULT_EMBEDDING_BACKEND, DEFAULT_EMBEDDING_MODEL, get_embedding_model, get_profile
+from PlotMind.IndexFactory import flat_vectors, search_parameters
+from StorySpace.Event import Event
+
+load_dotenv()
+
+# Los ids de FAISS del corpus llevan el número de historia en los bits altos y el número del
+# evento dentro de la historia en los bajos, así cada historia ocupa un rango de ids
+STORY_SHIFT = 32
+EVENT_MASK = (1 << STORY_SHIFT) - 1
+
+
+def story_range(story_number: int) -> Tuple[int, int]:
+    """Rango [inicio, fin) de ids de FAISS de una historia"""
+    return story_number << STORY_SHIFT, (story_number + 1) << STORY_SHIFT
+
+
+def story_number_of(event_id: int) -> int:
+    return int(event_id) >> STORY_SHIFT
+
+
+class StoryCorpus:
+    def __init__(self,
+                 model_name: str = DEFAULT_EMBEDDING_MODEL,
+                 path: Optional[str] = None,
+                 duplicate_threshold: float = 0.95,
+                 backend: str = DEFAULT_EMBEDDING_BACKEND,
+                 save_every: int = 0):
+        """
+        Corpus de eventos de muchas historias en un único índice FAISS compartido por todas
+        las generaciones del proceso. Cada historia tiene su espacio de ids (ver story_range),
+        de modo que se pueden añadir eventos de forma incremental, borrar una historia entera
+        y buscar entre todas las historias o solo en algunas.
+
+        Además del índice de eventos se mantiene otro con un vector resumen por historia
+        (la media normalizada de sus eventos) para detectar tramas casi idénticas.
+
+        Es seguro usarlo desde varios hilos (los workers del StoryService).
+
+        Args:
+            model_name: Modelo de embeddings (el mismo que usa ContextRetrieval); su perfil fija la dimensión
+            path: Ruta donde se guarda el corpus (ver save y load)
+            duplicate_threshold: Similitud entre resúmenes a partir de la que dos historias se
+                consideran duplicadas
+            backend: Backend de inferencia del modelo (ver EMBEDDING_BACKENDS)
+            save_every: Si es mayor que 0 y hay path, el corpus se guarda cada save_every
+                historias añadidas con add_story, para no perderlas si el proceso termina mal
+        """
+        self.profile = get_profile(model_name)
+        self.model_name = self.profile.model_name
+        self.backend = backend
+        self.dimension = self.profile.dimension
+        self.path = path
+        self.duplicate_threshold = duplicate_threshold
+        self.save_every = save_every
+        # Historias añadidas desde el último save o load
+        self._unsaved = 0
+
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+        self.story_index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+        # Texto y metadatos de cada evento por id de FAISS
+        self.events: Dict[int, Dict] = {}
+        self.story_numbers: Dict[str, int] = {}
+        self._story_names: Dict[int, str] = {}
+        self._story_sums: Dict[int, np.ndarray] = {}
+        self._story_sizes: Dict[int, int] = {}
+        self._next_event: Dict[int, int] = {}
+        self._next_story = 0
+        self._lock = threading.RLock()
+
+    @property
+    def model(self):
+        """
+        Modelo de embeddings, que se carga la primera vez que se codifica un texto: crear o
+        cargar el corpus (ej: al importar el bot) no espera a la carga del modelo
+        """
+        return get_embedding_model(self.model_name, backend=self.backend)
+
+    @classmethod
+    def from_env(cls) -> Optional["StoryCorpus"]:
+        """
+        Crea el corpus en PLOTMIND_CORPUS_PATH si está definida (cargándolo si ya existe) y
+        guardándolo cada PLOTMIND_CORPUS_SAVE_EVERY historias (1 por defecto); si no, devuelve None
+        """
+        path = os.getenv("PLOTMIND_CORPUS_PATH")
+        if not path:
+            return None
+        corpus = cls(path=path, save_every=int(os.getenv("PLOTMIND_CORPUS_SAVE_EVERY", "1")))
+        if os.path.exists(path):
+            corpus.load()
+        return corpus
+
+    def __len__(self) -> int:
+        return self.index.ntotal
+
+    def stories(self) -> List[str]:
+        return list(self.story_numbers)
+
+    def story_size(self, story_id: str) -> int:
+        number = self.story_numbers.get(story_id)
+        return 0 if number is None else self._story_sizes[number]
+
+    def add_story(self, story_id: str, events: List[Event]) -> np.ndarray:
+        """
+        Añade una historia completa, sustituyendo la anterior con el mismo identificador, y
+        guarda el corpus si ya hay save_every historias sin guardar
+        """
+        with self._lock:
+            self.delete_story(story_id)
+            ids = self.add_events(story_id, events)
+            self._unsaved += 1
+            if self.save_every > 0 and self.path is not None and self._unsaved >= self.save_every:
+                self.save()
+            return ids
+
+    def add_events(self, story_id: str, events: List[Event]) -> np.ndarray:
+        """
+        Añade eventos a una historia (creándola si no existe) sin tocar el resto del corpus.
+
+        Returns:
+            Ids de FAISS de los eventos añadidos
+        """
+        if not events:
+            return np.zeros(0, dtype=np.int64)
+        embeddings = self._encode(self.profile.passages(event.description for event in events))
+        metadata = [{**event_metadata(event), "story_id": story_id} for event in events]
+
+        with self._lock:
+            number = self.story_numbers.get(story_id)
+            if number is None:
+                number = self._new_story(story_id)
+            first = self._next_event[number]
+            if first + len(events) > EVENT_MASK:
+                raise ValueError(f"La historia {story_id} supera el máximo de eventos del corpus")
+            ids = (number << STORY_SHIFT) + np.arange(first, first + len(events), dtype=np.int64)
+
+            self.index.add_with_ids(embeddings, ids)
+            for event_id, event, meta in zip(ids, events, metadata):
+                self.events[int(event_id)] = {"text": event.description, "metadata": meta}
+            self._next_event[number] = first + len(events)
+            self._story_sizes[number] += len(events)
+            self._story_sums[number] += embeddings.sum(axis=0)
+            self._update_story_vector(number)
+            return ids
+
+    def delete_story(self, story_id: str) -> int:
+        """Borra todos los eventos de una historia y devuelve cuántos eran"""
+        with self._lock:
+            number = self.story_numbers.pop(story_id, None)
+            if number is None:
+                return 0
+            start, end = story_range(number)
+            removed = self.index.remove_ids(faiss.IDSelectorRange(start, end))
+            self.story_index.remove_ids(np.array([number], dtype=np.int64))
+            for event_id in [i for i in self.events if start <= i < end]:
+                del self.events[event_id]
+            for attribute in (self._story_names, self._story_sums, self._story_sizes, self._next_event):
+                del attribute[number]
+            return int(removed)
+
+    def search(self,
+               query: Union[str, List[str]],
+               k: int = 5,
+               story_ids: Optional[List[str]] = None,
+               exclude_story_ids: Optional[List[str]] = None) -> List[Dict]:
+        """
+        Busca los eventos más parecidos a la consulta en todo el corpus.
+
+        Args:
+            query: Texto o lista de textos (se promedian sus embeddings)
+            k: Número de resultados
+            story_ids: Si se indica, solo se busca en estas historias
+            exclude_story_ids: Historias en las que no se busca (p. ej. la que se está generando)
+
+        Returns:
+            Lista de resultados con texto, similitud, historia y metadatos
+        """
+        texts = [query] if isinstance(query, str) else list(query)
+        query_embedding = self._mean(self.profile.queries(texts))
+
+        with self._lock:
+            # Los selectores tienen que seguir vivos durante la búsqueda
+            selectors = self._story_selector(story_ids, exclude_story_ids)
+            if selectors is None:
+                return []
+            params = search_parameters(self.index, selectors[-1]) if selectors else None
+            distances, indices = self.index.search(query_embedding, k, params=params)
+            return [
+                {
+                    "text": self.events[int(i)]["text"],
+                    "similarity": float(distance),
+                    "story_id": self._story_names[story_number_of(i)],
+                    "metadata": self.events[int(i)]["metadata"],
+                }
+                for i, distance in zip(indices[0], distances[0]) if i >= 0
+            ]
+
+    def similar_stories(self,
+                        story: Union[str, List[Event]],
+                        k: int = 5,
+                        threshold: Optional[float] = None) -> List[Tuple[str, float]]:
+        """
+        Historias del corpus con la trama más parecida, comparando sus vectores resumen.
+
+        Args:
+            story: Identificador de una historia del corpus o lista de eventos de una historia nueva
+            k: Número de historias
+            threshold: Si se indica, solo se devuelven las que tienen al menos esta similitud
+
+        Returns:
+            Lista de (identificador de la historia, similitud), de más a menos parecida
+        """
+        if not isinstance(story, str):
+            if not story:
+                return []
+            summary = self._mean(self.profile.passages(event.description for event in story))
+
+        with self._lock:
+            own = None
+            if isinstance(story, str):
+                own = self.story_numbers.get(story)
+                if own is None:
+                    raise KeyError(f"La historia {story} no está en el corpus")
+                summary = self._summary(own)[None, :]
+            n_results = min(k + (own is not None), self.story_index.ntotal)
+            if n_results == 0:
+                return []
+            distances, indices = self.story_index.search(summary, n_results)
+            result = [(self._story_names[int(i)], float(distance))
+                      for i, distance in zip(indices[0], distances[0]) if i >= 0 and i != own]
+        if threshold is not None:
+            result = [(story_id, similarity) for story_id, similarity in result if similarity >= threshold]
+        return result[:k]
+
+    def find_duplicates(self, story: Union[str, List[Event]], threshold: Optional[float] = None) -> List[Tuple[str, float]]:
+        """Historias casi idénticas (similitud de resumen >= threshold, por defecto duplicate_threshold)"""
+        return self.similar_stories(story, k=5, threshold=self.duplicate_threshold if threshold is None else threshold)
+
+    def save(self, path: Optional[str] = None) -> None:
+        """Guarda el corpus (índice y sidecar SQLite con textos, metadatos e historias, ver IndexPersistence)"""
+        path = path or self.path
+        if path is None:
+            raise ValueError("No se ha indicado dónde guardar el corpus")
+        with self._lock:
+            IndexPersistence.save(
+                self.index, path,
+                ((i, event["text"], event["metadata"]) for i, event in self.events.items()),
+                {"model_name": self.model_name, "dimension": self.dimension, "stories": self.story_numbers},
+            )
+            if path == self.path:
+                self._unsaved = 0
+
+    def load(self, path: Optional[str] = None) -> None:
+        """Carga un corpus guardado con save; los vectores resumen se recalculan desde el índice"""
+        path = path or self.path
+        index = IndexPersistence.load_index(path)
+        sidecar = IndexPersistence.load_sidecar(path)
+        if sidecar is None:
+            raise ValueError(f"El corpus {path} no tiene metadatos ({IndexPersistence.sidecar_path(path)})")
+        info, rows = sidecar
+        if info.get("ntotal") != index.ntotal or len(rows) != index.ntotal:
+            raise ValueError(f"El corpus {path} ({index.ntotal} vectores) no corresponde con sus metadatos ({len(rows)} eventos)")
+        if info.get("model_name") != self.model_name:
+            print(f"Aviso: el corpus se creó con {info.get('model_name')} y se consulta con {self.model_name}")
+        if index.d != self.dimension:
+            raise ValueError(f"El corpus {path} tiene dimensión {index.d} y el modelo {self.model_name} {self.dimension}")
+
+        with self._lock:
+            self.index = index
+            self.story_index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.dimension))
+            self.events = {int(i): {"text": text, "metadata": json.loads(metadata)} for i, text, metadata in rows}
+            self.story_numbers = {}
+            self._story_names, self._story_sums, self._story_sizes, self._next_event = {}, {}, {}, {}
+            self._next_story = 0
+            self._unsaved = 0
+            for story_id, number in info.get("stories", {}).items():
+                self._register_story(story_id, int(number))
+
+            ids = faiss.vector_to_array(index.id_map)
+            vectors = flat_vectors(index.index)
+            for number in self._story_names:
+                start, end = story_range(number)
+                in_story = (ids >= start) & (ids < end)
+                self._story_sizes[number] = int(in_story.sum())
+                if self._story_sizes[number]:
+                    self._story_sums[number] = vectors[in_story].sum(axis=0)
+                    self._next_event[number] = int(ids[in_story].max() & EVENT_MASK) + 1
+                self._update_story_vector(number)
+
+    def _new_story(self, story_id: str) -> int:
+        number = self._next_story
+        self._register_story(story_id, number)
+        return number
+
+    def _register_story(self, story_id: str, number: int) -> None:
+        self.story_numbers[story_id] = number
+        self._story_names[number] = story_id
+        self._story_sums[number] = np.zeros(self.dimension, dtype='float32')
+        self._story_sizes[number] = 0
+        self._next_event[number] = 0
+        self._next_story = max(self._next_story, number + 1)
+
+    def _summary(self, number: int) -> np.ndarray:
+        """Vector resumen de una historia: media normalizada de los embeddings de sus eventos"""
+        summary = self._story_sums[number] / max(self._story_sizes[number], 1)
+        return (summary / max(float(np.linalg.norm(summary)), 1e-12)).astype('float32')
+
+    def _update_story_vector(self, number: int) -> None:
+        self.story_index.remove_ids(np.array([number], dtype=np.int64))
+        if self._story_sizes[number]:
+            self.story_index.add_with_ids(self._summary(number)[None, :], np.array([number], dtype=np.int64))
+
+    def _encode(self, texts: List[str]) -> np.ndarray:
+        return np.asarray(self.model.encode(texts, convert_to_tensor=False,
+                                            normalize_embeddings=self.profile.normalize), dtype='float32')
+
+    def _mean(self, texts: List[str]) -> np.ndarray:
+        """Embedding (1, d) medio de los textos, normalizado"""
+        embedding = self._encode(texts).mean(axis=0, keepdims=True)
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+    def _story_selector(self, story_ids: Optional[List[str]], exclude_story_ids: Optional[List[str]]) -> Optional[List[faiss.IDSelector]]:
+        """
+        Selector de FAISS que restringe la búsqueda a rangos de historias. FAISS no copia los
+        selectores, así que se devuelven todos los creados (tienen que seguir vivos durante la
+        búsqueda) y el último es el que se usa. Lista vacía si no hay restricción y None si
+        no queda ninguna historia en la que buscar.
+        """
+        selectors: List[faiss.IDSelector] = []
+        selector = None
+        if story_ids is not None:
+            numbers = [self.story_numbers[story_id] for story_id in story_ids if story_id in self.story_numbers]
+            if not numbers:
+                return None
+            for number in numbers:
+                story = faiss.IDSelectorRange(*story_range(number))
+                selector = story if selector is None else faiss.IDSelectorOr(selector, story)
+                selectors += [story, selector]
+        for story_id in exclude_story_ids or []:
+            number = self.story_numbers.get(story_id)
+            if number is None:
+                continue
+            story = faiss.IDSelectorRange(*story_range(number))
+            excluded = faiss.IDSelectorNot(story)
+            selector = excluded if selector is None else faiss.IDSelectorAnd(selector, excluded)
+            selectors += [story, excluded, selector]
+        return selectors
@@ -0,0 +1,163 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+import itertools
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from PlotMind.PlotMind import PlotMind
+from PlotMind.StoryUpdates import StoryFinished, StoryUpdate
+
+
+class StoryCancelled(Exception):
+    """Se lanza (en el resultado del trabajo) cuando el usuario cancela su historia"""
+
+
+@dataclass
+class StoryJob:
+    """Petición de historia encolada en el StoryService"""
+    job_id: int
+    user_id: int
+    description: str
+    on_update: Optional[Callable[[StoryUpdate], Awaitable[None]]] = None
+    result: Optional[asyncio.Future] = None
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    started: bool = False
+
+
+class StoryService:
+    def __init__(self, workers: int = 2, plotmind_factory: Callable[[], PlotMind] = PlotMind):
+        """
+        Cola de peticiones de historias atendida por un conjunto de workers. Cada historia se
+        genera con su propio PlotMind en un hilo del pool, de modo que el event loop (el bot
+        de Telegram) nunca se bloquea y se atienden varias historias a la vez.
+
+        Args:
+            workers: Número de historias que se generan a la vez
+            plotmind_factory: Crea el PlotMind de cada historia
+        """
+        self.workers = workers
+        self.plotmind_factory = plotmind_factory
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._pending: List[StoryJob] = []
+        self._running: Dict[int, StoryJob] = {}
+        self._tasks: List[asyncio.Task] = []
+        self._ids = itertools.count(1)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def start(self) -> None:
+        """
+        Arranca los workers y el pool de hilos en el event loop actual. Se puede volver a
+        arrancar después de stop (ej: cada run_polling del bot); si ya está arrancado no hace nada.
+        """
+        if self._queue is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="plotmind")
+        self._pending = []
+        self._running = {}
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        """Cancela las historias pendientes y en curso y detiene los workers; si no está arrancado no hace nada"""
+        if self._queue is None:
+            return
+        for job in self._pending + list(self._running.values()):
+            self._cancel_job(job)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._executor = None
+        self._queue = None
+        self._tasks = []
+        self._pending = []
+        self._running = {}
+
+    def submit(self, user_id: int, description: str,
+               on_update: Optional[Callable[[StoryUpdate], Awaitable[None]]] = None) -> StoryJob:
+        """
+        Encola una historia. El resultado se obtiene esperando job.result (la historia
+        final, o StoryCancelled si se cancela).
+
+        Args:
+            user_id: Usuario que pide la historia
+            description: Descripción inicial de la historia
+            on_update: Corrutina que recibe el progreso de la generación (ver PlotMind.stream)
+        """
+        if self._queue is None:
+            raise RuntimeError("El StoryService no se ha arrancado (ver start)")
+        job = StoryJob(next(self._ids), user_id, description, on_update, self._loop.create_future())
+        self._pending.append(job)
+        self._queue.put_nowait(job)
+        return job
+
+    def queued(self) -> int:
+        """Historias que esperan a que un worker quede libre"""
+        return len(self._pending)
+
+    def position(self, job: StoryJob) -> int:
+        """Posición del trabajo en la cola (1 es el siguiente); 0 si ya se está generando"""
+        if job.started:
+            return 0
+        return self._pending.index(job) + 1 if job in self._pending else 0
+
+    def jobs_of(self, user_id: int) -> List[StoryJob]:
+        """Trabajos pendientes o en curso de un usuario"""
+        return [job for job in list(self._running.values()) + self._pending if job.user_id == user_id]
+
+    def cancel(self, user_id: int) -> int:
+        """Cancela las historias pendientes y en curso de un usuario y devuelve cuántas eran"""
+        jobs = self.jobs_of(user_id)
+        for job in jobs:
+            self._cancel_job(job)
+        return len(jobs)
+
+    def _cancel_job(self, job: StoryJob) -> None:
+        job.cancelled.set()
+        if job in self._pending:
+            self._pending.remove(job)
+        if not job.result.done():
+            job.result.set_exception(StoryCancelled(f"Historia {job.job_id} cancelada"))
+
+    async def _worker(self) -> None:
+        while True:
+            job: StoryJob = await self._queue.get()
+            try:
+                if job.cancelled.is_set():
+                    continue
+                self._pending.remove(job)
+                job.started = True
+                self._running[job.job_id] = job
+                try:
+                    story = await self._loop.run_in_executor(self._executor, self._generate, job)
+                    if not job.result.done():
+                        job.result.set_result(story)
+                except Exception as e:
+                    if not job.result.done():
+                        job.result.set_exception(e)
+                finally:
+                    self._running.pop(job.job_id, None)
+            finally:
+                self._queue.task_done()
+
+    def _generate(self, job: StoryJob) -> str:
+        """
+        Genera la historia en un hilo del pool. La cancelación se comprueba entre avisos
+        del pipeline, así que una historia cancelada se detiene al terminar la llamada en curso.
+        """
+        plotmind = self.plotmind_factory()
+        updates = plotmind.stream(job.description)
+        try:
+            for update in updates:
+                if job.cancelled.is_set():
+                    raise StoryCancelled(f"Historia {job.job_id} cancelada")
+                if job.on_update is not None:
+                    asyncio.run_coroutine_threadsafe(job.on_update(update), self._loop)
+                if isinstance(update, StoryFinished):
+                    return update.story
+        finally:
+            updates.close()
+        return plotmind.story
@@ -0,0 +1,42 @@
+from dataclasses import dataclass
+
+
+@dataclass
+class StoryUpdate:
+    """Base de los avisos que emite PlotMind.stream mientras genera la historia"""
+
+
+@dataclass
+class StageStarted(StoryUpdate):
+    """Comienza una etapa del pipeline"""
+    stage: str
+    description: str
+
+
+@dataclass
+class StageFinished(StoryUpdate):
+    """Termina una etapa del pipeline"""
+    stage: str
+    elapsed: float
+
+
+@dataclass
+class PassageChunk(StoryUpdate):
+    """Fragmento de un pasaje que el proveedor está generando en streaming"""
+    index: int
+    title: str
+    text: str
+
+
+@dataclass
+class PassageReady(StoryUpdate):
+    """Pasaje narrado completo, en el orden de la historia"""
+    index: int
+    title: str
+    text: str
+
+
+@dataclass
+class StoryFinished(StoryUpdate):
+    """Historia final, ya editada"""
+    story: str
@@ -0,0 +1,176 @@
+from typing import Optional
+
+import faiss
+import numpy as np
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+# dbscan: DBSCAN sobre el grafo k-NN que da FAISS | kmeans: k-means esférico de FAISS
+CLUSTERING_METHODS = ("dbscan", "kmeans")
+
+
+class SubplotClustering:
+    def __init__(self,
+                 method: str = "dbscan",
+                 eps_factor: float = 1.5,
+                 n_neighbors: int = 16,
+                 n_clusters: Optional[int] = None,
+                 kmeans_iterations: int = 20,
+                 seed: int = 1234):
+        """
+        Agrupa eventos en subtramas usando FAISS tanto para el grafo de vecinos como para
+        asignar de forma incremental los eventos que se añaden después del ajuste.
+
+        Args:
+            method: Uno de CLUSTERING_METHODS
+            eps_factor: En DBSCAN, eps = eps_factor * distancia media al vecino más cercano
+            n_neighbors: En DBSCAN, vecinos que se buscan por evento para construir el grafo
+            n_clusters: En k-means, número de clusters (None: sqrt(n / 2))
+            kmeans_iterations: Iteraciones de k-means
+            seed: Semilla de k-means
+        """
+        if method not in CLUSTERING_METHODS:
+            raise ValueError(f"Método de clustering desconocido '{method}', debe ser uno de {CLUSTERING_METHODS}")
+        self.method = method
+        self.eps_factor = eps_factor
+        self.n_neighbors = n_neighbors
+        self.n_clusters = n_clusters
+        self.kmeans_iterations = kmeans_iterations
+        self.seed = seed
+        self.min_samples: Optional[int] = None
+        self.eps: float = 0.0
+        self.avg_distance: float = 0.0
+        # Índice con los puntos de referencia para la asignación incremental (núcleos en DBSCAN,
+        # centroides en k-means) y el cluster de cada uno
+        self._reference_index: Optional[faiss.Index] = None
+        self._reference_labels: Optional[np.ndarray] = None
+        self._reference_norms: Optional[np.ndarray] = None
+
+    @property
+    def fitted(self) -> bool:
+        return self._reference_index is not None
+
+    def fit(self, embeddings: np.ndarray, min_samples: int, index: Optional[faiss.Index] = None) -> np.ndarray:
+        """
+        Agrupa los embeddings.
+
+        Args:
+            embeddings: Matriz (n, d); la fila i debe ser el vector con id i en index
+            min_samples: Mínimo número de eventos para formar un cluster
+            index: Índice FAISS que ya contiene los embeddings (se usa para el grafo k-NN de
+                DBSCAN); si no se indica se crea uno exacto
+
+        Returns:
+            Cluster de cada evento (-1 es ruido)
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        self.min_samples = min_samples
+        if self.method == "kmeans":
+            return self._fit_kmeans(embeddings, min_samples)
+        return self._fit_dbscan(embeddings, min_samples, index)
+
+    def assign(self, embeddings: np.ndarray) -> np.ndarray:
+        """
+        Asigna eventos nuevos a los clusters ya ajustados sin volver a ajustar: en k-means al
+        centroide más cercano, en DBSCAN al núcleo más cercano si está a menos de eps (si no,
+        ruido). No crea ni fusiona clusters; para eso hay que volver a llamar a fit.
+        """
+        if not self.fitted:
+            raise RuntimeError("El clustering no se ha ajustado (ver fit)")
+        embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        if len(embeddings) == 0 or self._reference_index.ntotal == 0:
+            return np.full(len(embeddings), -1, dtype=np.int64)
+        similarities, ids = self._reference_index.search(embeddings, 1)
+        labels = self._reference_labels[ids[:, 0]]
+        if self.method == "dbscan":
+            distances = self._distances(embeddings, similarities, self._reference_norms[ids])[:, 0]
+            labels = np.where(distances <= self.eps, labels, -1)
+        return labels
+
+    def _fit_kmeans(self, embeddings: np.ndarray, min_samples: int) -> np.ndarray:
+        n = len(embeddings)
+        n_clusters = min(n, self.n_clusters or max(1, int(round(np.sqrt(n / 2)))))
+        kmeans = faiss.Kmeans(embeddings.shape[1], n_clusters, niter=self.kmeans_iterations,
+                              spherical=True, seed=self.seed, verbose=False)
+        kmeans.train(embeddings)
+        _, assignment = kmeans.index.search(embeddings, 1)
+        assignment = assignment[:, 0]
+
+        # Los clusters con menos de min_samples eventos se consideran ruido, como en DBSCAN
+        sizes = np.bincount(assignment, minlength=n_clusters)
+        valid = sizes >= min_samples
+        relabel = np.full(n_clusters, -1, dtype=np.int64)
+        relabel[valid] = np.arange(int(valid.sum()))
+
+        self._reference_index = kmeans.index
+        self._reference_labels = relabel
+        self._reference_norms = None
+        return relabel[assignment]
+
+    def _fit_dbscan(self, embeddings: np.ndarray, min_samples: int, index: Optional[faiss.Index]) -> np.ndarray:
+        n = len(embeddings)
+        if index is None or index.ntotal != n:
+            index = faiss.IndexFlatIP(embeddings.shape[1])
+            index.add(embeddings)
+        norms = np.einsum('ij,ij->i', embeddings, embeddings)
+
+        # Grafo k-NN con el índice de FAISS (incluye al propio punto). Con IVF/PQ las
+        # puntuaciones del índice son aproximadas: los candidatos se puntúan de nuevo con el
+        # producto interno exacto para que eps signifique lo mismo con cualquier backend
+        k = min(n, max(self.n_neighbors, min_samples) + 1)
+        _, neighbors = index.search(embeddings, k)
+        valid = neighbors >= 0
+        safe_neighbors = np.where(valid, neighbors, 0)
+        similarities = self._exact_similarities(embeddings, safe_neighbors)
+        distances = np.where(valid, self._distances(embeddings, similarities, norms[safe_neighbors]), np.inf)
+        distances[neighbors == np.arange(n)[:, None]] = 0.0
+        order = np.argsort(distances, axis=1)
+        distances = np.take_along_axis(distances, order, axis=1)
+        neighbors = np.take_along_axis(safe_neighbors, order, axis=1)
+
+        # eps como en la versión con sklearn: distancia media al vecino más cercano (sin contar el propio punto)
+        self.avg_distance = float(np.mean(distances[:, 1])) if k > 1 else 0.0
+        self.eps = self.avg_distance * self.eps_factor
+
+        within = distances <= self.eps
+        core = within.sum(axis=1) >= min_samples
+
+        # Componentes conexas de los núcleos unidos por aristas de longitud <= eps
+        rows, columns = np.nonzero(within & core[:, None] & core[neighbors])
+        graph = coo_matrix((np.ones(len(rows), dtype=np.int8), (rows, neighbors[rows, columns])), shape=(n, n))
+        _, components = connected_components(graph, directed=False)
+
+        labels = np.full(n, -1, dtype=np.int64)
+        core_ids = np.flatnonzero(core)
+        _, labels[core_ids] = np.unique(components[core_ids], return_inverse=True)
+
+        # Los puntos frontera toman el cluster del núcleo más cercano a menos de eps
+        for i in np.flatnonzero(~core):
+            for neighbor, distance in zip(neighbors[i], distances[i]):
+                if distance > self.eps:
+                    break
+                if core[neighbor]:
+                    labels[i] = labels[neighbor]
+                    break
+
+        self._reference_index = faiss.IndexFlatIP(embeddings.shape[1])
+        if len(core_ids):
+            self._reference_index.add(embeddings[core_ids])
+        self._reference_labels = labels[core_ids]
+        self._reference_norms = norms[core_ids]
+        return labels
+
+    @staticmethod
+    def _exact_similarities(embeddings: np.ndarray, neighbors: np.ndarray, batch_size: int = 1024) -> np.ndarray:
+        """Producto interno exacto de cada punto con sus vecinos, por bloques para acotar la memoria"""
+        similarities = np.empty(neighbors.shape, dtype=np.float32)
+        for start in range(0, len(embeddings), batch_size):
+            end = start + batch_size
+            similarities[start:end] = np.einsum('id,ikd->ik', embeddings[start:end], embeddings[neighbors[start:end]])
+        return similarities
+
+    @staticmethod
+    def _distances(queries: np.ndarray, similarities: np.ndarray, neighbor_norms: np.ndarray) -> np.ndarray:
+        """Distancias euclídeas a partir de productos internos: ||q - x||² = ||q||² + ||x||² - 2 q·x"""
+        query_norms = np.einsum('ij,ij->i', queries, queries)[:, None]
+        return np.sqrt(np.maximum(query_norms + neighbor_norms - 2 * similarities, 0.0))
@@ -1,7 +1,7 @@
 from enum import Enum
 from typing import Dict, List, Optional
-import json
 from ConversationalAgents.ConversationalAgent import ConversationalAgent
+from ConversationalAgents.StructuredOutput import SalvageReport, extract_items
 from StorySpace.Character import Character
 from StorySpace.Event import Event
 
@@ -83,16 +83,21 @@ class EntityRelationship(Relationship):
         }
 
 class RelationshipManager:
-    def __init__(self, model: ConversationalAgent):
+    def __init__(self, model: ConversationalAgent, max_workers: int = 4):
         """
         Gestiona relaciones entre entidades y puede inferir nuevas relaciones.
         
         Args:
             model: Modelo de agente conversacional que se empleará
+            max_workers: Número máximo de chunks procesados a la vez al inferir relaciones
         """
         self.relationships: Dict[str, Relationship] = {}
         self.entities: Dict[str, Dict] = {}
         self.model = model
+        self.max_workers = max_workers
+        self.failed_chunks: List[int] = []
+        # Cómo se ha leído la respuesta de cada petición de la última inferencia (ver salvage_summary)
+        self.salvage_reports: List[SalvageReport] = []
         
     
     def add_entity(self, entity_id: str, entity_data: Dict):
@@ -123,14 +128,21 @@ class RelationshipManager:
     def infer_relationships_from_text(self,                       
                                     existing_entities: List[str],
                                     existing_events: List[Event],
-                                    prompt_template: Optional[str] = None) -> List[Relationship]:
+                                    prompt_template: Optional[str] = None,
+                                    max_workers: Optional[int] = None) -> List[Relationship]:
         """
         Infiere relaciones entre entidades a partir de un texto usando un modelo de lenguaje.
         
+        Los chunks de eventos son independientes, así que todas sus peticiones (relaciones
+        entre eventos y relaciones entre entidades) se envían en paralelo. El resultado se
+        combina en el orden de los chunks y el fallo de una petición solo descarta esa
+        petición; los chunks fallidos quedan registrados en self.failed_chunks.
+        
         Args:
-            text: Texto del cual inferir relaciones
             existing_entities: Lista de entidades existentes
+            existing_events: Lista de eventos de la historia
             prompt_template: Plantilla personalizada para el prompt
+            max_workers: Número máximo de peticiones simultáneas (por defecto self.max_workers)
             
         Returns:
             Lista de relaciones inferidas
@@ -139,40 +151,54 @@ class RelationshipManager:
         all_event_relations = []
         chunk_size = 10 if len(existing_events) > 50 else 5 
         overlap = 3 if len(existing_events) > 50 else 2
+        chunks = list(self.chunk_events(existing_events, chunk_size, overlap))
         
-        # Dividir los eventos en chunks
-        for event_chunk in self.chunk_events(existing_events, chunk_size, overlap):
-            # Construir el prompt para el chunk actual de eventos
-            events_relation_prompt = self._build_events_relationship_prompt(event_chunk)
+        # Para cada chunk: prompt de relaciones entre eventos y prompt de relaciones entre entidades
+        prompts = []
+        for event_chunk in chunks:
+            prompts.append(self._build_events_relationship_prompt(event_chunk))
+            prompts.append(self._build_relationship_prompt(event_chunk, existing_entities, prompt_template))
 
-            # Construir el prompt para entidades (si sigue siendo necesario)
-            prompt = self._build_relationship_prompt(event_chunk, existing_entities, prompt_template)
-            
-            try:
-                # Hacer la llamada a la API para el chunk actual
-                response2 = self.model.ask(events_relation_prompt)
-                
-                # Procesar la respuesta del chunk actual
-                chunk_relations = self._parse_events_relation_from_response(response2)
-                all_event_relations.extend(chunk_relations)
-                
-            except Exception as e:
-                print(f"Error al procesar chunk de eventos: {e}")
-                continue
-        
-            try:
-                # Procesar las relaciones de entidades
-                response = self.model.ask(prompt)
-                new_relationships = self._parse_relationships_from_response(response)
-                
-                # Combinar todas las relaciones
-                all_event_relations.extend(new_relationships)
-                
-            except Exception as e:
-                print(f"Error al inferir relaciones de entidades: {e}")
-                return all_event_relations  # Devolver al menos las relaciones de eventos que sí se procesaron
-            
+        responses = self.model.ask_many(prompts, concurrency=max_workers or self.max_workers, return_exceptions=True)
+
+        self.failed_chunks = []
+        self.salvage_reports = []
+        for i in range(len(chunks)):
+            events_response, entities_response = responses[2 * i], responses[2 * i + 1]
+
+            if isinstance(events_response, BaseException):
+                print(f"Error al procesar chunk de eventos {i}: {events_response}")
+                self.failed_chunks.append(i)
+            else:
+                all_event_relations.extend(self._parse_events_relation_from_response(events_response, chunk=i))
+
+            if isinstance(entities_response, BaseException):
+                print(f"Error al inferir relaciones de entidades en el chunk {i}: {entities_response}")
+                if i not in self.failed_chunks:
+                    self.failed_chunks.append(i)
+            else:
+                all_event_relations.extend(self._parse_relationships_from_response(entities_response, chunk=i))
+
+        summary = self.salvage_summary()
+        if summary["repaired"] or summary["salvaged"] or summary["failed"]:
+            print(f"Lectura de relaciones por chunk: {summary}")
         return all_event_relations
+
+    def salvage_summary(self) -> Dict[str, int]:
+        """
+        Resumen de cómo se leyeron las respuestas de la última inferencia: cuántas eran JSON
+        válido, cuántas se repararon enteras, cuántas se recuperaron objeto a objeto y cuántas
+        no aportaron nada, junto con las relaciones recuperadas y descartadas.
+        """
+        summary = {mode: 0 for mode in ("parsed", "repaired", "salvaged", "failed")}
+        summary.update(relations=0, salvaged_relations=0, dropped=0, truncated=0)
+        for report in self.salvage_reports:
+            summary[report.mode] += 1
+            summary["relations"] += report.items
+            summary["salvaged_relations"] += report.items if report.mode in ("repaired", "salvaged") else 0
+            summary["dropped"] += report.invalid
+            summary["truncated"] += report.truncated
+        return summary
         
     def _build_events_relationship_prompt(self, events: List[Event]) -> str:
         """
@@ -231,76 +257,56 @@ class RelationshipManager:
         
         return prompt
     
-    def _parse_relationships_from_response(self, response_text: str) -> List[EntityRelationship]:
+    def _parse_relationships_from_response(self, response_text: str, chunk: Optional[int] = None) -> List[EntityRelationship]:
         """
-        Parsea la respuesta de Gemini a objetos Relationship.
+        Parsea la respuesta de Gemini a objetos Relationship. Si el JSON está mal formado o
+        truncado se recuperan todas las relaciones completas (ver extract_items).
         """
-        try:
-            # Limpiar la respuesta
-            clean_response = response_text.strip()
-            if clean_response.startswith("```json"):
-                clean_response = clean_response[7:]
-            if clean_response.endswith("```"):
-                clean_response = clean_response[:-3]
-                
-            # Parsear JSON
-            data = json.loads(clean_response)
-            relationships_data = data.get("relationships", [])
-            #print("Relaciones entre entidades:", json.dumps(data, indent=2, ensure_ascii=False))
-            
-            # Crear objetos Relationship
-            new_relationships = []
-            for rel_data in relationships_data:
-                relationship = EntityRelationship(
-                    entity1=rel_data["entity1"],
-                    entity2=rel_data["entity2"],
-                    relationship_type=rel_data["relationship_type"],
-                    description=rel_data["description"],
-                    mutual=bool(rel_data.get("mutual", True)),
-                    bidirectional=bool(rel_data.get("bidirectional", False))
-                )
-                new_relationships.append(relationship)
-            
-            return new_relationships
-            
-        except (json.JSONDecodeError, KeyError) as e:
-            print(f"Error parseando relaciones: {e}")
-            print(f"Respuesta recibida: {response_text}")
-            return []
+        relationships_data = self._extract_relationships(
+            response_text, chunk, "entidades", ("entity1", "entity2", "relationship_type", "description"))
         
-    def _parse_events_relation_from_response(self, response_text: str) -> List[Relationship]:
+        # Crear objetos Relationship
+        return [
+            EntityRelationship(
+                entity1=rel_data["entity1"],
+                entity2=rel_data["entity2"],
+                relationship_type=rel_data["relationship_type"],
+                description=rel_data["description"],
+                mutual=bool(rel_data.get("mutual", True)),
+                bidirectional=bool(rel_data.get("bidirectional", False))
+            )
+            for rel_data in relationships_data
+        ]
+        
+    def _parse_events_relation_from_response(self, response_text: str, chunk: Optional[int] = None) -> List[Relationship]:
         """
-        Parsea la respuesta de Gemini a objetos EventRelationship.
+        Parsea la respuesta de Gemini a objetos EventRelationship, recuperando todas las
+        relaciones completas aunque el JSON esté mal formado o truncado.
         """
-        try:
-            # Limpiar la respuesta
-            clean_response = response_text.strip()
-            if clean_response.startswith("```json"):
-                clean_response = clean_response[7:]
-            if clean_response.endswith("```"):
-                clean_response = clean_response[:-3]
-                
-            # Parsear JSON
-            data = json.loads(clean_response)
-            relationships_data = data.get("relationships", [])
-            #print("Relaciones entre eventos:", json.dumps(data, indent=2, ensure_ascii=False))
-            
-            # Crear objetos EventRelationship
-            new_relationships = []
-            for rel_data in relationships_data:
-                relationship = Relationship(
-                    entity1=rel_data["event1"],
-                    entity2=rel_data["event2"],
-                    relationship_type=rel_data["relationship_type"]     
-                )
-                new_relationships.append(relationship)
-            
-            return new_relationships
-                
-        except (json.JSONDecodeError, KeyError) as e:
-            print(f"Error parseando relaciones entre eventos: {e}")
+        relationships_data = self._extract_relationships(
+            response_text, chunk, "eventos", ("event1", "event2", "relationship_type"))
+        
+        # Crear objetos EventRelationship
+        return [
+            Relationship(
+                entity1=rel_data["event1"],
+                entity2=rel_data["event2"],
+                relationship_type=rel_data["relationship_type"]     
+            )
+            for rel_data in relationships_data
+        ]
+
+    def _extract_relationships(self, response_text: str, chunk: Optional[int], kind: str, required: tuple) -> List[Dict]:
+        """Lista "relationships" de la respuesta; registra cómo se ha leído en salvage_reports"""
+        relationships_data, report = extract_items(response_text, "relationships", required)
+        report.chunk, report.kind = chunk, kind
+        self.salvage_reports.append(report)
+        if report.mode == "failed":
+            print(f"Error parseando relaciones entre {kind} (chunk {chunk})")
             print(f"Respuesta recibida: {response_text}")
-            return []
+        elif report.mode != "parsed":
+            print(f"Relaciones entre {kind} del chunk {chunk}: {report.items} recuperadas ({report.mode}), {report.invalid} descartadas")
+        return relationships_data
     
 
     def verify_subplot(self, events):
@@ -313,7 +319,7 @@ class RelationshipManager:
         - "faltantes": ["introducción", "conflicto", "resolución"],
         - "coherencia": 1-10
         """
-        response = self.model.clean_answer(self.model.ask(prompt))
+        response = self.model.ask_json(prompt)
         return response
     
 
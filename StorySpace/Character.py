@@ -197,11 +197,15 @@ class Character (Entity):
     
 
     def describe_character_with_event(self, evento):
+        return self.describe_character() + "\n" + self.describe_event_role(evento)
+
+    def describe_character(self) -> str:
+        """Descripción del personaje que no depende del evento (para prefijos estables de los prompts)"""
         personality_str = ""
         if isinstance(self.personality, dict):
             personality_str = "\n".join([f"  - {trait}: {desc}" for trait, desc in self.personality.items()])
 
-        descripcion = (
+        return (
             f"Nombre: {self.name}\n"
             f"Rol: {self.role}\n"
             f"Personalidad:\n{personality_str}\n"
@@ -210,12 +214,14 @@ class Character (Entity):
             f"Fortalezas: {', '.join(self.strengths) if self.strengths else 'Ninguna'}\n"
             f"Debilidades: {', '.join(self.flaws) if self.flaws else 'Ninguna'}\n"
         )
-        
-        # Añadir motivaciones, metas y acciones según el evento
+
+    def describe_event_role(self, evento) -> str:
+        """Motivaciones, metas y acciones del personaje en el evento"""
+        descripcion = ""
         if evento in self.motivations:
-            descripcion += f"\nMotivaciones en '{evento}': {self.motivations[evento]}\n"
+            descripcion += f"Motivaciones en '{evento}': {self.motivations[evento]}\n"
         else:
-            descripcion += f"\nMotivaciones en '{evento}': No especificadas\n"
+            descripcion += f"Motivaciones en '{evento}': No especificadas\n"
         
         if evento in self.goals:
             descripcion += f"Metas en '{evento}': {self.goals[evento]}\n"
@@ -7,7 +7,11 @@ from dotenv import load_dotenv
 from telegram import Update, Bot
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 
+from PlotMind.EmbeddingModels import warmup
 from PlotMind.PlotMind import PlotMind
+from PlotMind.StoryCorpus import StoryCorpus
+from PlotMind.StoryService import StoryCancelled, StoryService
+from PlotMind.StoryUpdates import StageStarted
 
 # Configuración básica de logging
 logging.basicConfig(
@@ -19,12 +23,17 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 TOKEN = os.getenv("BOT_TOKEN")
 
-# Variable global para el lock
-procesamiento_lock = asyncio.Lock()
+# Corpus de historias compartido por todas las generaciones (PLOTMIND_CORPUS_PATH; None si no está definida).
+# Su modelo de embeddings no se carga aquí sino en precargar_embeddings o en la primera historia
+corpus = StoryCorpus.from_env()
 
-async def procesar_pedido(texto: str) -> str:
-    plotMind = PlotMind()
-    return plotMind.run(texto)
+# Cola de historias atendida por varios workers (STORY_WORKERS historias a la vez)
+story_service = StoryService(workers=int(os.getenv("STORY_WORKERS", "2")),
+                             plotmind_factory=lambda: PlotMind(corpus=corpus))
+
+async def procesar_pedido(texto: str, user_id: int = 0) -> str:
+    job = story_service.submit(user_id, texto)
+    return await job.result
 
 
 async def obtener_mensajes_pendientes(application):
@@ -48,7 +57,7 @@ async def obtener_mensajes_pendientes(application):
                 logger.info(f"Mensaje pendiente de {user_id}: {texto}")
                 
                 # Procesar el pedido
-                respuesta = procesar_pedido(texto)
+                respuesta = await procesar_pedido(texto, user_id)
                 
                 # Enviar respuesta al usuario
                 await application.bot.send_message(
@@ -76,6 +85,14 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ¡Cuantos más detalles me des, más personalizada y emocionante será tu historia! 🚀📝"""
     )
 
+async def cancelar(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Maneja el comando /cancelar: cancela las historias pendientes o en curso del usuario"""
+    canceladas = story_service.cancel(update.effective_user.id)
+    if canceladas:
+        await update.message.reply_text("🛑 He cancelado tu historia.")
+    else:
+        await update.message.reply_text("No tienes ninguna historia en preparación.")
+
 # Añade estas variables globales al inicio del archivo
 EVALUACION_PREGUNTAS = [
     "¿Cómo calificarías la facilidad de generar nuevas narrativas usando la herramienta (Facilidad de Uso)?\nDesde Complicado (1) hasta Fácil (10)",
@@ -208,64 +225,114 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if texto.isdigit() and 1 <= int(texto) <= 10:
         return  # Deja que handle_evaluacion maneje esto
     
-    # Verificar si es un comando (no aplicar lock a comandos)
+    # Verificar si es un comando (los manejan sus handlers específicos)
     if texto.startswith('/'):
         return  # Los comandos son manejados por sus handlers específicos
     
+    # El mensaje de "procesando" se crea antes de encolar la historia, para que el progreso
+    # tenga dónde mostrarse desde el primer aviso
+    antes = story_service.queued()
     mensaje_procesando = await update.message.reply_text(
         "🛠️ Estoy creando tu historia...\n"
         "Esto puede tomar varios minutos dependiendo de la complejidad y la generación de otras historias.\n"
-        "¡Te avisaré cuando esté listo!"
+        + (f"Hay {antes} historias antes que la tuya.\n" if antes > 0 else "")
+        + "¡Te avisaré cuando esté listo! Puedes cancelarla con /cancelar."
     )
-    async with procesamiento_lock:  # Solo aplica lock a procesamiento de pedidos
-        try:
-            respuesta = await procesar_pedido(texto)
-            
-            # Dividir la respuesta en partes si es muy larga
-            max_chars = 3000
-            if len(respuesta) > max_chars:
-                partes = respuesta.split('\n\n')
-                partes_finales = []
-                for parte in partes:
-                    if len(parte) > max_chars:
-                        for i in range(0, len(parte), max_chars):
-                            partes_finales.append(parte[i:i+max_chars])
-                    else:
-                        partes_finales.append(parte)
-                
-                # Eliminar mensaje de "procesando" antes de enviar las partes
-                await context.bot.delete_message(chat_id=user_id, message_id=mensaje_procesando.message_id)
-                
-                for i, parte in enumerate(partes_finales, 1):
-                    await update.message.reply_text(
-                        f"Parte {i}/{len(partes_finales)}:\n\n{parte}"
-                    )
-                    await asyncio.sleep(0.5)
-            else:
-                # Eliminar mensaje de "procesando" y enviar respuesta completa
-                await context.bot.delete_message(chat_id=user_id, message_id=mensaje_procesando.message_id)
-                await update.message.reply_text(respuesta)
+
+    async def avisar_progreso(update_historia):
+        # Se muestra la etapa del pipeline en el mensaje de "procesando"
+        if isinstance(update_historia, StageStarted):
+            try:
+                await context.bot.edit_message_text(
+                    chat_id=user_id,
+                    message_id=mensaje_procesando.message_id,
+                    text=f"🛠️ Estoy creando tu historia...\n{update_historia.description}..."
+                )
+            except Exception as e:
+                logger.debug(f"No se pudo actualizar el progreso: {e}")
+
+    job = story_service.submit(user_id, texto, on_update=avisar_progreso)
+    # La entrega se hace en otra tarea para no bloquear el resto de handlers mientras se genera
+    context.application.create_task(entregar_historia(update, context, job, mensaje_procesando))
+
+async def entregar_historia(update: Update, context: ContextTypes.DEFAULT_TYPE, job, mensaje_procesando):
+    """Espera a que el StoryService termine la historia y la envía al usuario"""
+    user_id = job.user_id
+    texto = job.description
+    try:
+        respuesta = await job.result
+
+        # Dividir la respuesta en partes si es muy larga
+        max_chars = 3000
+        if len(respuesta) > max_chars:
+            partes = respuesta.split('\n\n')
+            partes_finales = []
+            for parte in partes:
+                if len(parte) > max_chars:
+                    for i in range(0, len(parte), max_chars):
+                        partes_finales.append(parte[i:i+max_chars])
+                else:
+                    partes_finales.append(parte)
             
-            evaluaciones_en_curso[user_id] = {
-                'mensaje_original': texto,
-                'pregunta_actual': 0,
-                'respuestas': {}
-            }
-            await enviar_pregunta_evaluacion(user_id, context)
+            # Eliminar mensaje de "procesando" antes de enviar las partes
+            await context.bot.delete_message(chat_id=user_id, message_id=mensaje_procesando.message_id)
             
-        except Exception as e:
-            logger.error(f"Error al procesar pedido: {e}")
-            # Asegurarse de eliminar el mensaje de "procesando" incluso si hay error
+            for i, parte in enumerate(partes_finales, 1):
+                await update.message.reply_text(
+                    f"Parte {i}/{len(partes_finales)}:\n\n{parte}"
+                )
+                await asyncio.sleep(0.5)
+        else:
+            # Eliminar mensaje de "procesando" y enviar respuesta completa
             await context.bot.delete_message(chat_id=user_id, message_id=mensaje_procesando.message_id)
-            await update.message.reply_text("❌ Ocurrió un error al procesar tu solicitud. Por favor, inténtalo de nuevo.")
+            await update.message.reply_text(respuesta)
+        
+        evaluaciones_en_curso[user_id] = {
+            'mensaje_original': texto,
+            'pregunta_actual': 0,
+            'respuestas': {}
+        }
+        await enviar_pregunta_evaluacion(user_id, context)
+
+    except StoryCancelled:
+        logger.info(f"Historia {job.job_id} de {user_id} cancelada")
+        await context.bot.delete_message(chat_id=user_id, message_id=mensaje_procesando.message_id)
+        
+    except Exception as e:
+        logger.error(f"Error al procesar pedido: {e}")
+        # Asegurarse de eliminar el mensaje de "procesando" incluso si hay error
+        await context.bot.delete_message(chat_id=user_id, message_id=mensaje_procesando.message_id)
+        await update.message.reply_text("❌ Ocurrió un error al procesar tu solicitud. Por favor, inténtalo de nuevo.")
+
+async def precargar_embeddings():
+    """Carga el modelo de embeddings en un hilo, sin retrasar el arranque del bot"""
+    logger.info("Cargando el modelo de embeddings...")
+    try:
+        await asyncio.to_thread(warmup)
+        logger.info("Modelo de embeddings cargado")
+    except Exception as e:
+        logger.error(f"No se ha podido precargar el modelo de embeddings: {e}")
+
+async def iniciar_servicio(application):
+    """Arranca los workers de historias en el event loop del bot y precarga en segundo plano el modelo de embeddings"""
+    await story_service.start()
+    if os.getenv("EMBEDDING_WARMUP", "1") != "0":
+        application.create_task(precargar_embeddings())
+
+async def detener_servicio(application):
+    await story_service.stop()
+    if corpus is not None:
+        logger.info(f"Guardando el corpus de historias ({len(corpus)} eventos) en {corpus.path}")
+        await asyncio.to_thread(corpus.save)
 
 def main():
     """Configura y ejecuta el bot"""
     # Crear aplicación
-    application = Application.builder().token(TOKEN).build()
+    application = Application.builder().token(TOKEN).post_init(iniciar_servicio).post_shutdown(detener_servicio).build()
     
     # Manejar comandos (se ejecutan inmediatamente)
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("cancelar", cancelar))
     
     # Primero añadir el handler de evaluaciones (con mayor prioridad)
     application.add_handler(MessageHandler(
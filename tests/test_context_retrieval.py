@@ -0,0 +1,63 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("sentence_transformers")
+
+from PlotMind import ContextRetrieval as context_retrieval
+from StorySpace.Event import Event
+
+DIMENSION = 384  # e5-small
+
+
+def unit(*components):
+    vector = np.zeros(DIMENSION, dtype="float32")
+    for axis, value in components:
+        vector[axis] = value
+    return vector / np.linalg.norm(vector)
+
+
+# Embedding de cada texto, sin el prefijo "query: " o "passage: " de e5
+VECTORS = {
+    "el viaje": unit((0, 1.0)),
+    "la tormenta": unit((1, 1.0)),
+    "viaje en la tormenta": unit((0, 1.0), (1, 1.0)),
+    "viaje al mercado": unit((0, 0.9), (2, 0.436)),
+    "tormenta en el puerto": unit((1, 0.8), (3, 0.6)),
+    "una boda": unit((4, 1.0)),
+}
+
+
+class FakeModel:
+    """Codifica con VECTORS en lugar de cargar el modelo de embeddings"""
+
+    def encode(self, texts, convert_to_tensor=False, normalize_embeddings=False):
+        return np.stack([VECTORS[text.split(": ", 1)[-1]] for text in texts])
+
+
+@pytest.fixture
+def retriever(monkeypatch):
+    monkeypatch.setattr(context_retrieval, "get_embedding_model", lambda *args, **kwargs: FakeModel())
+    retriever = context_retrieval.ContextRetrieval(model_name="e5-small")
+    retriever.add_events([
+        Event(title=text, description=text)
+        for text in ("viaje en la tormenta", "viaje al mercado", "tormenta en el puerto", "una boda")
+    ])
+    return retriever
+
+
+def test_window_query_ranks_by_centroid(retriever):
+    # Con solo el primer evento de la ventana "viaje al mercado" iría primero
+    context = retriever.get_context(["el viaje", "la tormenta"], k=3)
+    assert [result["text"] for result in context] == ["viaje en la tormenta", "viaje al mercado", "tormenta en el puerto"]
+    assert context[0]["similarity"] == pytest.approx(1.0, abs=1e-5)
+
+
+def test_batch_matches_single_queries(retriever):
+    windows = [["el viaje", "la tormenta"], ["el viaje"]]
+    batch = retriever.get_context_batch(windows, k=3)
+    retriever.result_cache.clear()
+    for window, context in zip(windows, batch):
+        single = retriever.get_context(window, k=3)
+        assert [result["text"] for result in context] == [result["text"] for result in single]
+        assert [result["similarity"] for result in context] == pytest.approx([result["similarity"] for result in single], abs=1e-5)
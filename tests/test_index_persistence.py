@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+np = pytest.importorskip("numpy")
+faiss = pytest.importorskip("faiss")
+
+from PlotMind import IndexPersistence
+
+
+def resident_memory() -> int:
+    """Memoria residente del proceso en bytes (Linux)"""
+    with open("/proc/self/statm") as statm:
+        return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def save_flat_index(path, n=50_000, d=128, seed=0):
+    vectors = np.random.default_rng(seed).standard_normal((n, d)).astype("float32")
+    faiss.normalize_L2(vectors)
+    index = faiss.IndexFlatIP(d)
+    index.add(vectors)
+    rows = ((i, f"evento {i}", {}) for i in range(n))
+    IndexPersistence.save(index, str(path), rows, {"dimension": d})
+    return index, vectors
+
+
+def test_mmap_load_returns_same_results(tmp_path):
+    path = tmp_path / "events.index"
+    index, vectors = save_flat_index(path)
+
+    mapped = IndexPersistence.load_index(str(path), mmap=True)
+    assert mapped.ntotal == index.ntotal
+    expected = index.search(vectors[:10], 5)
+    found = mapped.search(vectors[:10], 5)
+    np.testing.assert_array_equal(found[1], expected[1])
+    np.testing.assert_allclose(found[0], expected[0], rtol=1e-6)
+
+
+@pytest.mark.skipif(not hasattr(faiss, "IO_FLAG_MMAP_IFC") or not os.path.exists("/proc/self/statm"),
+                    reason="Solo IO_FLAG_MMAP_IFC proyecta los índices flat")
+def test_mmap_load_does_not_read_vectors(tmp_path):
+    path = tmp_path / "events.index"
+    index, vectors = save_flat_index(path)
+    size = os.path.getsize(path)
+    del index, vectors
+
+    before = resident_memory()
+    mapped = IndexPersistence.load_index(str(path), mmap=True)
+    grown = resident_memory() - before
+    assert mapped.ntotal == 50_000
+    assert grown < size / 4
+
+
+def test_sidecar_detects_index_from_another_save(tmp_path):
+    path = tmp_path / "events.index"
+    save_flat_index(path, n=100, seed=0)
+    old_index = path.read_bytes()
+    save_flat_index(path, n=100, seed=1)
+
+    # Fallo entre las dos sustituciones de save: sidecar nuevo junto al índice anterior
+    path.write_bytes(old_index)
+    with pytest.raises(ValueError):
+        IndexPersistence.load_sidecar(str(path))
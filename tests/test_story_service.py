@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("faiss")
+pytest.importorskip("networkx")
+
+from PlotMind.StoryService import StoryCancelled, StoryService
+from PlotMind.StoryUpdates import StoryFinished
+
+
+class FakePlotMind:
+    """Genera al instante una historia que repite la descripción"""
+    story = ""
+
+    def stream(self, description):
+        yield StoryFinished(f"Historia: {description}")
+
+
+def test_start_stop_start():
+    async def run():
+        service = StoryService(workers=1, plotmind_factory=FakePlotMind)
+
+        await service.start()
+        await service.start()  # Arrancar dos veces no duplica los workers
+        assert len(service._tasks) == 1
+        assert await service.submit(1, "primera").result == "Historia: primera"
+
+        # Parar dos veces no falla y, parado, no se aceptan trabajos
+        await service.stop()
+        await service.stop()
+        with pytest.raises(RuntimeError):
+            service.submit(1, "sin arrancar")
+
+        await service.start()
+        assert service.jobs_of(1) == []
+        assert await service.submit(1, "segunda").result == "Historia: segunda"
+        await service.stop()
+
+    asyncio.run(run())
+
+
+def test_stop_cancels_pending_jobs():
+    async def run():
+        service = StoryService(workers=1, plotmind_factory=FakePlotMind)
+        await service.start()
+        job = service.submit(1, "pendiente")
+        await service.stop()
+        with pytest.raises(StoryCancelled):
+            await job.result
+
+    asyncio.run(run())